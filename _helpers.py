@@ -1,11 +1,33 @@
 import hashlib
+import json
 import os
+import shlex
 import sys
+import threading
+import time
+from collections import namedtuple
+from queue import Queue
+from subprocess import CalledProcessError
 from os.path import isfile, realpath, join as opj, sep as pathsep
 from string import Template
 from configparser import ConfigParser
+from .cluster_scripts.job_status import (parse_qstat_xml, qstat_command,
+                                         qstat_failed)
 
 
+# one record per job, as reported by cluster_scripts/scan_outputs.py
+JobOutput = namedtuple(
+    'JobOutput',
+    ['jobid', 'script_name', 'finished', 'stderr_size', 'exit_status']
+)
+
+# one record per job, as reported by cluster_scripts/ledger.py
+LedgerRecord = namedtuple(
+    'LedgerRecord',
+    ['job_name', 'jobid', 'array_index', 'state', 'exit_status', 'attempts',
+     'script_path', 'stdout_id', 'failure_class', 'failure_reason']
+)
+
 def attempt_load_config():
     """
     tries to load config file from expected path in instances where neither a
@@ -59,6 +81,24 @@ def fmt_remote_commands(commands):
     return executable + commands_str
 
 
+def fmt_array_indices(indices):
+    """
+    Formats an iterable of PBS job array indices as a compact range string
+    suitable for the "-t" option of qsub/mksub (e.g., [0, 1, 2, 5, 7, 8] ->
+    "0-2,5,7-8")
+    """
+    indices = sorted(set(int(i) for i in indices))
+    ranges = []
+    for ix in indices:
+        if ranges and ix == ranges[-1][1] + 1:
+            ranges[-1][1] = ix
+        else:
+            ranges.append([ix, ix])
+
+    return ','.join(str(start) if start == stop else f'{start}-{stop}'
+                    for start, stop in ranges)
+
+
 def get_qstat(remote_shell, options=None):
     """
     Return the status of running "qstat" on the cluster, optionally with a
@@ -83,7 +123,264 @@ def get_qstat(remote_shell, options=None):
     return remote_shell.check_output(cmds_fmt)
 
 
+def get_job_statuses(remote_shell, owner=None, job_name=None):
+    """
+    Returns structured status records for jobs on the cluster.  Jobs are
+    filtered by owner and/or name on the cluster, so only the relevant jobs'
+    info is transferred
+    :param remote_shell: (spurplus.SshShell instance)
+    :param owner: (str, optional) only include jobs submitted by this user
+    :param job_name: (str, optional) only include jobs with this name
+    :return statuses: (dict) maps full jobids (with array indices, for tasks
+                      of job arrays) to JobStatus records (see
+                      cluster_scripts/job_status.py)
+    """
+    cmd = fmt_remote_commands([qstat_command(owner, job_name)])
+    result = remote_shell.run(cmd, allow_error=True)
+    # raised rather than reporting an empty queue when the scheduler can't
+    # be queried
+    if qstat_failed(result.return_code, result.stderr_output):
+        raise CalledProcessError(result.return_code, cmd, result.output,
+                                 result.stderr_output)
+    qstat_output = result.output
+    if not qstat_output.strip():
+        return {}
+    return {status.jobid: status for status in parse_qstat_xml(qstat_output)}
+
+
+class JobStatusCache:
+    """
+    Caches the results of get_job_statuses for `ttl` seconds, so that
+    frequent status checks don't each run qstat on the cluster, and reports
+    which jobs' states have changed between polls
+    """
+    def __init__(self, remote_shell, owner=None, job_name=None, ttl=15):
+        self.remote_shell = remote_shell
+        self.owner = owner
+        self.job_name = job_name
+        self.ttl = ttl
+        self._statuses = {}
+        self._fetched_at = None
+        # states as of the last call to changes()
+        self._last_states = {}
+
+    def statuses(self, refresh=False):
+        """
+        returns the (possibly cached) dict of JobStatus records
+        """
+        if (refresh or self._fetched_at is None
+                or time.time() - self._fetched_at > self.ttl):
+            self._statuses = get_job_statuses(self.remote_shell,
+                                              owner=self.owner,
+                                              job_name=self.job_name)
+            self._fetched_at = time.time()
+        return self._statuses
+
+    def changes(self, refresh=False):
+        """
+        returns (jobid, previous state, current state) tuples for jobs whose
+        state changed since the last call.  Previous state is None for new
+        jobs and current state is None for jobs no longer reported by qstat
+        """
+        current = {jobid: status.state for jobid, status
+                   in self.statuses(refresh=refresh).items()}
+        changed = [(jobid, self._last_states.get(jobid), state)
+                   for jobid, state in current.items()
+                   if self._last_states.get(jobid) != state]
+        changed.extend((jobid, state, None) for jobid, state
+                       in self._last_states.items() if jobid not in current)
+        self._last_states = current
+        return changed
+
+
+def scan_job_outputs(remote_shell, workingdir, job_name):
+    """
+    Summarizes all of a job's stdout/stderr files on the cluster in a single
+    remote command (rather than reading each file over SFTP) by running
+    scan_outputs.py, uploaded to the working directory with the other cluster
+    scripts
+    :param remote_shell: (spurplus.SshShell instance)
+    :param workingdir: (str) remote directory containing the output files
+    :param job_name: (str) name given to the jobs in config.ini
+    :return outputs: (list) JobOutput records, one per job (bundled jobs
+                     share a stdout file, and therefore a jobid)
+    """
+    scanner_path = opj(workingdir, 'scan_outputs.py')
+    cmd = fmt_remote_commands(
+        [f'python3 {scanner_path} {workingdir} {job_name}']
+    )
+    scan_output = remote_shell.check_output(cmd)
+
+    outputs = []
+    for line in scan_output.splitlines():
+        if not line:
+            continue
+        (jobid, script_name, finished,
+         stderr_size, exit_status) = line.split('\t')
+        outputs.append(JobOutput(
+            jobid=jobid,
+            script_name=script_name,
+            finished=finished == '1',
+            stderr_size=int(stderr_size),
+            exit_status=int(exit_status) if exit_status else None
+        ))
+    return outputs
+
+
+def read_ledger(remote_shell, workingdir, job_name, sync=True):
+    """
+    Reads the state of every job from the project's job ledger on the cluster
+    (see cluster_scripts/ledger.py) with a single remote command
+    :param remote_shell: (spurplus.SshShell instance)
+    :param workingdir: (str) remote directory containing the ledger, job
+                       output files, and cluster scripts
+    :param job_name: (str) name given to the jobs in config.ini
+    :param sync: (bool, default: True) if True, update the state of running
+                 & queued jobs from qstat and their output files first
+    :return records: (list) LedgerRecord records, one per job
+    """
+    ledger_script = opj(workingdir, 'ledger.py')
+    ledger_path = opj(workingdir, f'{job_name}_ledger.db')
+    cmd = f'python3 {ledger_script} {ledger_path} status'
+    if sync:
+        cmd += f' --sync {workingdir} {job_name}'
+    ledger_output = remote_shell.check_output(fmt_remote_commands([cmd]))
+
+    records = []
+    for line in ledger_output.splitlines():
+        if not line:
+            continue
+        fields = [f if f else None for f in line.split('\t')]
+        for ix in (2, 4, 5):
+            if fields[ix] is not None:
+                fields[ix] = int(fields[ix])
+        records.append(LedgerRecord(*fields))
+    return records
+
+
+def read_resource_report(remote_shell, workingdir, job_name, margin=0.25):
+    """
+    Summarizes the resources used by finished jobs, as recorded in the
+    project's job ledger on the cluster (see
+    cluster_scripts/resource_usage.py), with a single remote command
+    :param remote_shell: (spurplus.SshShell instance)
+    :param workingdir: (str) remote directory containing the ledger & cluster
+                       scripts
+    :param job_name: (str) name given to the jobs in config.ini
+    :param margin: (float, default: 0.25) fraction added to the 95th
+                   percentile of usage when recommending requests
+    :return report: (dict) usage statistics ("stats"), recommended walltime,
+                    mem & ppn ("recommended", None if too few jobs have
+                    finished) and resource requests for jobs killed for
+                    exceeding a limit ("escalated", by job name)
+    """
+    usage_script = opj(workingdir, 'resource_usage.py')
+    ledger_path = opj(workingdir, f'{job_name}_ledger.db')
+    cmd = fmt_remote_commands(
+        [f'python3 {usage_script} {ledger_path} --margin {margin}']
+    )
+    return json.loads(remote_shell.check_output(cmd))
+
+
+def bulk_submit(remote_shell, workingdir, job_name, submit_cmd, submissions,
+                remove=()):
+    """
+    Submits (or resubmits) many jobs and removes stale output files with a
+    single remote command, by uploading a submission plan for
+    cluster_scripts/bulk_submit.py to run.  New jobids are recorded in the
+    project's job ledger on the cluster
+    :param remote_shell: (spurplus.SshShell instance)
+    :param workingdir: (str) remote directory containing the ledger & cluster
+                       scripts
+    :param job_name: (str) name given to the jobs in config.ini
+    :param submit_cmd: (str) command used to submit jobs (qsub or mksub)
+    :param submissions: (list) dicts with keys "script_path", "job_names",
+                        "array_indices" (None unless resubmitting job array
+                        tasks) and "options" (extra arguments to submit_cmd)
+    :param remove: (iterable, optional) remote paths of files to delete
+                   before submitting
+    :return results: (list) dicts with keys "job_name", "jobid" (None if
+                     submission failed) and "error" (None if it succeeded)
+    """
+    plan = {
+        'submit_cmd': submit_cmd,
+        'ledger_path': opj(workingdir, f'{job_name}_ledger.db'),
+        'remove': list(remove),
+        'submissions': list(submissions)
+    }
+    if not plan['submissions'] and not plan['remove']:
+        return []
+    plan_path = opj(workingdir, f'{job_name}_submit_plan.json')
+    remote_shell.write_text(plan_path, json.dumps(plan))
+    submitter_path = opj(workingdir, 'bulk_submit.py')
+    cmd = fmt_remote_commands([f'python3 {submitter_path} {plan_path}'])
+    submit_output = remote_shell.check_output(cmd)
+    return [json.loads(line) for line in submit_output.splitlines() if line]
+
+
+class _LineQueue:
+    """
+    file-like object that splits the text written to it into lines & puts
+    them on a queue
+    """
+    def __init__(self):
+        self.queue = Queue()
+        self._partial = ''
+
+    def write(self, text):
+        *lines, self._partial = (self._partial + text).split('\n')
+        for line in lines:
+            self.queue.put(line)
+
+    def flush(self):
+        pass
 
+    def close(self):
+        if self._partial:
+            self.queue.put(self._partial)
+            self._partial = ''
+
+
+def stream_lines(remote_shell, command):
+    """
+    runs a remote command, yielding each line of its stdout as soon as it's
+    printed (rather than all of them once the command finishes).  Raises
+    CalledProcessError if the command fails
+    :param remote_shell: (spurplus.SshShell or session_broker.SessionClient
+                         instance)
+    :param command: (list) the command, e.g. from fmt_remote_commands
+    """
+    if hasattr(remote_shell, 'stream'):
+        # connected through a session broker, which streams the lines itself
+        yield from remote_shell.stream(command)
+        return
+
+    stdout = _LineQueue()
+    proc = remote_shell.spawn(command, stdout=stdout, encoding='utf-8',
+                              allow_error=True)
+    finished = object()
+    outcome = {}
+
+    def _wait():
+        try:
+            outcome['result'] = proc.wait_for_result()
+        finally:
+            stdout.close()
+            stdout.queue.put(finished)
+
+    threading.Thread(target=_wait, daemon=True).start()
+    while True:
+        line = stdout.queue.get()
+        if line is finished:
+            break
+        yield line
+    result = outcome.get('result')
+    if result is None or result.return_code != 0:
+        raise CalledProcessError(
+            getattr(result, 'return_code', None), command,
+            getattr(result, 'output', None),
+            getattr(result, 'stderr_output', None)
+        )
 
 
 def md5_checksum(filepath):
@@ -103,6 +400,33 @@ def md5_checksum(filepath):
     return hash_md5.hexdigest()
 
 
+def remote_md5sums(remote_shell, remote_dir, relpaths, batch_size=1000):
+    """
+    computes the MD5 checksums of many remote files at once, using a single
+    md5sum invocation per `batch_size` files rather than a remote command per
+    file
+    :param remote_shell: (spurplus.SshShell instance)
+    :param remote_dir: (str) remote directory the paths are relative to
+    :param relpaths: (list) paths of files to checksum, relative to remote_dir
+    :param batch_size: (int, default: 1000) max number of files per command
+                       (keeps commands within the shell's argument limit)
+    :return checksums: (dict) maps relative paths to checksums.  Files that
+                       don't exist on the remote are omitted
+    """
+    checksums = {}
+    for start in range(0, len(relpaths), batch_size):
+        batch = ' '.join(shlex.quote(p)
+                         for p in relpaths[start:start + batch_size])
+        # missing files are reported on stderr & don't stop the rest
+        cmd = fmt_remote_commands([f'cd {shlex.quote(remote_dir)}',
+                                   f'md5sum -- {batch} 2>/dev/null; true'])
+        for line in remote_shell.check_output(cmd).splitlines():
+            if line:
+                checksum, path = line.split(maxsplit=1)
+                checksums[path.lstrip('*')] = checksum
+    return checksums
+
+
 def parse_config(config_path):
     """
     parses various user-specifc options from config file in configs dir
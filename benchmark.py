@@ -0,0 +1,388 @@
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from os.path import dirname, realpath, join as opj
+from ._helpers import (
+                        bulk_submit,
+                        fmt_array_indices,
+                        read_ledger,
+                        scan_job_outputs
+                    )
+from .cluster_scripts.job_scripts import (
+                                            ARRAY_JOBSCRIPT_TEMPLATE,
+                                            JOBSCRIPT_TEMPLATE,
+                                            ScriptTemplate
+                                        )
+from .fake_pbs import install_fake_pbs
+from .session_broker import ExecutionResult
+from .upload_scripts import list_local_files, upload_scripts
+
+
+class LocalShell:
+    """
+    Stand-in for a spurplus.SshShell that runs commands & file operations on
+    the local machine (the "remote" directories are local temporary ones),
+    adding a fixed delay to each call to simulate the network round trip to
+    the cluster.  Counts the number of calls made
+    """
+    def __init__(self, rtt=0.02):
+        self.rtt = rtt
+        self.n_calls = 0
+
+    def _round_trip(self):
+        self.n_calls += 1
+        time.sleep(self.rtt)
+
+    def run(self, command, allow_error=False):
+        self._round_trip()
+        result = subprocess.run(command, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        if result.returncode != 0 and not allow_error:
+            raise subprocess.CalledProcessError(result.returncode, command,
+                                                result.stdout, result.stderr)
+        return ExecutionResult(result.returncode, result.stdout,
+                               result.stderr)
+
+    def check_output(self, command):
+        return self.run(command).output
+
+    def md5(self, remote_path):
+        return self.check_output(['md5sum', remote_path]).split()[0]
+
+    def read_text(self, remote_path):
+        self._round_trip()
+        with open(remote_path, 'r') as f:
+            return f.read()
+
+    def write_text(self, remote_path, text):
+        self._round_trip()
+        with open(remote_path, 'w') as f:
+            f.write(text)
+
+    def exists(self, remote_path):
+        self._round_trip()
+        return os.path.exists(remote_path)
+
+    def is_dir(self, remote_path):
+        self._round_trip()
+        if not os.path.exists(remote_path):
+            raise FileNotFoundError(remote_path)
+        return os.path.isdir(remote_path)
+
+    def mkdir(self, remote_path, parents=False, exist_ok=False):
+        self._round_trip()
+        if parents:
+            os.makedirs(remote_path, exist_ok=exist_ok)
+        else:
+            os.mkdir(remote_path)
+
+    def remove(self, remote_path):
+        self._round_trip()
+        os.remove(remote_path)
+
+    def put(self, local_path, remote_path, create_directories=True):
+        self._round_trip()
+        if create_directories:
+            os.makedirs(dirname(remote_path), exist_ok=True)
+        shutil.copyfile(local_path, remote_path)
+
+    def put_many(self, transfers, n_channels=4):
+        # transfers share n_channels concurrent round trips
+        transfers = list(transfers)
+        self.n_calls += len(transfers)
+        time.sleep(self.rtt * -(-len(transfers) // n_channels))
+        for local_path, remote_path in transfers:
+            shutil.copyfile(local_path, remote_path)
+
+
+class Benchmark:
+    """
+    Times each stage of running a sweep (uploading scripts, writing job
+    scripts, submitting, scanning output files, syncing the job ledger, and
+    resubmitting failed jobs) against a fake PBS scheduler (see fake_pbs.py)
+    and a simulated remote shell
+    :param root: (str) temporary directory standing in for the cluster
+    :param rtt: (float) simulated network round trip time, in seconds
+    :param per_job_limit: (int) largest sweep to also submit one job at a time
+                          (one scheduler call per job is slow for big sweeps)
+    """
+    def __init__(self, root, rtt=0.02, per_job_limit=1000):
+        self.root = root
+        self.workingdir = opj(root, 'scripts')
+        self.shell = LocalShell(rtt=rtt)
+        self.per_job_limit = per_job_limit
+        self.results = []
+        os.makedirs(self.workingdir, exist_ok=True)
+
+    def job_config(self, jobname):
+        return {
+            'jobname': jobname,
+            'startdir': self.root,
+            'workingdir': self.workingdir,
+            'datadir': opj(self.root, 'data'),
+            'scriptdir': opj(self.workingdir, f'{jobname}_scripts'),
+            'queue': 'largeq',
+            'nnodes': 1,
+            'ppn': 1,
+            'walltime': '1:00:00',
+            'mem': '',
+            'email_updates': 'n',
+            'email_addr': '',
+            'modules': 'python',
+            'env_type': 'conda',
+            'env_name': 'base',
+            'activate_cmd': 'source activate',
+            'deactivate_cmd': 'conda deactivate',
+            'env_snapshot': '',
+            'cmd_wrapper': 'python',
+            'array_slot_limit': '',
+            'bundle_task_time': '0:01:00',
+            'max_queued': '',
+            'queue_poll_interval': 60,
+            'submit_parallel': 4,
+            'live_logs': 'false'
+        }
+
+    def time_stage(self, stage, n_jobs, func, *args, **kwargs):
+        calls_before = self.shell.n_calls
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        self.results.append({
+            'stage': stage,
+            'n_jobs': n_jobs,
+            'seconds': round(seconds, 4),
+            'jobs_per_second': round(n_jobs / seconds, 1) if n_jobs else None,
+            'remote_calls': self.shell.n_calls - calls_before
+        })
+        print(f"{stage:>16} {n_jobs:>7} jobs: {seconds:8.3f}s "
+              f"({self.shell.n_calls - calls_before} remote calls)")
+        return result
+
+    def upload(self):
+        script_dir = opj(dirname(realpath(__file__)), 'cluster_scripts')
+        conf = self.job_config('upload')
+        n_files = len(list_local_files(script_dir))
+        self.time_stage('upload', n_files, upload_scripts, self.shell,
+                        script_dir, conf, confirm_overwrite=False)
+        self.time_stage('upload_unchanged', n_files, upload_scripts,
+                        self.shell, script_dir, conf, confirm_overwrite=False)
+
+    def run_sweep(self, n_jobs):
+        names = [f'job_{i}' for i in range(n_jobs)]
+        commands = [f'cruncher.py {i}' for i in range(n_jobs)]
+
+        # one script per job, submitted one at a time
+        template = ScriptTemplate(JOBSCRIPT_TEMPLATE,
+                                  self.job_config(f'sweep{n_jobs}'))
+
+        def _generate():
+            paths = []
+            for name, command in zip(names, commands):
+                if not template.lock(name, command):
+                    paths.append(template.write_scriptfile(name, command))
+            return paths
+
+        def _submit(paths):
+            for name, path in zip(names, paths):
+                jobid = template.submit_job(path)
+                template.ledger.record_submission([name], jobid, [path])
+            template.ledger.flush()
+
+        paths = self.time_stage('generate', n_jobs, _generate)
+        if n_jobs <= self.per_job_limit:
+            self.time_stage('submit_per_job', n_jobs, _submit, paths)
+        template.release_locks()
+
+        # the same sweep as a single job array
+        jobname = f'sweep{n_jobs}_array'
+        array_template = ScriptTemplate(JOBSCRIPT_TEMPLATE,
+                                        self.job_config(jobname))
+
+        def _submit_array():
+            for name, command in zip(names, commands):
+                array_template.lock(name, command)
+            path, _ = array_template.write_array_scriptfile(
+                ARRAY_JOBSCRIPT_TEMPLATE, zip(names, commands)
+            )
+            jobid = array_template.submit_job(path)
+            array_template.ledger.record_submission(
+                names, jobid, [path] * n_jobs, array_indices=range(n_jobs)
+            )
+            array_template.release_locks()
+
+        self.time_stage('submit_array', n_jobs, _submit_array)
+        self.time_stage('scan', n_jobs, scan_job_outputs, self.shell,
+                        self.workingdir, jobname)
+        jobs = self.time_stage('sync', n_jobs, read_ledger, self.shell,
+                               self.workingdir, jobname, sync=True)
+
+        def _resubmit():
+            # as in resubmit_failed.py
+            failed = [j for j in jobs if j.state == 'failed']
+            stale_outputs = [opj(self.workingdir,
+                                 f'{jobname}.{stream}{j.stdout_id}')
+                             for j in failed for stream in ('o', 'e')]
+            submissions = [{
+                'script_path': failed[0].script_path,
+                'job_names': [j.job_name for j in failed],
+                'array_indices': [j.array_index for j in failed],
+                'options': ['-t', fmt_array_indices(j.array_index
+                                                    for j in failed)]
+            }] if failed else []
+            return bulk_submit(self.shell, self.workingdir, jobname, 'qsub',
+                               submissions, remove=stale_outputs)
+
+        n_failed = len([j for j in jobs if j.state == 'failed'])
+        self.time_stage('resubmit', n_failed, _resubmit)
+
+    def report(self):
+        return {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'rtt': self.shell.rtt,
+            'scheduler_latency': float(os.environ.get('FAKE_PBS_LATENCY', 0)),
+            'fail_rate': float(os.environ.get('FAKE_PBS_FAIL_RATE', 0)),
+            'results': self.results
+        }
+
+
+def compare_reports(report, baseline, tolerance=0.2):
+    """
+    returns the results that took more than (1 + tolerance) times as long as
+    the same stage & sweep size in the baseline report, as (result, baseline
+    seconds) pairs
+    """
+    baseline_times = {(r['stage'], r['n_jobs']): r['seconds']
+                      for r in baseline['results']}
+    regressions = []
+    for result in report['results']:
+        base = baseline_times.get((result['stage'], result['n_jobs']))
+        if base and result['seconds'] > base * (1 + tolerance):
+            regressions.append((result, base))
+    return regressions
+
+
+def run_benchmarks(sizes=(100, 1000, 10000), rtt=0.02, latency=0.0,
+                   fail_rate=0.05, per_job_limit=1000):
+    """
+    runs the benchmark suite for sweeps of each size and returns a report
+    :param sizes: (iterable) numbers of jobs per sweep
+    :param rtt: (float, default: 0.02) simulated network round trip time, in
+    seconds
+    :param latency: (float, default: 0) time each fake scheduler command takes
+    to respond, in seconds
+    :param fail_rate: (float, default: 0.05) fraction of jobs that fail
+    :param per_job_limit: (int, default: 1000) largest sweep to also submit
+    one job at a time
+    :return report: (dict) machine-readable benchmark results
+    """
+    with tempfile.TemporaryDirectory() as root:
+        bin_dir = opj(root, 'bin')
+        install_fake_pbs(bin_dir)
+        bench = Benchmark(opj(root, 'cluster'), rtt=rtt,
+                          per_job_limit=per_job_limit)
+        saved_env = dict(os.environ)
+        os.environ.update({
+            'PATH': f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}",
+            'FAKE_PBS_DIR': opj(root, 'pbs'),
+            'FAKE_PBS_LATENCY': str(latency),
+            'FAKE_PBS_FAIL_RATE': str(fail_rate),
+            'FAKE_PBS_OUTDIR': bench.workingdir
+        })
+        # job scripts are written & submitted from the "remote" working dir
+        cwd = os.getcwd()
+        os.chdir(bench.workingdir)
+        try:
+            bench.upload()
+            for n_jobs in sizes:
+                bench.run_sweep(n_jobs)
+        finally:
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(saved_env)
+        return bench.report()
+
+
+if __name__ == '__main__':
+    description = "Benchmark job submission, output scanning & resubmission \
+    against a fake PBS scheduler"
+    arg_parser = ArgumentParser(description=description)
+    arg_parser.add_argument(
+        "--sizes",
+        nargs='+',
+        type=int,
+        default=[100, 1000, 10000],
+        help="Numbers of jobs per sweep (e.g., 100 1000 10000 100000)"
+    )
+    arg_parser.add_argument(
+        "--rtt",
+        default=0.02,
+        type=float,
+        help="Simulated network round trip time to the cluster, in seconds"
+    )
+    arg_parser.add_argument(
+        "--latency",
+        default=0.0,
+        type=float,
+        help="Time each scheduler command (qsub, qstat, etc.) takes, in \
+        seconds"
+    )
+    arg_parser.add_argument(
+        "--fail-rate",
+        default=0.05,
+        type=float,
+        help="Fraction of jobs that fail (and are resubmitted)"
+    )
+    arg_parser.add_argument(
+        "--per-job-limit",
+        default=1000,
+        type=int,
+        help="Largest sweep to also submit one job at a time"
+    )
+    arg_parser.add_argument(
+        "--output",
+        default='benchmark_report.json',
+        type=str,
+        help="Path to write the JSON report to"
+    )
+    arg_parser.add_argument(
+        "--baseline",
+        default=None,
+        type=str,
+        help="Report from a previous run to compare against.  Exits with \
+        status 1 if any stage got slower by more than --tolerance"
+    )
+    arg_parser.add_argument(
+        "--tolerance",
+        default=0.2,
+        type=float,
+        help="Allowed fractional slowdown relative to the baseline"
+    )
+    args = arg_parser.parse_args()
+
+    bench_report = run_benchmarks(args.sizes, rtt=args.rtt,
+                                  latency=args.latency,
+                                  fail_rate=args.fail_rate,
+                                  per_job_limit=args.per_job_limit)
+    with open(args.output, 'w') as f:
+        json.dump(bench_report, f, indent=2)
+    print(f"report written to {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline_report = json.load(f)
+        slower = compare_reports(bench_report, baseline_report, args.tolerance)
+        for result, base_seconds in slower:
+            print(f"REGRESSION: {result['stage']} ({result['n_jobs']} jobs) "
+                  f"took {result['seconds']:.3f}s vs {base_seconds:.3f}s")
+        if slower:
+            sys.exit(1)
@@ -0,0 +1,279 @@
+#!/usr/bin/python
+
+# rsync-style block-level delta transfer, used to update large files on the
+# cluster (e.g., in datadir) by sending only the blocks that changed.
+#   1. the cluster computes a signature of its copy of the file: a weak
+#      (rolling, Adler-32) and a strong (MD5) checksum of each block
+#      python3 block_delta.py signature <path> <block size>
+#   2. the local machine scans its copy for blocks matching the signature
+#      (at any offset, using the rolling checksum) and writes a delta
+#      consisting of references to matched blocks & literal data
+#   3. the delta is uploaded and applied against the cluster's copy, writing
+#      the new file alongside it and atomically replacing the old one
+#      python3 block_delta.py patch <path> <delta path> <block size>
+# The module can also be run locally to compare the number of bytes sent
+# with & without delta transfer for a synthetic file:
+#   python block_delta.py benchmark [--size-mb N] [--block-size N]
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from argparse import ArgumentParser
+
+ADLER_MOD = 65521
+# delta records: copy a run of blocks from the old file, or insert literal data
+COPY = b'C'
+LITERAL = b'L'
+RECORD_HEADER = struct.Struct('>cQQ')
+# split literal runs so the patcher never needs to hold much in memory
+MAX_LITERAL = 1 << 24
+# most offsets whose rolling checksums are computed at once (bounds the memory
+# used & keeps the running sums within 64-bit integers)
+SCAN_CHUNK = 1 << 22
+
+
+def file_signature(path, block_size):
+    """
+    returns a list of (weak checksum, strong checksum) pairs, one per block
+    of the file
+    """
+    signature = []
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            signature.append((zlib.adler32(block),
+                              hashlib.md5(block).hexdigest()))
+    return signature
+
+
+def candidate_offsets(data, start, stop, block_size, weak_checksums):
+    """
+    returns (offset, weak checksum) pairs for the offsets in [start, stop)
+    of data where the block starting there has one of the given weak
+    (Adler-32) checksums.  The checksums of every block are computed together
+    from running sums, rather than rolled forward one byte at a time
+    """
+    # numpy is only needed on the local machine, to compute deltas (the
+    # cluster just computes signatures & applies deltas)
+    import numpy as np
+
+    window = np.frombuffer(data, dtype=np.uint8,
+                           count=stop - start + block_size - 1,
+                           offset=start).astype(np.int64)
+    byte_sums = np.concatenate(([0], np.cumsum(window)))
+    weighted_sums = np.concatenate(
+        ([0], np.cumsum(window * np.arange(len(window))))
+    )
+    offsets = np.arange(stop - start)
+    # a = 1 + sum(block), b = sum over the block of (block_size - i) * byte i
+    # (+ block_size, from the 1 a starts at)
+    sums = byte_sums[offsets + block_size] - byte_sums[offsets]
+    weighted = (weighted_sums[offsets + block_size] - weighted_sums[offsets]
+                - offsets * sums)
+    a = (1 + sums) % ADLER_MOD
+    b = (block_size * (1 + sums) - weighted) % ADLER_MOD
+    weak = (b << 16) | a
+    matches = np.flatnonzero(np.isin(weak, weak_checksums))
+    return zip((start + matches).tolist(), weak[matches].tolist())
+
+
+def write_delta(path, signature, block_size, delta_file):
+    """
+    compares a local file against the signature of the remote copy and writes
+    the delta needed to reconstruct the local file from the remote one
+    :param path: (str) path to the local (new) version of the file
+    :param signature: (list) output of file_signature for the remote copy
+    :param block_size: (int) block size the signature was computed with
+    :param delta_file: (file-like) binary stream the delta is written to
+    :return n_matched: (int) number of blocks that didn't need to be sent
+    """
+    # the local file is scanned in full-size blocks, so if the remote's last
+    # block is short, it's never matched (it's sent as literal data)
+    blocks = {}
+    for ix, (weak, strong) in enumerate(signature):
+        blocks.setdefault(weak, {}).setdefault(strong, ix)
+
+    copy_start = copy_count = n_matched = 0
+
+    def _flush_copy():
+        nonlocal copy_count
+        if copy_count:
+            delta_file.write(RECORD_HEADER.pack(COPY, copy_start, copy_count))
+            copy_count = 0
+
+    def _write_literal(data):
+        for start in range(0, len(data), MAX_LITERAL):
+            chunk = data[start:start + MAX_LITERAL]
+            delta_file.write(RECORD_HEADER.pack(LITERAL, 0, len(chunk)))
+            delta_file.write(chunk)
+
+    def _match(pos, weak):
+        # index of the remote block the local block at pos matches, if any
+        if weak not in blocks:
+            return None
+        strong = hashlib.md5(data[pos:pos + block_size]).hexdigest()
+        return blocks[weak].get(strong)
+
+    size = os.path.getsize(path)
+    if size == 0:
+        return 0
+
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        pos = literal_start = 0
+        weak_checksums = list(blocks)
+        n_offsets = max(size - block_size + 1, 0)
+        # offsets scanned at once after a miss; grows while nothing matches
+        scan_len = block_size
+        while pos < n_offsets:
+            # the block at pos is checked first, on its own (the common case
+            # for files edited in place: the next block matches)
+            match_pos = pos
+            match_ix = _match(pos, zlib.adler32(data[pos:pos + block_size]))
+            if match_ix is None:
+                # otherwise, only the offsets whose weak checksum matches one
+                # of the remote's blocks are compared, in order
+                stop = min(pos + scan_len, n_offsets)
+                for match_pos, weak in candidate_offsets(
+                        data, pos + 1, stop, block_size, weak_checksums
+                ):
+                    match_ix = _match(match_pos, weak)
+                    if match_ix is not None:
+                        break
+                else:
+                    pos = stop
+                    scan_len = min(2 * scan_len, SCAN_CHUNK)
+                    continue
+
+            if literal_start < match_pos:
+                _flush_copy()
+                _write_literal(data[literal_start:match_pos])
+            if copy_count and match_ix == copy_start + copy_count:
+                copy_count += 1
+            else:
+                _flush_copy()
+                copy_start, copy_count = match_ix, 1
+            n_matched += 1
+            pos = literal_start = match_pos + block_size
+            scan_len = block_size
+
+        _flush_copy()
+        if literal_start < size:
+            _write_literal(data[literal_start:size])
+    return n_matched
+
+
+def apply_delta(basis_path, delta_path, block_size, dest_path=None):
+    """
+    reconstructs the new version of a file from the old version (basis_path)
+    and a delta.  The new file is written to a temporary file in the same
+    directory, then atomically moved to dest_path (basis_path by default).
+    Returns the MD5 checksum of the new file
+    """
+    if dest_path is None:
+        dest_path = basis_path
+    hash_md5 = hashlib.md5()
+    dest_dir = os.path.dirname(os.path.abspath(dest_path))
+    fd, tmp_path = tempfile.mkstemp(dir=dest_dir, prefix='.delta-')
+    try:
+        with open(basis_path, 'rb') as basis, open(delta_path, 'rb') as delta, \
+                os.fdopen(fd, 'wb') as out:
+            for header in iter(lambda: delta.read(RECORD_HEADER.size), b''):
+                kind, start, count = RECORD_HEADER.unpack(header)
+                if kind == COPY:
+                    basis.seek(start * block_size)
+                    remaining = count * block_size
+                    while remaining:
+                        chunk = basis.read(min(remaining, MAX_LITERAL))
+                        remaining -= len(chunk)
+                        out.write(chunk)
+                        hash_md5.update(chunk)
+                else:
+                    chunk = delta.read(count)
+                    out.write(chunk)
+                    hash_md5.update(chunk)
+        if os.path.exists(dest_path):
+            os.chmod(tmp_path, os.stat(dest_path).st_mode)
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return hash_md5.hexdigest()
+
+
+def benchmark(size_mb=64, block_size=1 << 16, n_edits=8, insert_bytes=100):
+    """
+    creates a random file, modifies a few regions (in-place edits plus an
+    insertion that shifts all subsequent data), and reports the number of
+    bytes that would be sent with & without delta transfer
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        old_path = os.path.join(tmpdir, 'old')
+        new_path = os.path.join(tmpdir, 'new')
+        delta_path = os.path.join(tmpdir, 'delta')
+        size = size_mb * (1 << 20)
+        with open(old_path, 'wb') as f:
+            f.write(os.urandom(size))
+        with open(old_path, 'rb') as f:
+            content = bytearray(f.read())
+        for edit_ix in range(n_edits):
+            offset = (edit_ix + 1) * size // (n_edits + 1)
+            content[offset:offset + 10] = os.urandom(10)
+        content[size // 2:size // 2] = os.urandom(insert_bytes)
+        with open(new_path, 'wb') as f:
+            f.write(content)
+
+        start = time.time()
+        signature = file_signature(old_path, block_size)
+        sig_time = time.time() - start
+        start = time.time()
+        with open(delta_path, 'wb') as f:
+            n_matched = write_delta(new_path, signature, block_size, f)
+        delta_time = time.time() - start
+        start = time.time()
+        new_md5 = apply_delta(old_path, delta_path, block_size)
+        patch_time = time.time() - start
+
+        with open(new_path, 'rb') as f:
+            assert new_md5 == hashlib.md5(f.read()).hexdigest(), \
+                "reconstructed file doesn't match the original"
+
+        whole_bytes = os.path.getsize(new_path)
+        # 20 bytes per block (4-byte weak + 16-byte strong checksum) on the
+        # wire for the signature, plus the delta itself
+        delta_bytes = os.path.getsize(delta_path) + 20 * len(signature)
+        print(f"file size: {whole_bytes} bytes, block size: {block_size}")
+        print(f"whole-file transfer: {whole_bytes} bytes sent")
+        print(f"delta transfer: {delta_bytes} bytes sent "
+              f"({100 * delta_bytes / whole_bytes:.2f}%), "
+              f"{n_matched}/{len(signature)} blocks matched")
+        print(f"signature: {sig_time:.2f}s, delta: {delta_time:.2f}s, "
+              f"patch: {patch_time:.2f}s")
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser(description="Block-level delta transfer")
+    subparsers = arg_parser.add_subparsers(dest='action')
+    sig_parser = subparsers.add_parser('signature')
+    sig_parser.add_argument("path", type=str)
+    sig_parser.add_argument("block_size", type=int)
+    patch_parser = subparsers.add_parser('patch')
+    patch_parser.add_argument("path", type=str)
+    patch_parser.add_argument("delta_path", type=str)
+    patch_parser.add_argument("block_size", type=int)
+    bench_parser = subparsers.add_parser('benchmark')
+    bench_parser.add_argument("--size-mb", default=64, type=int)
+    bench_parser.add_argument("--block-size", default=1 << 16, type=int)
+    args = arg_parser.parse_args()
+
+    if args.action == 'signature':
+        for weak, strong in file_signature(args.path, args.block_size):
+            sys.stdout.write(f'{weak}\t{strong}\n')
+    elif args.action == 'patch':
+        # prints the new file's checksum so the upload can be verified
+        print(apply_delta(args.path, args.delta_path, args.block_size))
+    else:
+        benchmark(args.size_mb, args.block_size)
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+
+# submits many jobs (and cleans up old output files) in a single remote
+# invocation, rather than one SSH round trip per job.  Reads a JSON plan
+# written by _helpers.bulk_submit:
+#   {"submit_cmd": "qsub", "ledger_path": <path or null>,
+#    "remove": [<paths of output files to delete>],
+#    "submissions": [{"script_path": <path>, "options": [<qsub options>],
+#                     "job_names": [...], "array_indices": [...] or null}]}
+# and prints one JSON line per job as it's submitted:
+#   {"job_name": ..., "jobid": <new jobid or null>, "error": <str or null>}
+# New jobids are recorded in the job ledger in a single transaction.
+import json
+import os
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from os.path import dirname, realpath
+from subprocess import run, PIPE
+
+try:
+    from .ledger import JobLedger
+    from .local_backend import LocalBackend, pbs_available
+except ImportError:
+    # run as a script on the cluster
+    from ledger import JobLedger
+    from local_backend import LocalBackend, pbs_available
+
+
+def remove_outputs(paths):
+    n_removed = 0
+    for path in paths:
+        try:
+            os.remove(path)
+            n_removed += 1
+        except FileNotFoundError:
+            # e.g., job was killed before its output was written
+            pass
+    return n_removed
+
+
+def submit(submit_cmd, submission, local_backend=None):
+    """
+    submits a single script and returns (jobid, error message)
+    """
+    if local_backend is not None:
+        try:
+            return local_backend.submit(submission['script_path'],
+                                        submission.get('options', [])), None
+        except (OSError, ValueError) as e:
+            return None, str(e)
+    result = run([submit_cmd, *submission.get('options', []),
+                  submission['script_path']],
+                 stdout=PIPE, stderr=PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        return None, result.stderr.strip() or f'exit status {result.returncode}'
+    return result.stdout.strip(), None
+
+
+def submit_plan(plan, n_parallel=4):
+    """
+    carries out a submission plan, yielding a result dict for each job
+    """
+    remove_outputs(plan.get('remove', []))
+    ledger = None
+    if plan.get('ledger_path'):
+        ledger = JobLedger(plan['ledger_path'])
+
+    local_backend = None
+    if not pbs_available(plan['submit_cmd']):
+        # no scheduler here, so run the jobs on this machine (from the
+        # working directory the cluster scripts were uploaded to)
+        local_backend = LocalBackend(dirname(realpath(__file__)))
+
+    submissions = plan.get('submissions', [])
+    # a few submissions in flight at once, without flooding the server
+    with ThreadPoolExecutor(max_workers=n_parallel) as pool:
+        results = pool.map(
+            lambda s: submit(plan['submit_cmd'], s, local_backend),
+            submissions
+        )
+        try:
+            for submission, (jobid, error) in zip(submissions, results):
+                job_names = submission['job_names']
+                array_indices = submission.get('array_indices')
+                if ledger is not None and jobid is not None:
+                    ledger.record_submission(job_names, jobid,
+                                             array_indices=array_indices)
+                for job_name in job_names:
+                    yield {'job_name': job_name, 'jobid': jobid,
+                           'error': error}
+        finally:
+            if ledger is not None:
+                ledger.close()
+            if local_backend is not None:
+                local_backend.shutdown()
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser(description="Submit jobs in bulk")
+    arg_parser.add_argument("plan_path", type=str)
+    arg_parser.add_argument("--parallel", default=4, type=int)
+    args = arg_parser.parse_args()
+
+    with open(args.plan_path, 'r') as f:
+        submission_plan = json.load(f)
+    os.remove(args.plan_path)
+
+    for job_result in submit_plan(submission_plan, n_parallel=args.parallel):
+        sys.stdout.write(json.dumps(job_result) + '\n')
+        sys.stdout.flush()
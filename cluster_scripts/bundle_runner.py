@@ -0,0 +1,84 @@
+#!/usr/bin/python
+
+# runs a bundle of jobs (written by submit.py in bundle mode) on a pool of
+# workers within a single PBS allocation
+import shlex
+import sys
+from argparse import ArgumentParser
+from os.path import dirname, realpath, join as opj
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import run, PIPE
+from threading import Lock
+
+# keeps output from concurrently finishing jobs from being interleaved
+print_lock = Lock()
+instrument_script = opj(dirname(realpath(__file__)), 'instrument.py')
+
+
+def read_manifest(manifest_path):
+    """
+    reads (job name, job command) pairs from a tab-separated manifest file
+    """
+    with open(manifest_path, 'r') as f:
+        return [tuple(line.rstrip('\n').split('\t', 1))
+                for line in f if line.strip()]
+
+
+def run_task(task_ix, job_name, job_command, cmd_wrapper, instrument=False):
+    """
+    runs a single job in its own process and, once it's done, prints its output
+    between the same markers JOBSCRIPT_TEMPLATE would, so each job in the
+    bundle can be tracked individually by resubmit_failed.py.  If instrument
+    is True, the job is run by instrument.py, which adds a line with its
+    timing & resource use to its output
+    """
+    command = f'{cmd_wrapper} {job_command}'
+    if instrument:
+        command = (f'{shlex.quote(sys.executable)} {instrument_script} run '
+                   f'--job-name {shlex.quote(job_name)} -- '
+                   f'/bin/bash -c {shlex.quote(command)}')
+    result = run(command, shell=True, executable='/bin/bash', stdout=PIPE,
+                 stderr=PIPE, universal_newlines=True)
+    with print_lock:
+        sys.stdout.write('---\n'
+                         f'script name: {job_name}\n'
+                         f'bundle task: {task_ix}\n'
+                         f'{result.stdout}'
+                         f'exit status: {result.returncode}\n'
+                         'job script finished\n'
+                         '---\n')
+        sys.stdout.flush()
+        if result.stderr:
+            sys.stderr.write(f'--- script name: {job_name}\n{result.stderr}')
+            sys.stderr.flush()
+    return result.returncode
+
+
+def run_bundle(manifest_path, n_workers, cmd_wrapper, instrument=False):
+    """
+    runs every job listed in the manifest, at most n_workers at a time.
+    Returns the number of jobs that exited with a non-zero status
+    """
+    tasks = read_manifest(manifest_path)
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(run_task, ix, name, cmd, cmd_wrapper,
+                               instrument)
+                   for ix, (name, cmd) in enumerate(tasks)]
+        return sum(1 for fut in futures if fut.result() != 0)
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser(description="Run a bundle of jobs in parallel")
+    arg_parser.add_argument("manifest_path", type=str)
+    arg_parser.add_argument("--workers", default=1, type=int)
+    arg_parser.add_argument("--cmd-wrapper", default='python', type=str)
+    arg_parser.add_argument("--instrument", action='store_true',
+                            help="Record each job's timing & resource use \
+                            (see instrument.py)")
+    args = arg_parser.parse_args()
+
+    n_failed = run_bundle(args.manifest_path, args.workers, args.cmd_wrapper,
+                          args.instrument)
+    print(f"{n_failed} jobs in bundle exited with non-zero status")
+    # so jobs that depend on the bundle only run if all of its jobs succeeded
+    sys.exit(1 if n_failed else 0)
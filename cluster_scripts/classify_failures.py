@@ -0,0 +1,131 @@
+#!/usr/bin/python
+
+# sorts failed jobs into classes, so that only jobs that might succeed if
+# resubmitted are resubmitted:
+#   transient      the job (or its node) was interrupted, e.g. by a node
+#                  failure, preemption, or a filesystem hiccup.  Also used for
+#                  jobs that left no error message at all
+#   resource       the job ran out of walltime or memory
+#   deterministic  the job itself failed, e.g. with a Python exception, a
+#                  missing file, or a bad "module load", and will fail again
+# Classification looks at the end of the job's stderr & stdout files, the
+# resource limit PBS killed it for exceeding (if any, see ledger.py), and the
+# exit status PBS reported for it.  The ledger classifies each job when it's
+# found to have failed
+import re
+
+TRANSIENT = 'transient'
+RESOURCE = 'resource'
+DETERMINISTIC = 'deterministic'
+RETRYABLE = (TRANSIENT, RESOURCE)
+
+# how much of the end of each output file is read
+TAIL_BYTES = 64 * 1024
+
+# (class, description, pattern) in the order they're checked: an exception
+# caused by a stale file handle is transient, not deterministic
+FAILURE_PATTERNS = [
+    (RESOURCE, 'out of memory',
+     r'MemoryError|Out of memory|out-of-memory|oom-kill|Cannot allocate '
+     r'memory|std::bad_alloc|exceeded memory limit|mem \S+ exceeded limit'),
+    (RESOURCE, 'out of walltime', r'walltime \S+ exceeded limit'),
+    (TRANSIENT, 'node failure',
+     r'node failure|node \S+ (is )?down|lost connection to node|'
+     r'MOM .* (died|rejected)'),
+    (TRANSIENT, 'preempted', r'preempt|requeue'),
+    (TRANSIENT, 'filesystem error',
+     r'Stale file handle|Input/output error|Transport endpoint is not '
+     r'connected|Resource temporarily unavailable'),
+    (TRANSIENT, 'network error',
+     r'Connection (reset|refused|timed out)|Temporary failure in name '
+     r'resolution|Socket timed out'),
+    (DETERMINISTIC, 'out of disk space',
+     r'Disk quota exceeded|No space left on device'),
+    (DETERMINISTIC, 'bad module load',
+     r'Lmod has detected the following error|module: command not found|'
+     r'ERROR: Unable to locate a modulefile'),
+    (DETERMINISTIC, 'missing environment',
+     r'EnvironmentNameNotFound|Could not find conda environment|'
+     r'Not a conda environment'),
+    (DETERMINISTIC, 'missing file', r'No such file or directory|'
+     r'FileNotFoundError|cannot open file'),
+    (DETERMINISTIC, 'command not found', r'command not found'),
+    (DETERMINISTIC, 'exception', r'Traceback \(most recent call last\)'),
+    (DETERMINISTIC, 'crashed', r'Segmentation fault|core dumped|Aborted'),
+]
+FAILURE_REGEXES = [(failure_class, description, re.compile(pattern))
+                   for failure_class, description, pattern
+                   in FAILURE_PATTERNS]
+# e.g. "ValueError: ...", the last line of a Python traceback
+EXCEPTION_LINE = re.compile(r'^(\w+(\.\w+)*(Error|Exception)\b.*)$', re.M)
+
+
+def read_tail(path, n_bytes=TAIL_BYTES):
+    """returns the last n_bytes of a file ('' if it doesn't exist)"""
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, 2)
+            f.seek(max(0, f.tell() - n_bytes))
+            return f.read().decode(errors='replace')
+    except FileNotFoundError:
+        return ''
+
+
+def job_section(text, job_name):
+    """
+    returns the part of a bundle's stderr written by one of its jobs (see
+    bundle_runner.py), or all of text if there aren't separate sections
+    """
+    marker = f'--- script name: {job_name}\n'
+    start = text.rfind(marker)
+    if start == -1:
+        return text
+    end = text.find('--- script name: ', start + len(marker))
+    return text[start:end if end != -1 else len(text)]
+
+
+def _last_exception(text):
+    matches = EXCEPTION_LINE.findall(text)
+    return matches[-1][0].strip() if matches else None
+
+
+def classify(stderr_text, stdout_text='', killed_by=None,
+             pbs_exit_status=None):
+    """
+    returns (failure class, reason) for a failed job
+    :param stderr_text: (str) the end of the job's stderr file
+    :param stdout_text: (str) the end of the job's stdout file
+    :param killed_by: (str, optional) resource the job was killed for
+                      exceeding the limit of (e.g., "walltime", "mem")
+    :param pbs_exit_status: (int, optional) exit status reported by PBS.
+                            Negative values mean the job couldn't be started
+                            on its node; values over 256 mean it was killed
+                            by a signal (256 + signal number)
+    """
+    if killed_by is not None:
+        if killed_by in ('mem', 'vmem', 'pmem'):
+            return RESOURCE, 'out of memory'
+        return RESOURCE, f'out of {killed_by}'
+
+    text = f'{stderr_text}\n{stdout_text}'
+    for failure_class, description, regex in FAILURE_REGEXES:
+        match = regex.search(text)
+        if match is None:
+            continue
+        if failure_class == DETERMINISTIC:
+            exception = _last_exception(stderr_text)
+            if exception is not None:
+                return failure_class, exception[:200]
+        # the line the match is on
+        line_start = text.rfind('\n', 0, match.start()) + 1
+        line_end = text.find('\n', match.end())
+        if line_end == -1:
+            line_end = len(text)
+        line = text[line_start:line_end].strip()
+        return failure_class, f'{description}: {line[:200]}'
+
+    if pbs_exit_status is not None and pbs_exit_status < 0:
+        return TRANSIENT, f'failed to start on node (exit {pbs_exit_status})'
+    if pbs_exit_status is not None and pbs_exit_status > 256:
+        return TRANSIENT, f'killed by signal {pbs_exit_status - 256}'
+    return TRANSIENT, 'no error in output (job or node interrupted)'
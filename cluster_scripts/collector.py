@@ -1,3 +1,442 @@
 #!/usr/bin/python
 
-from .config import job_config
+# merges per-job result files in datadir (.npy, .npz, .csv, or pickle) into a
+# single columnar store: one raw binary file per column, which can be loaded
+# as a memory-mapped array (see load_results).  Files are parsed in parallel
+# and appended to the store as they're read, so results never need to fit in
+# memory all at once.  A checkpoint records each ingested file's path, mtime &
+# size, so re-running after more jobs finish only processes new (or changed)
+# files:
+#   python collector.py [--datadir DIR] [--store DIR] [--pattern GLOB]
+#                       [--workers N]
+import json
+import os
+import pickle
+import sys
+import time
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from fnmatch import fnmatch
+from os.path import join as opj
+
+import numpy as np
+
+try:
+    from .config import job_config
+except ImportError:
+    # run as a script on the cluster
+    from config import job_config
+
+RESULT_EXTENSIONS = ('.npy', '.npz', '.csv', '.pkl', '.pickle')
+MANIFEST_NAME = 'manifest.json'
+# index (into the manifest's list of sources) of the file each row came from
+SOURCE_COLUMN = '_source'
+# dtypes that can be stored in fixed-width binary columns
+STORABLE_KINDS = 'biufcUSMm'
+# rows are copied in chunks of this many when a column is rewritten
+COPY_CHUNK = 1 << 20
+
+
+def _as_columns(data):
+    """
+    converts a loaded result (structured or plain array, dict of arrays or
+    scalars, list of dicts, or DataFrame) to a dict of equal-length 1D arrays
+    """
+    if hasattr(data, 'to_records'):
+        # pandas DataFrame
+        data = data.to_records(index=False)
+    if isinstance(data, list) and all(isinstance(d, dict) for d in data):
+        keys = list(dict.fromkeys(k for d in data for k in d))
+        data = {k: [d.get(k) for d in data] for k in keys}
+
+    if isinstance(data, dict):
+        columns = {str(k): np.atleast_1d(np.asarray(v))
+                   for k, v in data.items()}
+    else:
+        arr = np.asarray(data)
+        if arr.dtype.names is not None:
+            arr = np.atleast_1d(arr)
+            columns = {name: arr[name] for name in arr.dtype.names}
+        elif arr.ndim <= 1:
+            columns = {'value': np.atleast_1d(arr)}
+        elif arr.ndim == 2:
+            columns = {f'c{i}': arr[:, i] for i in range(arr.shape[1])}
+        else:
+            raise ValueError(f"can't store {arr.ndim}-dimensional array")
+
+    lengths = {len(c) for c in columns.values()}
+    if len(lengths) > 1:
+        raise ValueError(f"columns have different lengths: {sorted(lengths)}")
+    for name, column in columns.items():
+        if column.ndim != 1:
+            raise ValueError(f"column {name} isn't one-dimensional")
+        if column.dtype.kind not in STORABLE_KINDS:
+            raise ValueError(f"column {name} has unsupported dtype "
+                             f"{column.dtype}")
+    return columns
+
+
+def read_result(path):
+    """
+    loads a single result file and returns it as a dict of column arrays
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.npy':
+        data = np.load(path, allow_pickle=False)
+    elif ext == '.npz':
+        with np.load(path, allow_pickle=False) as npz:
+            data = {k: npz[k] for k in npz.files}
+    elif ext == '.csv':
+        data = np.genfromtxt(path, delimiter=',', names=True, dtype=None,
+                             encoding='utf-8')
+    elif ext in ('.pkl', '.pickle'):
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+    else:
+        raise ValueError(f"unsupported result file type: {ext}")
+    return _as_columns(data)
+
+
+def _read_job(job):
+    # runs in a worker process; errors are returned rather than raised so one
+    # bad file doesn't stop the collection
+    relpath, path, mtime, size = job
+    try:
+        return relpath, mtime, size, read_result(path), None
+    except Exception as e:
+        return relpath, mtime, size, None, f'{type(e).__name__}: {e}'
+
+
+def _missing_dtype(dtype):
+    # integer & boolean columns can't represent missing values, so they're
+    # converted to floats (filled with NaN) when some rows lack them
+    if dtype.kind in 'biu':
+        return np.dtype('float64')
+    return dtype
+
+
+def _fill_value(dtype):
+    if dtype.kind in 'fc':
+        return np.nan
+    if dtype.kind in 'Mm':
+        return np.array('NaT', dtype=dtype)
+    if dtype.kind in 'US':
+        return ''
+    return 0
+
+
+class ResultStore:
+    """
+    Append-only columnar store.  Each column is a raw binary file
+    (<column>.bin) whose dtype, along with the number of rows, list of source
+    files, and checkpoint of ingested files, is kept in manifest.json.  The
+    manifest is only replaced (atomically) after the column files it
+    describes have been written to disk, so an interrupted collection leaves
+    the store at its last checkpoint
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+        self.manifest_path = opj(store_dir, MANIFEST_NAME)
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'n_rows': 0, 'columns': {}, 'sources': [],
+                             'superseded': [], 'files': {}}
+        self.dtypes = {name: np.dtype(dt)
+                       for name, dt in self.manifest['columns'].items()}
+        self.n_rows = self.manifest['n_rows']
+        self._handles = {}
+        # discard anything written after the last checkpoint
+        for name, dtype in self.dtypes.items():
+            path = self._column_path(name)
+            if os.path.getsize(path) != self.n_rows * dtype.itemsize:
+                os.truncate(path, self.n_rows * dtype.itemsize)
+
+    def _column_path(self, name):
+        return opj(self.store_dir, f'{name}.bin')
+
+    def _handle(self, name):
+        if name not in self._handles:
+            self._handles[name] = open(self._column_path(name), 'ab')
+        return self._handles[name]
+
+    def _write_fill(self, f, dtype, n_rows):
+        fill = np.full(min(n_rows, COPY_CHUNK), _fill_value(dtype),
+                       dtype=dtype)
+        for start in range(0, n_rows, COPY_CHUNK):
+            f.write(fill[:min(COPY_CHUNK, n_rows - start)].tobytes())
+
+    def _set_dtype(self, name, dtype):
+        """adds a new column (filled for existing rows) or converts one"""
+        path = self._column_path(name)
+        if name not in self.dtypes:
+            if self.n_rows:
+                dtype = _missing_dtype(dtype)
+            with open(path, 'wb') as f:
+                self._write_fill(f, dtype, self.n_rows)
+        else:
+            old_dtype = self.dtypes[name]
+            handle = self._handles.pop(name, None)
+            if handle is not None:
+                handle.close()
+            tmp_path = f'{path}.tmp'
+            with open(path, 'rb') as src, open(tmp_path, 'wb') as dest:
+                while True:
+                    chunk = np.fromfile(src, dtype=old_dtype,
+                                        count=COPY_CHUNK)
+                    if not len(chunk):
+                        break
+                    dest.write(chunk.astype(dtype).tobytes())
+            os.replace(tmp_path, path)
+        self.dtypes[name] = dtype
+
+    def _promote(self, name, incoming):
+        stored = self.dtypes[name]
+        if stored.kind in 'US' or incoming.kind in 'US':
+            if stored.kind != incoming.kind:
+                raise ValueError(f"column {name} mixes {stored} and "
+                                 f"{incoming} values")
+        try:
+            return np.result_type(stored, incoming)
+        except TypeError:
+            # no common type, e.g. datetimes & floats (DTypePromotionError)
+            raise ValueError(f"column {name} mixes {stored} and "
+                             f"{incoming} values")
+
+    def append(self, source, columns):
+        """
+        appends the rows from one result file.  Columns that are new to the
+        store, or missing from this file, are filled in for the other rows
+        """
+        if not columns:
+            return
+        n_new = len(next(iter(columns.values())))
+        columns = dict(columns)
+        columns[SOURCE_COLUMN] = np.full(n_new, source, dtype=np.int32)
+
+        # check all columns before changing anything, so a file that can't
+        # be stored doesn't leave the store half-updated
+        new_dtypes = {}
+        for name, column in columns.items():
+            if name in self.dtypes:
+                new_dtypes[name] = self._promote(name, column.dtype)
+        old_dtypes = dict(self.dtypes)
+        for name, dtype in new_dtypes.items():
+            if dtype != self.dtypes[name]:
+                self._set_dtype(name, dtype)
+        for name, column in columns.items():
+            if name not in self.dtypes:
+                self._set_dtype(name, column.dtype)
+        for name, dtype in list(self.dtypes.items()):
+            if name not in columns and _missing_dtype(dtype) != dtype:
+                self._set_dtype(name, _missing_dtype(dtype))
+        if self.dtypes != old_dtypes:
+            # the manifest must describe the rewritten column files
+            self.checkpoint()
+
+        for name, dtype in self.dtypes.items():
+            f = self._handle(name)
+            if name in columns:
+                f.write(columns[name].astype(dtype, copy=False).tobytes())
+            else:
+                self._write_fill(f, dtype, n_new)
+        self.n_rows += n_new
+
+    def add_source(self, relpath, mtime, size):
+        """
+        registers an ingested result file, whose rows were appended with the
+        next source index.  If an earlier version of the file was already
+        ingested, its rows are superseded
+        """
+        previous = self.manifest['files'].get(relpath)
+        if previous is not None:
+            self.manifest['superseded'].append(previous['source'])
+        self.manifest['sources'].append(relpath)
+        source = len(self.manifest['sources']) - 1
+        self.manifest['files'][relpath] = {'mtime': mtime, 'size': size,
+                                           'source': source}
+
+    def is_current(self, relpath, mtime, size):
+        ingested = self.manifest['files'].get(relpath)
+        return (ingested is not None and ingested['mtime'] == mtime
+                and ingested['size'] == size)
+
+    def checkpoint(self):
+        for f in self._handles.values():
+            f.flush()
+            os.fsync(f.fileno())
+        self.manifest['n_rows'] = self.n_rows
+        self.manifest['columns'] = {name: dtype.str
+                                    for name, dtype in self.dtypes.items()}
+        tmp_path = f'{self.manifest_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.manifest_path)
+
+    def close(self):
+        self.checkpoint()
+        for f in self._handles.values():
+            f.close()
+        self._handles = {}
+
+
+def find_results(datadir, pattern='*', exclude=()):
+    """
+    recursively finds result files in datadir whose names match pattern.
+    Yields (path relative to datadir, absolute path, mtime, size) tuples
+    """
+    exclude = {os.path.realpath(p) for p in exclude}
+    dirs = [datadir]
+    while dirs:
+        current = dirs.pop()
+        with os.scandir(current) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    if os.path.realpath(entry.path) not in exclude:
+                        dirs.append(entry.path)
+                elif (entry.name.lower().endswith(RESULT_EXTENSIONS)
+                      and fnmatch(entry.name, pattern)):
+                    st = entry.stat()
+                    yield (os.path.relpath(entry.path, datadir), entry.path,
+                           st.st_mtime, st.st_size)
+
+
+def collect(datadir, store_dir, pattern='*', n_workers=None, min_age=60,
+            checkpoint_every=100):
+    """
+    ingests new & changed result files from datadir into the store
+    :param datadir: (str) directory containing jobs' result files
+    :param store_dir: (str) directory containing the store (created if it
+                      doesn't exist)
+    :param pattern: (str, default: '*') only ingest files whose names match
+                    this glob pattern
+    :param n_workers: (int, optional) number of processes used to read files.
+                      Defaults to the number of available cores
+    :param min_age: (int, default: 60) skip files modified within this many
+                    seconds (they may still be being written)
+    :param checkpoint_every: (int, default: 100) save progress after
+                             ingesting this many files
+    :return: (tuple) number of files ingested & list of (path, error) for
+             files that couldn't be read
+    """
+    if n_workers is None:
+        try:
+            n_workers = len(os.sched_getaffinity(0))
+        except AttributeError:
+            n_workers = os.cpu_count() or 1
+
+    store = ResultStore(store_dir)
+    cutoff = time.time() - min_age
+    todo = ((relpath, path, mtime, size) for relpath, path, mtime, size
+            in find_results(datadir, pattern, exclude=[store_dir])
+            if mtime < cutoff and not store.is_current(relpath, mtime, size))
+    n_ingested = 0
+    errors = []
+
+    def _ingest(result):
+        nonlocal n_ingested
+        relpath, mtime, size, columns, error = result
+        if error is None:
+            try:
+                store.append(len(store.manifest['sources']), columns)
+                store.add_source(relpath, mtime, size)
+            except (TypeError, ValueError) as e:
+                error = str(e)
+        if error is not None:
+            # not checkpointed, so the file is retried next time
+            errors.append((relpath, error))
+            return
+        n_ingested += 1
+        if n_ingested % checkpoint_every == 0:
+            store.checkpoint()
+            print(f"ingested {n_ingested} files ({store.n_rows} rows)")
+
+    try:
+        if n_workers <= 1:
+            for job in todo:
+                _ingest(_read_job(job))
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                # keep a bounded number of files in flight so results are
+                # written as they're read rather than piling up in memory
+                pending = deque()
+                for job in todo:
+                    pending.append(pool.submit(_read_job, job))
+                    if len(pending) >= 2 * n_workers:
+                        _ingest(pending.popleft().result())
+                while pending:
+                    _ingest(pending.popleft().result())
+    finally:
+        store.close()
+    return n_ingested, errors
+
+
+def load_results(store_dir, columns=None):
+    """
+    loads the store as a dict of column arrays.  Columns are memory-mapped
+    (read-only) unless some rows have been superseded by re-ingested files,
+    in which case the current rows are copied into memory
+    :param store_dir: (str) directory containing the store
+    :param columns: (list, optional) names of columns to load (default: all)
+    :return results: (dict) maps column names to arrays.  The "_source"
+                     column indexes into results["_sources"], the list of
+                     result files' paths relative to datadir
+    """
+    with open(opj(store_dir, MANIFEST_NAME), 'r') as f:
+        manifest = json.load(f)
+    n_rows = manifest['n_rows']
+    names = list(manifest['columns']) if columns is None else list(columns)
+    load_names = set(names) | {SOURCE_COLUMN}
+
+    results = {}
+    for name in load_names:
+        dtype = np.dtype(manifest['columns'][name])
+        if n_rows == 0:
+            results[name] = np.empty(0, dtype=dtype)
+        else:
+            results[name] = np.memmap(opj(store_dir, f'{name}.bin'),
+                                      dtype=dtype, mode='r', shape=(n_rows,))
+    if manifest['superseded']:
+        keep = ~np.isin(results[SOURCE_COLUMN], manifest['superseded'])
+        results = {name: col[keep] for name, col in results.items()}
+    results = {name: results[name] for name in names + [SOURCE_COLUMN]
+               if name in results}
+    results['_sources'] = manifest['sources']
+    return results
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser(description="Collect jobs' results into a \
+    single columnar store")
+    arg_parser.add_argument("--datadir", default=None, type=str,
+                            help="Directory containing result files (default: \
+                            datadir from config.ini)")
+    arg_parser.add_argument("--store", default=None, type=str,
+                            help="Directory to write the store to (default: \
+                            <datadir>/<jobname>_results)")
+    arg_parser.add_argument("--pattern", default='*', type=str,
+                            help="Only collect files whose names match this \
+                            pattern")
+    arg_parser.add_argument("--workers", default=None, type=int,
+                            help="Number of processes to read files with")
+    arg_parser.add_argument("--min-age", default=60, type=int,
+                            help="Skip files modified within this many \
+                            seconds")
+    args = arg_parser.parse_args()
+
+    datadir = args.datadir or job_config['datadir']
+    store_dir = args.store or opj(datadir, f"{job_config['jobname']}_results")
+    start = time.time()
+    n_files, read_errors = collect(datadir, store_dir, pattern=args.pattern,
+                                   n_workers=args.workers,
+                                   min_age=args.min_age)
+    print(f"ingested {n_files} new files in {time.time() - start:.1f}s")
+    for err_path, message in read_errors:
+        sys.stderr.write(f"couldn't ingest {err_path}: {message}\n")
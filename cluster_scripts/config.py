@@ -21,3 +21,11 @@ with config_path.open() as f:
 # job_config['workingdir'] = opj(job_config['startir'], 'scripts')
 # job_config['scriptdir'] = opj(job_config['workingdir'], 'scripts')
 # job_config['lockdir'] = opj(job_config['workingdir'], 'locks')
+
+
+def as_bool(value):
+    """
+    converts a boolean option read from config.ini (e.g., "true", "no", "1")
+    to a bool.  Empty values are treated as False
+    """
+    return str(value).strip().lower() in ('1', 'yes', 'true', 'on')
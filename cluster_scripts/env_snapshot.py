@@ -0,0 +1,145 @@
+#!/usr/bin/python
+
+# captures the environment that loading config['modules'] & activating
+# config['env_name'] produce (PATH, LD_LIBRARY_PATH, conda variables, etc.) in
+# a snapshot file that job scripts source instead of running "module load" &
+# the activation command themselves, when config['cache_environment'] is
+# enabled.  Snapshots are named for a hash of the options that determine the
+# environment, so changing any of them in config.ini causes a new snapshot to
+# be captured.  Snapshots no sweep has used for SNAPSHOT_MAX_AGE are removed
+# (not sooner, since jobs still in the queue may source them).  To capture a
+# snapshot by hand:
+#   python3 env_snapshot.py <workingdir> --modules "<modules>" \
+#       --activate-cmd "source activate" --env-name <env name>
+import hashlib
+import os
+import shlex
+import time
+from argparse import ArgumentParser
+from os.path import isfile, join as opj
+from subprocess import run, PIPE
+
+SNAPSHOT_DIR = 'env_snapshots'
+# options that determine the environment jobs run in
+SNAPSHOT_FIELDS = ('modules', 'env_type', 'env_name', 'activate_cmd')
+# snapshots not used by a sweep for this many seconds are removed
+SNAPSHOT_MAX_AGE = 30 * 24 * 3600
+# differ from shell to shell (or are set by PBS for each job), so are never
+# restored from a snapshot
+VOLATILE_VARS = {'_', 'PWD', 'OLDPWD', 'SHLVL', 'HOSTNAME', 'RANDOM',
+                 'TMPDIR'}
+VOLATILE_PREFIXES = ('PBS_', 'BASH_FUNC_')
+
+
+def snapshot_key(config):
+    values = '\0'.join(str(config[field]) for field in SNAPSHOT_FIELDS)
+    return hashlib.sha256(values.encode()).hexdigest()[:16]
+
+
+def _login_env(setup_cmds=()):
+    """
+    returns the environment a login shell has after running setup_cmds, or
+    None if any of them fail
+    """
+    script = ' && '.join([*setup_cmds, 'env -0'])
+    result = run(['bash', '-l', '-c', script], stdout=PIPE, stderr=PIPE)
+    if result.returncode != 0:
+        return None
+    env = {}
+    for entry in result.stdout.decode(errors='replace').split('\0'):
+        name, sep, value = entry.partition('=')
+        if sep:
+            env[name] = value
+    return env
+
+
+def _is_volatile(name):
+    return name in VOLATILE_VARS or name.startswith(VOLATILE_PREFIXES)
+
+
+def capture_snapshot(snapshot_path, modules, activate_cmd, env_name):
+    """
+    writes a script that exports every variable loading modules & activating
+    the environment sets or changes (and unsets any they remove).  Returns
+    False (without writing anything) if loading or activation fails
+    """
+    baseline = _login_env()
+    setup_cmds = []
+    if modules:
+        setup_cmds.append(f'module load {modules}')
+    setup_cmds.append(f'{activate_cmd} {env_name}')
+    activated = _login_env(setup_cmds)
+    if baseline is None or activated is None:
+        return False
+
+    lines = [f'# environment after: {"; ".join(setup_cmds)}\n']
+    for name, value in sorted(activated.items()):
+        if not _is_volatile(name) and baseline.get(name) != value:
+            lines.append(f'export {name}={shlex.quote(value)}\n')
+    for name in sorted(set(baseline) - set(activated)):
+        if not _is_volatile(name):
+            lines.append(f'unset {name}\n')
+
+    # written under a temporary name so jobs never source a partial snapshot
+    tmp_path = f'{snapshot_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.writelines(lines)
+    os.replace(tmp_path, snapshot_path)
+    return True
+
+
+def ensure_snapshot(config):
+    """
+    returns the path to a snapshot of the environment described by config
+    (captured now if there isn't one for the current options), or None if
+    it couldn't be captured
+    """
+    snapshot_dir = opj(config['workingdir'], SNAPSHOT_DIR)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    snapshot_path = opj(snapshot_dir, f'{snapshot_key(config)}.sh')
+    if isfile(snapshot_path):
+        # the modification time records when a sweep last used it
+        os.utime(snapshot_path)
+    else:
+        print("capturing environment snapshot...")
+        if not capture_snapshot(snapshot_path, config['modules'],
+                                config['activate_cmd'], config['env_name']):
+            return None
+    prune_snapshots(snapshot_dir, keep=snapshot_path)
+    return snapshot_path
+
+
+def prune_snapshots(snapshot_dir, keep=None, max_age=SNAPSHOT_MAX_AGE):
+    """
+    removes snapshots (other than keep) that no sweep has used for max_age
+    seconds.  Snapshots for earlier options aren't removed as soon as they're
+    replaced, since jobs that are still queued source them
+    """
+    cutoff = time.time() - max_age
+    with os.scandir(snapshot_dir) as entries:
+        for entry in entries:
+            if (entry.name.endswith('.sh') and entry.path != keep
+                    and entry.stat().st_mtime < cutoff):
+                os.remove(entry.path)
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser(description="Capture the environment jobs run \
+    in, so job scripts can restore it without loading modules or activating \
+    the environment")
+    arg_parser.add_argument("workingdir", type=str)
+    arg_parser.add_argument("--modules", default='', type=str)
+    arg_parser.add_argument("--env-type", default='conda', type=str)
+    arg_parser.add_argument("--env-name", required=True, type=str)
+    arg_parser.add_argument("--activate-cmd", default='source activate',
+                            type=str)
+    args = arg_parser.parse_args()
+
+    path = ensure_snapshot({'workingdir': args.workingdir,
+                            'modules': args.modules,
+                            'env_type': args.env_type,
+                            'env_name': args.env_name,
+                            'activate_cmd': args.activate_cmd})
+    if path is None:
+        raise SystemExit("failed to load modules or activate environment")
+    print(path)
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+
+# keeps at most a window of the user's jobs queued or running at once, so that
+# large sweeps don't run into the scheduler's per-user queue limits.  Used by
+# ScriptTemplate.submit_job when config['max_queued'] is set: the submitter
+# job becomes a feeder that waits before each submission until the number of
+# the user's jobs in the queue (as of the last qstat poll, plus any submitted
+# since) leaves room for it.  The window adapts to what the scheduler accepts:
+#   - when a submission is rejected for exceeding a queue limit, the window
+#     shrinks to a little below the number of jobs queued at the time
+#   - each poll of the queue without a rejection since the last one grows the
+#     window by one job, back up to max_queued
+# Rejected submissions are retried after poll_interval, unless they're
+# rejected repeatedly while none of the user's jobs are queued (so it isn't a
+# queue limit rejecting them)
+import getpass
+import os
+import re
+import time
+
+try:
+    from .job_status import query_jobs
+except ImportError:
+    # run as a script on the cluster
+    from job_status import query_jobs
+
+# qsub/mksub errors caused by a per-user or per-queue job limit, e.g.:
+#   qsub: would exceed queue generic's per-user limit of jobs in 'Q' state
+#   qsub: Maximum number of jobs already in queue for user MSG=...
+# (but not permanent rejections, e.g. "Job exceeds queue resource limits")
+QUEUE_LIMIT_ERROR = re.compile(r'limit of jobs|maximum number of jobs',
+                               re.IGNORECASE)
+
+
+class Feeder:
+    """
+    :param max_queued: (int) most jobs to have queued or running at once
+    :param owner: (str, optional) user whose jobs count towards the window
+                  (default: the current user)
+    :param poll_interval: (float) seconds to wait between qstat polls while
+                          the window is full
+    :param backoff: (float) fraction of the jobs queued when a submission is
+                    rejected that the window shrinks to
+    :param max_idle_rejections: (int) times in a row a submission may be
+                                rejected with none of the owner's jobs queued
+                                before it's given up on
+    """
+    def __init__(self, max_queued, owner=None, poll_interval=60,
+                 backoff=0.9, max_idle_rejections=5):
+        self.max_queued = int(max_queued)
+        self.window = self.max_queued
+        self.owner = owner or getpass.getuser()
+        self.poll_interval = float(poll_interval)
+        self.backoff = backoff
+        self.n_active = None
+        self.n_since_poll = 0
+        self.last_poll = 0
+        self.max_idle_rejections = max_idle_rejections
+        self.n_rejections = 0
+        self.n_idle_rejections = 0
+        self._rejected_since_poll = False
+
+    def poll(self):
+        """
+        counts the owner's jobs that are in the queue (incl. running).  If the
+        scheduler can't be queried, the previous count is kept (or, before
+        the first successful poll, the window is treated as full), so a
+        failed query is never mistaken for an empty queue
+        """
+        statuses = query_jobs(owner=self.owner)
+        self.last_poll = time.monotonic()
+        if statuses is None:
+            if self.n_active is None:
+                self.n_active = self.window
+            return self.n_active
+        # the submitter job itself doesn't count
+        own_jobid = os.environ.get('PBS_JOBID')
+        self.n_active = len([status for status in statuses
+                             if status.state != 'C'
+                             and status.jobid != own_jobid])
+        self.n_since_poll = 0
+        if not self._rejected_since_poll and self.window < self.max_queued:
+            self.window += 1
+        self._rejected_since_poll = False
+        return self.n_active
+
+    @property
+    def n_queued(self):
+        if self.n_active is None:
+            self.poll()
+        return self.n_active + self.n_since_poll
+
+    def acquire(self, n_jobs=1):
+        """
+        blocks until there's room in the window for n_jobs more jobs.  A job
+        array bigger than the whole window waits for the queue to drain
+        """
+        waiting = False
+        while self.n_queued + min(n_jobs, self.window) > self.window:
+            if not waiting:
+                print(f"{self.n_queued} jobs queued (window: {self.window}); "
+                      f"waiting for jobs to finish...")
+                waiting = True
+            time.sleep(max(0, self.last_poll + self.poll_interval
+                           - time.monotonic()))
+            self.poll()
+
+    def submitted(self, n_jobs=1):
+        self.n_since_poll += n_jobs
+        self.n_idle_rejections = 0
+
+    def rejected(self):
+        """
+        shrinks the window after the scheduler rejects a submission, since
+        the queue is at (or past) our limit, then waits poll_interval before
+        it's retried.  Returns False if it shouldn't be retried, i.e., it's
+        been rejected max_idle_rejections times in a row with none of our
+        jobs queued
+        """
+        self.n_rejections += 1
+        self._rejected_since_poll = True
+        n_active = self.poll()
+        self._rejected_since_poll = True
+        if n_active == 0:
+            self.n_idle_rejections += 1
+            if self.n_idle_rejections >= self.max_idle_rejections:
+                print(f"submission rejected {self.n_idle_rejections} times "
+                      f"with no jobs queued; giving up on it")
+                self.n_idle_rejections = 0
+                return False
+        self.window = max(1, min(self.window, int(n_active * self.backoff)))
+        print(f"submission rejected with {n_active} jobs queued; "
+              f"window reduced to {self.window}")
+        time.sleep(self.poll_interval)
+        return True
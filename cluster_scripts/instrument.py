@@ -0,0 +1,231 @@
+#!/usr/bin/python
+
+# per-job timing & resource instrumentation, used when config['instrument'] is
+# enabled.  The instrumented job script templates record when each phase of
+# the job (loading modules, activating the environment) ends and run the job
+# command through this script, which times it and measures its peak RSS and
+# CPU time, then prints a single JSON line to the job's stdout:
+#   instrumentation: {"job_name": ..., "phases": {"modules": <seconds>,
+#                     "activate": <seconds>, "command": <seconds>}, ...}
+# "report" aggregates those lines across a sweep's stdout files:
+#   python3 instrument.py report <workingdir> <job name> [--json] [--top N]
+import json
+import os
+import resource
+import socket
+import sys
+import time
+from argparse import ArgumentParser, REMAINDER
+from subprocess import Popen
+
+try:
+    from .resource_usage import percentile
+except ImportError:
+    # run as a script on the cluster
+    from resource_usage import percentile
+
+PREFIX = 'instrumentation: '
+PHASES = ('modules', 'activate', 'command')
+PERCENTILES = (50, 90, 95, 99)
+# ru_maxrss is reported in kilobytes on Linux, but bytes on MacOS
+RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+def run_instrumented(command, job_name, started=None, modules_loaded=None,
+                     activated=None):
+    """
+    runs a job command (a list of arguments), then prints its
+    instrumentation record.  started, modules_loaded & activated are the
+    times (seconds since the epoch) the job script started, finished loading
+    modules & finished activating the environment.  Returns the command's
+    exit status
+    """
+    start = time.time()
+    timer = time.perf_counter()
+    proc = Popen(command)
+    try:
+        returncode = proc.wait()
+    except KeyboardInterrupt:
+        proc.terminate()
+        returncode = proc.wait()
+    wall = time.perf_counter() - timer
+    # this process's only child is the job command
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    phases = {}
+    if started is not None and modules_loaded is not None:
+        phases['modules'] = modules_loaded - started
+    if modules_loaded is not None and activated is not None:
+        phases['activate'] = activated - modules_loaded
+    phases['command'] = wall
+    record = {
+        'job_name': job_name,
+        'host': socket.gethostname(),
+        'jobid': os.environ.get('PBS_JOBID'),
+        'start': start,
+        'phases': phases,
+        'max_rss': usage.ru_maxrss * RSS_UNIT,
+        'user_time': usage.ru_utime,
+        'sys_time': usage.ru_stime,
+        'exit_status': returncode
+    }
+    sys.stdout.write(PREFIX + json.dumps(record) + '\n')
+    sys.stdout.flush()
+    # a command killed by a signal exits with 128 + the signal, as in bash
+    return returncode if returncode >= 0 else 128 - returncode
+
+
+def read_records(workingdir, job_name):
+    """
+    yields the instrumentation records in every {job_name}.o<jobid> file in
+    workingdir
+    """
+    stdout_prefix = f'{job_name}.o'
+    with os.scandir(workingdir) as entries:
+        for entry in entries:
+            if not entry.name.startswith(stdout_prefix):
+                continue
+            with open(entry.path, 'r', errors='replace') as f:
+                for line in f:
+                    if line.startswith(PREFIX):
+                        try:
+                            yield json.loads(line[len(PREFIX):])
+                        except ValueError:
+                            # cut off by the job being killed
+                            continue
+
+
+def _summarize(values):
+    summary = {f'p{q}': percentile(values, q) for q in PERCENTILES}
+    summary['mean'] = sum(values) / len(values)
+    summary['max'] = max(values)
+    return summary
+
+
+def build_report(records, top=10):
+    """
+    aggregates instrumentation records into percentile tables & hotspots
+    :param records: (iterable) instrumentation records (see read_records)
+    :param top: (int) number of slowest jobs to list
+    :return report: (dict) "n_jobs"; "metrics": summaries (p50, p90, p95,
+                    p99, mean & max) of each phase's duration, the total,
+                    peak RSS, CPU time & CPU efficiency (CPU time / command
+                    time); "phase_shares": each phase's share of total time;
+                    "slowest": the slowest jobs & their slowest phase;
+                    "slow_hosts": hosts whose median setup time (modules +
+                    activation) is over twice the overall median
+    """
+    records = list(records)
+    samples = {}
+    totals = []
+    by_host = {}
+    for record in records:
+        phases = record['phases']
+        total = sum(phases.values())
+        totals.append(total)
+        for phase, seconds in phases.items():
+            samples.setdefault(phase, []).append(seconds)
+        cpu_time = record['user_time'] + record['sys_time']
+        samples.setdefault('max_rss', []).append(record['max_rss'])
+        samples.setdefault('cpu_time', []).append(cpu_time)
+        if phases.get('command'):
+            samples.setdefault('cpu_efficiency', []).append(
+                cpu_time / phases['command']
+            )
+        setup = phases.get('modules', 0) + phases.get('activate', 0)
+        by_host.setdefault(record['host'], []).append(setup)
+
+    report = {'n_jobs': len(records), 'metrics': {}, 'phase_shares': {},
+              'slowest': [], 'slow_hosts': {}}
+    if not records:
+        return report
+    samples['total'] = totals
+    for metric, values in samples.items():
+        report['metrics'][metric] = _summarize(values)
+    grand_total = sum(totals) or 1
+    for phase in PHASES:
+        if phase in samples:
+            report['phase_shares'][phase] = sum(samples[phase]) / grand_total
+
+    ranked = sorted(zip(totals, records), key=lambda t: t[0], reverse=True)
+    for total, record in ranked[:top]:
+        phases = record['phases']
+        report['slowest'].append({
+            'job_name': record['job_name'],
+            'host': record['host'],
+            'total': total,
+            'slowest_phase': max(phases, key=phases.get)
+        })
+
+    median_setup = percentile([s for setups in by_host.values()
+                               for s in setups], 50)
+    for host, setups in by_host.items():
+        host_median = percentile(setups, 50)
+        if host_median > 2 * median_setup and host_median > 1:
+            report['slow_hosts'][host] = host_median
+    return report
+
+
+def _fmt_value(metric, value):
+    if metric == 'max_rss':
+        return f'{value / (1 << 20):.1f}M'
+    if metric == 'cpu_efficiency':
+        return f'{value:.2f}'
+    return f'{value:.2f}s'
+
+
+def print_report(report):
+    print(f"{report['n_jobs']} instrumented jobs")
+    if not report['n_jobs']:
+        return
+    columns = [f'p{q}' for q in PERCENTILES] + ['mean', 'max']
+    print(f"{'':>16}" + ''.join(f'{c:>11}' for c in columns))
+    for metric, summary in report['metrics'].items():
+        print(f'{metric:>16}' + ''.join(
+            f'{_fmt_value(metric, summary[c]):>11}' for c in columns
+        ))
+    print("\nshare of total time by phase:")
+    for phase, share in report['phase_shares'].items():
+        print(f'{phase:>16}{share:>10.1%}')
+    print("\nslowest jobs:")
+    for job in report['slowest']:
+        print(f"  {job['job_name']} ({job['host']}): {job['total']:.2f}s, "
+              f"mostly {job['slowest_phase']}")
+    if report['slow_hosts']:
+        print("\nhosts with slow module loading/environment activation:")
+        for host, setup in report['slow_hosts'].items():
+            print(f'  {host}: {setup:.2f}s median')
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser(description="Run an instrumented job command, \
+    or report on the instrumentation records of a sweep's jobs")
+    subparsers = arg_parser.add_subparsers(dest='action')
+    run_parser = subparsers.add_parser('run')
+    run_parser.add_argument("--job-name", required=True, type=str)
+    run_parser.add_argument("--started", default=None, type=float)
+    run_parser.add_argument("--modules-loaded", default=None, type=float)
+    run_parser.add_argument("--activated", default=None, type=float)
+    run_parser.add_argument("command", nargs=REMAINDER)
+    report_parser = subparsers.add_parser('report')
+    report_parser.add_argument("workingdir", type=str)
+    report_parser.add_argument("job_name", type=str)
+    report_parser.add_argument("--top", default=10, type=int,
+                               help="Number of slowest jobs to list")
+    report_parser.add_argument("--json", action='store_true',
+                               help="Print the report as JSON")
+    args = arg_parser.parse_args()
+
+    if args.action == 'run':
+        job_command = args.command
+        if job_command and job_command[0] == '--':
+            job_command = job_command[1:]
+        sys.exit(run_instrumented(job_command, args.job_name, args.started,
+                                  args.modules_loaded, args.activated))
+    else:
+        sweep_report = build_report(read_records(args.workingdir,
+                                                 args.job_name), args.top)
+        if args.json:
+            sys.stdout.write(json.dumps(sweep_report) + '\n')
+        else:
+            print_report(sweep_report)
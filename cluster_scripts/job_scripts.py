@@ -0,0 +1,576 @@
+#!/usr/bin/python
+
+# job script templates & the ScriptTemplate class that writes and submits job
+# scripts from them.  Kept separate from submit.py (which runs a sweep when
+# executed) so they can be imported by other tools, e.g. benchmark.py
+import getpass
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from os.path import dirname, realpath, join as opj
+from string import Template
+from subprocess import run, PIPE
+
+try:
+    from .config import as_bool
+    from .feeder import Feeder, QUEUE_LIMIT_ERROR
+    from .ledger import JobLedger, ledger_path
+    from .local_backend import LocalBackend, pbs_available
+except ImportError:
+    # run as a script on the cluster
+    from config import as_bool
+    from feeder import Feeder, QUEUE_LIMIT_ERROR
+    from ledger import JobLedger, ledger_path
+    from local_backend import LocalBackend, pbs_available
+
+bundle_runner = opj(dirname(realpath(__file__)), 'bundle_runner.py')
+instrument_script = opj(dirname(realpath(__file__)), 'instrument.py')
+# printed by ScriptTemplate.submit_jobs for each submission, followed by a JSON
+# object with its "jobid" & "job_names", so a caller streaming submit.py's
+# output (see remote_submit.py) can follow which jobs have been submitted
+SUBMISSION_PREFIX = 'submission: '
+
+# with config['live_logs'] enabled, "#PBS -k oed" has PBS write each job's
+# stdout & stderr directly to their final paths in the working directory as
+# the job runs (rather than spooling them on the compute node & copying them
+# there once it's done), so tail_logs.py can follow running jobs
+
+# every script exits with its job command's exit status (bundle scripts exit
+# with bundle_runner.py's: non-zero if any job failed), so jobs that depend on
+# it (qsub -W depend=afterok, see pipeline.py) only run if it succeeded
+JOBSCRIPT_TEMPLATE = Template(
+"""#!/bin/bash -l
+#PBS -N ${jobname}
+#PBS -q ${queue}
+#PBS -l nodes=${nnodes}:ppn=${ppn}
+#PBS -l walltime=${walltime}${mem_request}
+#PBS -m $email_updates
+#PBS -M $email_addr
+${live_logs_directive}
+
+echo ---
+echo script name: $job_name
+echo loading modules: $modules
+$load_modules
+
+echo activating ${env_type} environment: $env_name
+$activate_env
+
+echo calling job script
+$cmd_wrapper $job_command
+exit_status=$$?
+echo exit status: $$exit_status
+echo job script finished
+$deactivate_env
+echo ---
+exit $$exit_status"""
+)
+
+
+# used when config['array_mode'] is enabled: a single script is submitted as a
+# PBS job array and each task looks up its job name & command from a manifest
+# file by $PBS_ARRAYID (line N+1 of the manifest holds task N)
+ARRAY_JOBSCRIPT_TEMPLATE = Template(
+"""#!/bin/bash -l
+#PBS -N ${jobname}
+#PBS -q ${queue}
+#PBS -l nodes=${nnodes}:ppn=${ppn}
+#PBS -l walltime=${walltime}${mem_request}
+#PBS -t ${array_range}
+#PBS -m $email_updates
+#PBS -M $email_addr
+${live_logs_directive}
+
+IFS=$$'\\t' read -r job_name job_command < <(sed -n "$$((PBS_ARRAYID + 1))p" $manifest_path)
+
+echo ---
+echo script name: $$job_name
+echo array index: $$PBS_ARRAYID
+echo loading modules: $modules
+$load_modules
+
+echo activating ${env_type} environment: $env_name
+$activate_env
+
+echo calling job script
+eval "$cmd_wrapper $$job_command"
+exit_status=$$?
+echo exit status: $$exit_status
+echo job script finished
+$deactivate_env
+echo ---
+exit $$exit_status"""
+)
+
+
+# used instead of JOBSCRIPT_TEMPLATE & ARRAY_JOBSCRIPT_TEMPLATE when
+# config['instrument'] is enabled: the end of each phase is timestamped and
+# the job command is run by instrument.py, which prints a JSON line with the
+# phases' durations and the command's peak RSS & CPU time
+INSTRUMENTED_JOBSCRIPT_TEMPLATE = Template(
+"""#!/bin/bash -l
+#PBS -N ${jobname}
+#PBS -q ${queue}
+#PBS -l nodes=${nnodes}:ppn=${ppn}
+#PBS -l walltime=${walltime}${mem_request}
+#PBS -m $email_updates
+#PBS -M $email_addr
+${live_logs_directive}
+
+now() { echo "$${EPOCHREALTIME:-$$(date +%s.%N)}"; }
+job_started=$$(now)
+
+echo ---
+echo script name: $job_name
+echo loading modules: $modules
+$load_modules
+modules_loaded=$$(now)
+
+echo activating ${env_type} environment: $env_name
+$activate_env
+activated=$$(now)
+
+echo calling job script
+python3 $instrument_script run --job-name $job_name --started $$job_started \\
+    --modules-loaded $$modules_loaded --activated $$activated \\
+    -- $cmd_wrapper $job_command
+exit_status=$$?
+echo exit status: $$exit_status
+echo job script finished
+$deactivate_env
+echo ---
+exit $$exit_status"""
+)
+
+
+INSTRUMENTED_ARRAY_JOBSCRIPT_TEMPLATE = Template(
+"""#!/bin/bash -l
+#PBS -N ${jobname}
+#PBS -q ${queue}
+#PBS -l nodes=${nnodes}:ppn=${ppn}
+#PBS -l walltime=${walltime}${mem_request}
+#PBS -t ${array_range}
+#PBS -m $email_updates
+#PBS -M $email_addr
+${live_logs_directive}
+
+now() { echo "$${EPOCHREALTIME:-$$(date +%s.%N)}"; }
+job_started=$$(now)
+
+IFS=$$'\\t' read -r job_name job_command < <(sed -n "$$((PBS_ARRAYID + 1))p" $manifest_path)
+
+echo ---
+echo script name: $$job_name
+echo array index: $$PBS_ARRAYID
+echo loading modules: $modules
+$load_modules
+modules_loaded=$$(now)
+
+echo activating ${env_type} environment: $env_name
+$activate_env
+activated=$$(now)
+
+echo calling job script
+eval "python3 $instrument_script run --job-name $$job_name \\
+    --started $$job_started --modules-loaded $$modules_loaded \\
+    --activated $$activated -- $cmd_wrapper $$job_command"
+exit_status=$$?
+echo exit status: $$exit_status
+echo job script finished
+$deactivate_env
+echo ---
+exit $$exit_status"""
+)
+
+
+# used when config['bundle_mode'] is enabled: each script runs a chunk of jobs
+# (listed in a manifest file) on a pool of ${ppn} workers, so the modules and
+# environment are only loaded once per chunk.  bundle_runner.py prints the
+# usual "script name:" / "job script finished" markers for each job
+BUNDLE_JOBSCRIPT_TEMPLATE = Template(
+"""#!/bin/bash -l
+#PBS -N ${jobname}
+#PBS -q ${queue}
+#PBS -l nodes=${nnodes}:ppn=${ppn}
+#PBS -l walltime=${walltime}${mem_request}
+#PBS -m $email_updates
+#PBS -M $email_addr
+${live_logs_directive}
+
+echo ---
+echo bundle name: $bundle_name
+echo loading modules: $modules
+$load_modules
+
+echo activating ${env_type} environment: $env_name
+$activate_env
+
+echo running $n_tasks jobs on $ppn workers
+python $bundle_runner $manifest_path --workers $ppn --cmd-wrapper "$cmd_wrapper" $bundle_options
+exit_status=$$?
+echo bundle finished
+$deactivate_env
+echo ---
+exit $$exit_status"""
+)
+
+
+class CompiledTemplate:
+    """
+    a Template with everything but a few per-job fields filled in ahead of
+    time, so writing many scripts from it only joins strings rather than
+    re-parsing the template for each one
+    :param template: (Template) the template to compile
+    :param values: (dict-like) values for every placeholder but fields
+    :param fields: (iterable) names of the placeholders filled in by render()
+    """
+    def __init__(self, template, values, fields):
+        fields = set(fields)
+        self.literals = []
+        self.fields = []
+        text = template.template
+        start = 0
+        for match in template.pattern.finditer(text):
+            name = match.group('named') or match.group('braced')
+            if name in fields:
+                segment = Template(text[start:match.start()])
+                self.literals.append(segment.substitute(values))
+                self.fields.append(name)
+                start = match.end()
+        self.literals.append(Template(text[start:]).substitute(values))
+
+    def render(self, **field_values):
+        parts = [self.literals[0]]
+        for name, literal in zip(self.fields, self.literals[1:]):
+            parts.append(str(field_values[name]))
+            parts.append(literal)
+        return ''.join(parts)
+
+
+def walltime_to_seconds(walltime):
+    """
+    converts a PBS walltime string ([[DD:]HH:]MM:SS) to a number of seconds
+    """
+    seconds = 0
+    for unit, value in zip((1, 60, 3600, 86400),
+                           reversed(walltime.strip().split(':'))):
+        seconds += unit * int(value)
+    return seconds
+
+
+class ScriptTemplate:
+    def __init__(self, template, config):
+        self.config = config
+        self.config['instrument_script'] = instrument_script
+        if self.config['env_snapshot']:
+            # restore the environment captured by env_snapshot.py rather than
+            # loading modules & activating it in every job (unless the
+            # snapshot can't be read, e.g. it's been removed)
+            self.config['load_modules'] = (
+                f"source {self.config['env_snapshot']} || "
+                f"{{ module load {self.config['modules']}; "
+                f"{self.config['activate_cmd']} {self.config['env_name']}; }}"
+            )
+            self.config['activate_env'] = ':'
+            self.config['deactivate_env'] = ':'
+        else:
+            self.config['load_modules'] = \
+                f"module load {self.config['modules']}"
+            self.config['activate_env'] = \
+                f"{self.config['activate_cmd']} {self.config['env_name']}"
+            self.config['deactivate_env'] = self.config['deactivate_cmd']
+        # memory is only requested if set (otherwise the queue's default)
+        self.config['mem_request'] = ''
+        if self.config['mem']:
+            self.config['mem_request'] = f",mem={self.config['mem']}"
+        self.config['live_logs_directive'] = ''
+        if as_bool(self.config['live_logs']):
+            self.config['live_logs_directive'] = '#PBS -k oed'
+        # config values are filled in once; only job names & commands differ
+        # between scripts
+        self.template = CompiledTemplate(template, self.config,
+                                         ('job_name', 'job_command'))
+        self.scriptdir = self.config['scriptdir']
+        # array & bundle manifests/scripts are kept apart from per-job scripts
+        self.batchdir = opj(self.scriptdir, 'batches')
+        self.username = os.environ.get('LOGNAME') or getpass.getuser()
+        # record of all jobs written/submitted so far (see ledger.py)
+        self.ledger = JobLedger(
+            ledger_path(self.config['workingdir'], self.config['jobname'])
+        )
+
+        # set submission command
+        if self.username.startswith('f00'):
+            self.submit_cmd = 'mksub'
+        else:
+            self.submit_cmd = 'qsub'
+
+        # run jobs on this machine if there's no scheduler to submit them to
+        self.local_backend = None
+        if not pbs_available(self.submit_cmd):
+            self.local_backend = LocalBackend(self.config['workingdir'])
+
+        # keep at most max_queued jobs in the queue at once (see feeder.py)
+        self.feeder = None
+        if self.config['max_queued'] and self.local_backend is None:
+            self.feeder = Feeder(self.config['max_queued'],
+                                 owner=self.username,
+                                 poll_interval=self.config['queue_poll_interval'])
+
+        # create directories if they don't already exist
+        try:
+            os.stat(self.scriptdir)
+        except FileNotFoundError:
+            os.mkdir(self.scriptdir)
+        try:
+            os.stat(self.batchdir)
+        except FileNotFoundError:
+            os.mkdir(self.batchdir)
+
+    def lock(self, job_name, job_command):
+        """
+        adds a job to the ledger, returning True if it was already there
+        """
+        return self.ledger.claim(job_name, job_command)
+
+    def release_locks(self):
+        # writes any pending changes to the ledger
+        self.ledger.close()
+        if self.local_backend is not None:
+            print("waiting for jobs running locally to finish...")
+            self.local_backend.shutdown()
+
+    def submit_job(self, jobscript_path, options=(), n_jobs=1):
+        """
+        submits a job script & returns its jobid.  n_jobs is the number of
+        jobs the submission adds to the queue (i.e., an array's size), used
+        to wait for room in the queue if max_queued is set
+        """
+        print(f"[SUBMITTING JOB: {jobscript_path} ]")
+        if self.local_backend is not None:
+            jobid = self.local_backend.submit(jobscript_path, options)
+            print(jobid)
+            return jobid
+
+        if self.feeder is not None:
+            self.feeder.acquire(n_jobs)
+        while True:
+            result = run([self.submit_cmd, *options, jobscript_path],
+                         stdout=PIPE, stderr=PIPE, universal_newlines=True)
+            if (result.returncode == 0 or self.feeder is None
+                    or not QUEUE_LIMIT_ERROR.search(result.stderr)):
+                break
+            # the queue is full: wait for some jobs to finish & try again
+            if not self.feeder.rejected():
+                break
+            self.feeder.acquire(n_jobs)
+        # qsub/mksub print the new job's id
+        jobid = result.stdout.strip()
+        if self.feeder is not None and result.returncode == 0:
+            self.feeder.submitted(n_jobs)
+        try:
+            if result.stderr:
+                print(result.stderr.strip())
+            print(jobid)
+        except BrokenPipeError:
+            # the job was submitted, so its jobid must still be recorded if
+            # submit.py's output has been cut off (e.g., the connection
+            # streaming it dropped)
+            pass
+        return jobid
+
+    def submit_jobs(self, jobs, array_template=None, bundle_template=None,
+                    options=()):
+        """
+        writes & submits (job name, job command) pairs: as a single job array
+        if array_template is given, in bundles if bundle_template is given,
+        and otherwise one script per job (jobs whose scripts already exist
+        are skipped), recording each submission in the ledger.  jobs may be a
+        generator.  options are passed to qsub/mksub for every submission.
+        Returns the jobids of the submissions
+        """
+        jobids = []
+
+        def _record(job_names, jobid, script_paths, array_indices=None):
+            # a failed submission has no jobid: its jobs are left "written",
+            # so the next run of submit.py submits them again
+            if jobid:
+                self.ledger.record_submission(job_names, jobid, script_paths,
+                                              array_indices=array_indices)
+
+        def _submitted(jobid, job_names):
+            print(SUBMISSION_PREFIX + json.dumps({'jobid': jobid or None,
+                                                  'job_names': job_names}),
+                  flush=True)
+            jobids.append(jobid)
+
+        if array_template is not None:
+            # the whole set of jobs is one scheduler transaction
+            array_filepath, array_names = self.write_array_scriptfile(
+                array_template, jobs
+            )
+            if array_names:
+                jobid = self.submit_job(array_filepath, options,
+                                        n_jobs=len(array_names))
+                _record(array_names, jobid,
+                        [array_filepath] * len(array_names),
+                        array_indices=range(len(array_names)))
+                _submitted(jobid, array_names)
+        elif bundle_template is not None:
+            # individual job scripts are still written (but not submitted) so
+            # that failed jobs can be resubmitted on their own by
+            # resubmit_failed.py
+            written_jobs = ((job_n, job_c) for job_n, job_c in jobs
+                            if self.write_scriptfile(job_n, job_c))
+            for bundle_filepath, chunk_names in self.write_bundle_scriptfiles(
+                    bundle_template, written_jobs
+            ):
+                jobid = self.submit_job(bundle_filepath, options)
+                _record(chunk_names, jobid,
+                        [opj(self.scriptdir, n) for n in chunk_names])
+                _submitted(jobid, chunk_names)
+        else:
+            # a few submissions are kept in flight at once, so each one's
+            # round trip to the scheduler overlaps the next script being
+            # written & submitted (one at a time if jobs are fed into the
+            # queue or run locally)
+            n_parallel = 1
+            if self.feeder is None and self.local_backend is None:
+                n_parallel = max(1, int(self.config['submit_parallel'] or 1))
+            in_flight = deque()
+
+            def _record_oldest():
+                job_n, script_filepath, future = in_flight.popleft()
+                jobid = future.result()
+                _record([job_n], jobid, [script_filepath])
+                _submitted(jobid, [job_n])
+
+            with ThreadPoolExecutor(max_workers=n_parallel) as pool:
+                try:
+                    for job_n, job_c in jobs:
+                        script_filepath = self.write_scriptfile(job_n, job_c)
+                        if script_filepath:
+                            in_flight.append((job_n, script_filepath,
+                                              pool.submit(self.submit_job,
+                                                          script_filepath,
+                                                          options)))
+                            if len(in_flight) > n_parallel:
+                                _record_oldest()
+                    while in_flight:
+                        _record_oldest()
+                finally:
+                    # if writing or submitting a job failed (or submit.py was
+                    # interrupted), the submissions that went through are
+                    # still recorded
+                    for job_n, script_filepath, future in in_flight:
+                        if future.exception() is None:
+                            _record([job_n], future.result(),
+                                    [script_filepath])
+        # (failed submissions have no jobid)
+        return [jobid for jobid in jobids if jobid]
+
+    def write_scriptfile(self, job_name, job_command):
+        filepath = opj(self.scriptdir, job_name)
+        try:
+            os.stat(filepath)
+            return
+        except FileNotFoundError:
+            script_content = self.template.render(job_name=job_name,
+                                                  job_command=job_command)
+            with open(filepath, 'w+') as f:
+                f.write(script_content)
+            return filepath
+
+    def write_array_scriptfile(self, array_template, jobs):
+        """
+        writes a single job array script covering the given (job name, job
+        command) pairs, along with the manifest its tasks read their job name
+        & command from.  jobs may be a generator; it's consumed as the
+        manifest is written.  Returns the script's path & the job names
+        (or (None, []) if there were no jobs)
+        """
+        # number arrays after any written by a previous submission
+        array_ix = len([f for f in os.listdir(self.batchdir)
+                        if f.startswith(f"{self.config['jobname']}_array")
+                        and f.endswith('.sh')])
+        array_name = f"{self.config['jobname']}_array{array_ix}"
+        filepath = opj(self.batchdir, f'{array_name}.sh')
+        manifest_path = opj(self.batchdir, f'{array_name}.tsv')
+        job_names = self.write_manifest(manifest_path, jobs)
+        if not job_names:
+            os.remove(manifest_path)
+            return None, job_names
+
+        array_range = f'0-{len(job_names) - 1}'
+        slot_limit = self.config['array_slot_limit']
+        if slot_limit:
+            array_range = f'{array_range}%{slot_limit}'
+
+        template_vals = self.config
+        template_vals['array_range'] = array_range
+        template_vals['manifest_path'] = manifest_path
+        script_content = array_template.substitute(template_vals)
+        with open(filepath, 'w+') as f:
+            f.write(script_content)
+        return filepath, job_names
+
+    def write_bundle_scriptfiles(self, bundle_template, jobs):
+        """
+        splits (job name, job command) pairs into bundles sized so that each
+        bundle keeps all ppn cores busy for (at most) the requested walltime,
+        given the estimated time per job in config['bundle_task_time'].
+        Writes a script & a manifest for each bundle, yielding (script path,
+        job names) as soon as each bundle is full so it can be submitted
+        while later jobs are still being generated
+        """
+        ppn = int(self.config['ppn'])
+        task_seconds = walltime_to_seconds(self.config['bundle_task_time'])
+        wall_seconds = walltime_to_seconds(self.config['walltime'])
+        bundle_size = ppn * max(1, wall_seconds // max(1, task_seconds))
+
+        # number bundles after any written by a previous submission
+        bundle_ix = len([f for f in os.listdir(self.batchdir)
+                         if f.startswith(f"{self.config['jobname']}_bundle")
+                         and f.endswith('.sh')])
+
+        self.config['bundle_runner'] = bundle_runner
+        compiled = CompiledTemplate(bundle_template, self.config,
+                                    ('bundle_name', 'manifest_path', 'n_tasks'))
+        jobs = iter(jobs)
+        while True:
+            bundle_name = f"{self.config['jobname']}_bundle{bundle_ix}"
+            filepath = opj(self.batchdir, f'{bundle_name}.sh')
+            manifest_path = opj(self.batchdir, f'{bundle_name}.tsv')
+            chunk_names = self.write_manifest(manifest_path,
+                                              islice(jobs, bundle_size))
+            if not chunk_names:
+                os.remove(manifest_path)
+                return
+
+            script_content = compiled.render(bundle_name=bundle_name,
+                                             manifest_path=manifest_path,
+                                             n_tasks=len(chunk_names))
+            with open(filepath, 'w+') as f:
+                f.write(script_content)
+            yield filepath, chunk_names
+            bundle_ix += 1
+
+    @staticmethod
+    def write_manifest(manifest_path, jobs):
+        """
+        writes a tab-separated "<job name>\t<job command>" line for each
+        (job name, job command) pair (read by job array tasks &
+        bundle_runner.py) and returns the job names
+        """
+        job_names = []
+        with open(manifest_path, 'w+') as f:
+            for job_name, job_command in jobs:
+                assert '\t' not in job_name + job_command \
+                    and '\n' not in job_name + job_command, \
+                    f"job names & commands can't contain tabs or newlines\
+                     in array or bundle mode ({job_name})"
+                f.write(f'{job_name}\t{job_command}\n')
+                job_names.append(job_name)
+        return job_names
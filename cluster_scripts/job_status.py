@@ -0,0 +1,145 @@
+#!/usr/bin/python
+
+# parses the output of qstat into structured job status records.  Used on the
+# cluster (by ledger.py) as well as locally (by _helpers.get_job_statuses)
+import re
+import shutil
+import sys
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+from subprocess import run, PIPE
+
+# walltime_used & cput_used are in seconds and mem_used in bytes (None if not
+# yet reported).  exit_status is reported by PBS once the job has completed
+JobStatus = namedtuple(
+    'JobStatus',
+    ['jobid', 'array_index', 'name', 'owner', 'state', 'walltime_used',
+     'mem_used', 'exec_host', 'cput_used', 'exit_status']
+)
+
+MEM_UNITS = {'b': 1, 'kb': 1 << 10, 'mb': 1 << 20, 'gb': 1 << 30,
+             'tb': 1 << 40}
+
+# reported by qstat for jobs that left the queue between qselect & qstat
+UNKNOWN_JOB_ERROR = re.compile(r'Unknown Job Id', re.IGNORECASE)
+
+
+def _array_index(jobid):
+    match = re.search(r'\[(\d+)\]', jobid)
+    return int(match.group(1)) if match else None
+
+
+def parse_walltime(walltime):
+    if not walltime:
+        return None
+    seconds = 0
+    for part in walltime.split(':'):
+        seconds = seconds * 60 + int(part)
+    return seconds
+
+
+def parse_mem(mem):
+    if not mem:
+        return None
+    match = re.fullmatch(r'(\d+)([kmgt]?b)', mem.strip().lower())
+    if match is None:
+        return None
+    return int(match.group(1)) * MEM_UNITS[match.group(2)]
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _make_status(jobid, fields):
+    return JobStatus(
+        jobid=jobid,
+        array_index=_array_index(jobid),
+        name=fields.get('Job_Name'),
+        # Job_Owner takes the form "<user>@<submission host>"
+        owner=(fields.get('Job_Owner') or '').split('@')[0] or None,
+        state=fields.get('job_state'),
+        walltime_used=parse_walltime(fields.get('resources_used.walltime')),
+        mem_used=parse_mem(fields.get('resources_used.mem')),
+        exec_host=fields.get('exec_host'),
+        cput_used=parse_walltime(fields.get('resources_used.cput')),
+        exit_status=_int(fields.get('exit_status'))
+    )
+
+
+def parse_qstat_xml(qstat_output):
+    """
+    parses the output of "qstat -x" (possibly the concatenated output of
+    several calls) into a list of JobStatus records
+    """
+    # drop XML declarations so multiple documents can be wrapped in one root
+    body = re.sub(r'<\?xml[^>]*\?>', '', qstat_output)
+    root = ET.fromstring(f'<qstat>{body}</qstat>')
+    statuses = []
+    for job in root.iter('Job'):
+        fields = {}
+        for child in job:
+            if len(child):
+                # nested resources, e.g. <resources_used><mem>...</mem>
+                for grandchild in child:
+                    fields[f'{child.tag}.{grandchild.tag}'] = grandchild.text
+            else:
+                fields[child.tag] = child.text
+        statuses.append(_make_status(fields.get('Job_Id'), fields))
+    return statuses
+
+
+def qstat_command(owner=None, job_name=None):
+    """
+    returns a shell command that prints "qstat -x" output for (only) the jobs
+    with the given owner and/or name, so that filtering happens on the
+    cluster.  Array jobs are expanded into their individual tasks
+    """
+    if owner is None and job_name is None:
+        return 'qstat -x -t'
+    select_cmd = 'qselect'
+    if owner is not None:
+        select_cmd += f' -u {owner}'
+    if job_name is not None:
+        select_cmd += f' -N {job_name}'
+    # a failed qselect (e.g., the server is unreachable) mustn't look like an
+    # empty queue, so its exit status is passed on (see qstat_failed)
+    return (f'ids=$({select_cmd}) || exit; '
+            f'if [ -n "$ids" ]; then qstat -x -t $ids; fi')
+
+
+def qstat_failed(returncode, stderr):
+    """
+    returns True if the command from qstat_command failed to query the
+    scheduler.  qstat also exits with an error when jobs finish between
+    qselect & qstat, but it still reports the others, so that isn't a failure
+    """
+    if returncode == 0:
+        return False
+    errors = [line for line in stderr.splitlines() if line.strip()]
+    return not errors or not all(UNKNOWN_JOB_ERROR.search(line)
+                                 for line in errors)
+
+
+def query_jobs(owner=None, job_name=None):
+    """
+    runs qstat on the cluster and returns a list of JobStatus records for
+    jobs with the given owner and/or name.  Returns an empty list if qstat
+    isn't available (i.e., not running on a PBS cluster) and None if the
+    scheduler couldn't be queried (e.g., pbs_server is down or overloaded),
+    which callers mustn't mistake for an empty queue
+    """
+    if shutil.which('qstat') is None:
+        return []
+    result = run(['bash', '-c', qstat_command(owner, job_name)],
+                 stdout=PIPE, stderr=PIPE, universal_newlines=True)
+    if qstat_failed(result.returncode, result.stderr):
+        print(f"failed to query the scheduler: {result.stderr.strip()}",
+              file=sys.stderr)
+        return None
+    if not result.stdout.strip():
+        return []
+    return parse_qstat_xml(result.stdout)
@@ -0,0 +1,471 @@
+#!/usr/bin/python
+
+# persistent record of every job submitted for a project, kept in a single
+# SQLite database in the working directory.  Replaces the per-job lockfiles
+# previously written by submit.py, and lets the local tools check on (and
+# update) the state of every job with a single remote command:
+#   python3 ledger.py <ledger path> status [--sync <workingdir> <job name>]
+#   python3 ledger.py <ledger path> record <job name>=<jobid>[:<array index>] ...
+# "status" prints one tab-separated line per job:
+#   <job name>  <jobid>  <array index>  <state>  <exit status>  <attempts>
+#   <script path>  <stdout id (suffix of the job's {job name}.o<id> file)>
+#   <failure class>  <failure reason>
+import getpass
+import hashlib
+import json
+import re
+import sqlite3
+import sys
+from argparse import ArgumentParser
+from collections import Counter
+from datetime import datetime as dt
+from os.path import isfile, join as opj
+
+try:
+    from .classify_failures import classify, job_section, read_tail
+    from .job_status import parse_mem, parse_walltime, query_jobs
+    from .scan_outputs import parse_stdout
+except ImportError:
+    # run as a script on the cluster
+    from classify_failures import classify, job_section, read_tail
+    from job_status import parse_mem, parse_walltime, query_jobs
+    from scan_outputs import parse_stdout
+
+# written: script created but not (yet) submitted
+# submitted: in the queue, or no longer in the queue & output not yet checked
+# running: reported as running by qstat
+# finished: stdout shows the job ran to completion & exited with status 0
+# failed: no longer in the queue, but didn't finish (or exited with an error)
+STATES = ('written', 'submitted', 'running', 'finished', 'failed')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_name TEXT PRIMARY KEY,
+    command_hash TEXT,
+    script_path TEXT,
+    jobid TEXT,
+    array_index INTEGER,
+    submit_time TEXT,
+    state TEXT NOT NULL DEFAULT 'written',
+    exit_status INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    walltime_used INTEGER,
+    mem_used INTEGER,
+    cput_used INTEGER,
+    killed_by TEXT,
+    killed_limit INTEGER,
+    pbs_exit_status INTEGER,
+    failure_class TEXT,
+    failure_reason TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+CREATE INDEX IF NOT EXISTS jobs_jobid ON jobs (jobid);
+"""
+
+
+# resources used by each (non-bundled) job, as reported by qstat once it has
+# completed (or by its instrumentation record, if qstat no longer lists it),
+# and the resource limit it was killed for exceeding, if any (added after the
+# ledger's first version, so older ledgers are upgraded when opened)
+USAGE_COLUMNS = (('walltime_used', 'INTEGER'), ('mem_used', 'INTEGER'),
+                 ('cput_used', 'INTEGER'), ('killed_by', 'TEXT'),
+                 ('killed_limit', 'INTEGER'))
+# the exit status PBS reported for each job, and the class of & reason for
+# each failed job's failure (see classify_failures.py)
+FAILURE_COLUMNS = (('pbs_exit_status', 'INTEGER'), ('failure_class', 'TEXT'),
+                   ('failure_reason', 'TEXT'))
+
+# starts the line instrument.py prints to an instrumented job's stdout, with
+# the resources its command used (see instrument.py)
+INSTRUMENT_PREFIX = 'instrumentation: '
+
+# written to a job's stderr file by PBS when it exceeds a resource limit, e.g.
+# "=>> PBS: job killed: walltime 3630 exceeded limit 3600"
+KILLED_PATTERN = re.compile(
+    r'PBS: job killed: (\w+) (\S+) exceeded limit (\S+)'
+)
+
+
+def ledger_path(workingdir, job_name):
+    return opj(workingdir, f'{job_name}_ledger.db')
+
+
+def stdout_id(jobid, array_index=None):
+    """
+    returns the suffix of a job's stdout file name ({job name}.o<suffix>)
+    given its full PBS jobid (e.g., "12345.server" -> "12345", or
+    "12345[].server" or "12345[7].server" with array index 7 -> "12345-7")
+    """
+    base = jobid.split('.')[0]
+    if array_index is None:
+        return base
+    return f"{base.split('[')[0]}-{array_index}"
+
+
+def get_queued_jobs(statuses=None):
+    """
+    runs qstat on the cluster (unless statuses, a list of JobStatus records,
+    is given) and returns a dict mapping stdout ids (see stdout_id) of the
+    current user's jobs that haven't completed to their state code, or None
+    if the scheduler couldn't be queried
+    """
+    if statuses is None:
+        # filtered by owner only: tasks of a job array may be named
+        # differently from the array itself
+        statuses = query_jobs(owner=getpass.getuser())
+        if statuses is None:
+            return None
+    queued = {}
+    for status in statuses:
+        if status.state != 'C':
+            out_id = stdout_id(status.jobid, status.array_index)
+            queued[out_id] = status.state
+    return queued
+
+
+def parse_killed(stderr_path):
+    """
+    returns (resource, limit) if a job's stderr file shows it was killed for
+    exceeding a resource limit (limit in seconds for walltime & cput, bytes
+    for mem & vmem), otherwise None
+    """
+    if not isfile(stderr_path):
+        return None
+    with open(stderr_path, 'r', errors='replace') as f:
+        match = KILLED_PATTERN.search(f.read())
+    if match is None:
+        return None
+    resource, limit = match.group(1), match.group(3)
+    if resource in ('walltime', 'cput'):
+        # e.g. "3600" or "01:00:00"
+        return resource, parse_walltime(limit)
+    return resource, parse_mem(limit)
+
+
+def parse_instrumented(stdout_path):
+    """
+    returns (walltime used, mem used, cput used) from the last
+    instrumentation record in a job's stdout file (see instrument.py), or
+    None if there isn't one
+    """
+    record = None
+    with open(stdout_path, 'r', errors='replace') as f:
+        for line in f:
+            if line.startswith(INSTRUMENT_PREFIX):
+                try:
+                    record = json.loads(line[len(INSTRUMENT_PREFIX):])
+                except ValueError:
+                    # cut off by the job being killed
+                    continue
+    if record is None:
+        return None
+    return (round(sum(record['phases'].values())), record['max_rss'],
+            round(record['user_time'] + record['sys_time']))
+
+
+class JobLedger:
+    """
+    Pending changes are buffered and written in a single transaction on
+    flush() (called automatically every `batch_size` changes and on close())
+    to keep the number of writes to the shared filesystem small
+    """
+    def __init__(self, path, batch_size=1000):
+        self.path = path
+        self.batch_size = batch_size
+        # generous timeout since the database may sit on a network filesystem
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.executescript(SCHEMA)
+        columns = {row[1] for row
+                   in self.conn.execute('PRAGMA table_info(jobs)')}
+        with self.conn:
+            for column, column_type in USAGE_COLUMNS + FAILURE_COLUMNS:
+                if column not in columns:
+                    self.conn.execute(
+                        f'ALTER TABLE jobs ADD COLUMN {column} {column_type}'
+                    )
+        self.known_jobs = {row[0] for row
+                           in self.conn.execute('SELECT job_name FROM jobs')}
+        self._new_jobs = []
+        self._submissions = []
+
+    def claim(self, job_name, job_command):
+        """
+        adds a job to the ledger.  Returns True if the job was already there
+        (i.e., it's been written/submitted before) and False otherwise
+        """
+        if job_name in self.known_jobs:
+            return True
+        command_hash = hashlib.md5(job_command.encode()).hexdigest()
+        self.known_jobs.add(job_name)
+        self._new_jobs.append((job_name, command_hash))
+        self._maybe_flush()
+        return False
+
+    def record_submission(self, job_names, jobid, script_paths=None,
+                          array_indices=None):
+        """
+        records that the given jobs were submitted (together, in the case of
+        a job array or bundle) under a PBS jobid.  script_paths are the
+        scripts to use to resubmit each job (array scripts for array tasks);
+        if omitted, the previously recorded scripts are kept
+        """
+        submit_time = dt.now().isoformat(timespec='seconds')
+        if script_paths is None:
+            script_paths = [None] * len(job_names)
+        if array_indices is None:
+            array_indices = [None] * len(job_names)
+        for job_name, script_path, array_ix in zip(job_names, script_paths,
+                                                   array_indices):
+            self._submissions.append(
+                (script_path, jobid, array_ix, submit_time, job_name)
+            )
+        self._maybe_flush()
+
+    def forget(self, job_names):
+        """
+        removes jobs from the ledger, so they're treated as new (e.g., when
+        their cached results are out of date)
+        """
+        job_names = [name for name in job_names if name in self.known_jobs]
+        if not job_names:
+            return
+        self.flush()
+        with self.conn:
+            self.conn.executemany('DELETE FROM jobs WHERE job_name = ?',
+                                  [(name,) for name in job_names])
+        self.known_jobs.difference_update(job_names)
+
+    def _maybe_flush(self):
+        if len(self._new_jobs) + len(self._submissions) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO jobs (job_name, command_hash) '
+                'VALUES (?, ?)',
+                self._new_jobs
+            )
+            self.conn.executemany(
+                "UPDATE jobs SET script_path = COALESCE(?, script_path), "
+                "jobid = ?, array_index = ?, submit_time = ?, "
+                "state = 'submitted', exit_status = NULL, "
+                "killed_by = NULL, killed_limit = NULL, "
+                "pbs_exit_status = NULL, failure_class = NULL, "
+                "failure_reason = NULL, "
+                "attempts = attempts + 1 WHERE job_name = ?",
+                self._submissions
+            )
+        self._new_jobs = []
+        self._submissions = []
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def jobs(self, states=None):
+        """
+        returns (job name, jobid, array index, state, exit status, attempts,
+        script path) rows for all jobs, optionally only those in the given
+        states
+        """
+        self.flush()
+        query = ('SELECT job_name, jobid, array_index, state, exit_status, '
+                 'attempts, script_path FROM jobs')
+        if states is not None:
+            query += f" WHERE state IN ({', '.join('?' * len(states))})"
+            return self.conn.execute(query, tuple(states)).fetchall()
+        return self.conn.execute(query).fetchall()
+
+    def usage(self):
+        """
+        returns (job name, state, walltime used, mem used, cput used, killed
+        by, killed limit) rows for all jobs (see USAGE_COLUMNS)
+        """
+        self.flush()
+        return self.conn.execute(
+            'SELECT job_name, state, walltime_used, mem_used, cput_used, '
+            'killed_by, killed_limit FROM jobs'
+        ).fetchall()
+
+    def failures(self):
+        """
+        returns a dict mapping the names of failed jobs to (failure class,
+        reason) tuples (see classify_failures.py)
+        """
+        self.flush()
+        return {name: (failure_class, reason) for name, failure_class, reason
+                in self.conn.execute(
+                    "SELECT job_name, failure_class, failure_reason FROM jobs "
+                    "WHERE state = 'failed'"
+                )}
+
+    def classify_failures(self, workingdir, job_name):
+        """
+        classifies every failed job that hasn't been classified yet, from the
+        ends of its output files, the resource limit it was killed for
+        exceeding & its PBS exit status
+        """
+        self.flush()
+        # jobs in the same bundle share a jobid & output files
+        n_sharing = Counter(self.conn.execute(
+            'SELECT jobid, array_index FROM jobs WHERE jobid IS NOT NULL'
+        ).fetchall())
+        unclassified = self.conn.execute(
+            "SELECT job_name, jobid, array_index, killed_by, pbs_exit_status "
+            "FROM jobs WHERE state = 'failed' AND failure_class IS NULL "
+            "AND jobid IS NOT NULL"
+        ).fetchall()
+
+        tails = {}
+        updates = []
+        for name, jobid, array_ix, killed_by, pbs_exit_status in unclassified:
+            out_id = stdout_id(jobid, array_ix)
+            if out_id not in tails:
+                tails[out_id] = (
+                    read_tail(opj(workingdir, f'{job_name}.e{out_id}')),
+                    read_tail(opj(workingdir, f'{job_name}.o{out_id}'))
+                )
+            stderr_text, stdout_text = tails[out_id]
+            if n_sharing[(jobid, array_ix)] > 1:
+                # other jobs' output in the bundle's stdout could be mistaken
+                # for this job's
+                stderr_text = job_section(stderr_text, name)
+                stdout_text = ''
+            failure_class, reason = classify(stderr_text, stdout_text,
+                                             killed_by, pbs_exit_status)
+            # (stored in tab-separated output; see "status" below)
+            reason = ' '.join(reason.split())
+            updates.append((failure_class, reason, name))
+
+        with self.conn:
+            self.conn.executemany(
+                'UPDATE jobs SET failure_class = ?, failure_reason = ? '
+                'WHERE job_name = ?',
+                updates
+            )
+
+    def sync(self, workingdir, job_name, statuses=None):
+        """
+        updates the state of every job that's been submitted but hasn't
+        finished or failed.  Only the stdout files of those jobs (and the
+        stderr files of failed jobs) are read (their names are derived from
+        the recorded jobids, so the working directory isn't listed).  The
+        resources used by each job are recorded once it has completed (from
+        qstat or, if qstat no longer reports it, its instrumentation record),
+        and newly failed jobs are classified (see classify_failures).  If the
+        scheduler can't be queried, nothing is updated: jobs still in the
+        queue would otherwise be marked failed
+        """
+        if statuses is None:
+            statuses = query_jobs(owner=getpass.getuser())
+            if statuses is None:
+                return
+        queued = get_queued_jobs(statuses)
+        # completed jobs stay in qstat's output for a while, with their
+        # final resources_used (running jobs' usage so far would understate
+        # what they need)
+        used = {stdout_id(status.jobid, status.array_index): status
+                for status in statuses
+                if status.state == 'C' and status.walltime_used is not None}
+
+        by_stdout = {}
+        for name, jobid, array_ix, *_ in self.jobs(states=('submitted',
+                                                             'running')):
+            by_stdout.setdefault(stdout_id(jobid, array_ix), []).append(name)
+
+        updates = []
+        usage_updates = []
+        kills = []
+        for out_id, job_names in by_stdout.items():
+            stdout_path = opj(workingdir, f'{job_name}.o{out_id}')
+            # a bundle's usage isn't any one of its jobs' usage
+            if out_id in used and len(job_names) == 1:
+                status = used[out_id]
+                usage_updates.append((status.walltime_used, status.mem_used,
+                                      status.cput_used, status.exit_status,
+                                      job_names[0]))
+            if out_id in queued:
+                # (with live_logs, a running job's output is already in the
+                # working dir; otherwise it's only copied there on completion)
+                state = 'running' if queued[out_id] == 'R' else 'submitted'
+                updates.extend((state, None, name) for name in job_names)
+            elif isfile(stdout_path):
+                sections = {name: (finished, exit_status) for
+                            name, finished, exit_status
+                            in parse_stdout(stdout_path)}
+                failed = []
+                for name in job_names:
+                    finished, exit_status = sections.get(name, (False, None))
+                    # job scripts report finishing whatever their command's
+                    # exit status
+                    if finished and exit_status in (0, None):
+                        state = 'finished'
+                    else:
+                        state = 'failed'
+                        failed.append(name)
+                    updates.append((state, exit_status, name))
+                if out_id not in used and len(job_names) == 1:
+                    instrumented = parse_instrumented(stdout_path)
+                    if instrumented is not None:
+                        usage_updates.append((*instrumented, None,
+                                              job_names[0]))
+                if failed:
+                    killed = parse_killed(opj(workingdir,
+                                              f'{job_name}.e{out_id}'))
+                    if killed is not None:
+                        kills.extend((*killed, name) for name in failed)
+            else:
+                updates.extend(('failed', None, name) for name in job_names)
+
+        with self.conn:
+            self.conn.executemany(
+                'UPDATE jobs SET state = ?, exit_status = ? WHERE job_name = ?',
+                updates
+            )
+            self.conn.executemany(
+                'UPDATE jobs SET walltime_used = ?, mem_used = ?, '
+                'cput_used = ?, pbs_exit_status = ? WHERE job_name = ?',
+                usage_updates
+            )
+            self.conn.executemany(
+                'UPDATE jobs SET killed_by = ?, killed_limit = ? '
+                'WHERE job_name = ?',
+                kills
+            )
+        self.classify_failures(workingdir, job_name)
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser(description="Query or update the job ledger")
+    arg_parser.add_argument("ledger_path", type=str)
+    subparsers = arg_parser.add_subparsers(dest='action')
+    status_parser = subparsers.add_parser('status')
+    status_parser.add_argument("--sync", nargs=2, default=None,
+                               metavar=('WORKINGDIR', 'JOB_NAME'))
+    record_parser = subparsers.add_parser('record')
+    record_parser.add_argument("submissions", nargs='+',
+                               help="<job name>=<jobid>[:<array index>]")
+    args = arg_parser.parse_args()
+
+    ledger = JobLedger(args.ledger_path)
+    if args.action == 'record':
+        for submission in args.submissions:
+            job_name, jobid = submission.split('=', 1)
+            array_ix = None
+            if ':' in jobid:
+                jobid, array_ix = jobid.split(':')
+                array_ix = int(array_ix)
+            ledger.record_submission([job_name], jobid,
+                                     array_indices=[array_ix])
+    else:
+        if args.sync is not None:
+            ledger.sync(*args.sync)
+        failures = ledger.failures()
+        for row in ledger.jobs():
+            jobid, array_ix = row[1], row[2]
+            fields = [*row, stdout_id(jobid, array_ix) if jobid else None,
+                      *failures.get(row[0], (None, None))]
+            sys.stdout.write('\t'.join('' if f is None else str(f)
+                                       for f in fields) + '\n')
+    ledger.close()
@@ -0,0 +1,278 @@
+#!/usr/bin/python
+
+# runs generated job scripts on the local machine when no PBS scheduler is
+# available (e.g., on a workstation or CI box), in place of qsub/mksub.
+# Scripts run in parallel on the machine's cores, with each job reserving the
+# number of cores it requests (#PBS -l nodes=N:ppn=P), and their output is
+# written to {jobname}.o<id> & {jobname}.e<id> files in the working directory
+# (just as PBS would), so scan_outputs.py, ledger.py, and resubmit_failed.py
+# work unchanged.  Jobs that run past their walltime are killed.  Jobs that
+# depend on others (-W depend=..., see pipeline.py) wait for them to finish,
+# and are dropped if the dependency can't be satisfied (as PBS deletes them).
+import fcntl
+import os
+import re
+import shutil
+import signal
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from os.path import join as opj
+from subprocess import Popen, TimeoutExpired
+
+# suffix of local jobids, in place of the PBS server name
+LOCAL_SERVER = 'local'
+
+
+def pbs_available(submit_cmd='qsub'):
+    """returns True if the given submission command is on the PATH"""
+    return shutil.which(submit_cmd) is not None
+
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # not available on MacOS
+        return os.cpu_count() or 1
+
+
+def parse_directives(script_path):
+    """
+    reads a job script's #PBS directives into a dict mapping options (e.g.,
+    "N", "l", "t") to values.  Resource requests (-l) are split into their
+    own keys (e.g., "ppn", "walltime")
+    """
+    directives = {}
+    with open(script_path, 'r') as f:
+        for line in f:
+            match = re.match(r'#PBS\s+-(\w)\s*(.*)', line)
+            if match is None:
+                continue
+            option, value = match.group(1), match.group(2).strip()
+            if option == 'l':
+                for resource in value.split(','):
+                    key, _, val = resource.partition('=')
+                    if key == 'nodes':
+                        # e.g., nodes=1:ppn=4
+                        val, *properties = val.split(':')
+                        for prop in properties:
+                            prop_key, _, prop_val = prop.partition('=')
+                            directives[prop_key] = prop_val
+                    directives[key] = val
+            else:
+                directives[option] = value
+    return directives
+
+
+def parse_array_range(array_range):
+    """
+    expands a job array range (e.g., "0-9", "1,3,5-7%2") into a list of
+    indices and a slot limit (None if not set)
+    """
+    array_range, _, slot_limit = array_range.partition('%')
+    indices = []
+    for part in array_range.split(','):
+        start, _, end = part.partition('-')
+        indices.extend(range(int(start), int(end or start) + 1))
+    return indices, int(slot_limit) if slot_limit else None
+
+
+def parse_depend(depend):
+    """
+    parses the value of qsub's -W option (e.g.,
+    "depend=afterok:12.local:13.local,afteranyarray:14[].local") into a list
+    of (dependency type, jobid) pairs.  "<type>array" types are treated as
+    <type>, since an array's jobid refers to all of its tasks
+    """
+    dependencies = []
+    for attribute in depend.split(','):
+        if attribute.startswith('depend='):
+            attribute = attribute[len('depend='):]
+        depend_type, *jobids = attribute.split(':')
+        if depend_type.endswith('array'):
+            depend_type = depend_type[:-len('array')]
+        dependencies.extend((depend_type, jobid) for jobid in jobids)
+    return dependencies
+
+
+def _walltime_seconds(walltime):
+    if not walltime:
+        return None
+    seconds = 0
+    for part in walltime.split(':'):
+        seconds = seconds * 60 + int(part)
+    return seconds
+
+
+class LocalBackend:
+    """
+    Stands in for the PBS scheduler: submit() queues a job script to run
+    locally and returns a PBS-style jobid (e.g., "12.local", or "12[].local"
+    for a job array) right away.  Call wait() to block until every submitted
+    job has finished.
+    :param workingdir: (str) directory jobs run in & write their output to
+    :param n_cores: (int, optional) number of cores to run jobs on (default:
+                    all available)
+    """
+    def __init__(self, workingdir, n_cores=None):
+        self.workingdir = workingdir
+        self.n_cores = n_cores or available_cores()
+        self._free_cores = self.n_cores
+        self._cores_freed = threading.Condition()
+        # every job needs at least 1 core, so no more can run at once
+        self._pool = ThreadPoolExecutor(max_workers=self.n_cores)
+        self._futures = []
+        # futures of each submitted job (or array task) by jobid; an array's
+        # jobid maps to all of its tasks' futures
+        self._jobs = {}
+
+    def _next_job_number(self):
+        # shared by every process that submits jobs from this workingdir, so
+        # ids (and output file names) are never reused
+        counter_path = opj(self.workingdir, '.local_jobid')
+        with open(counter_path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            job_number = int(f.read().strip() or 0) + 1
+            f.seek(0)
+            f.truncate()
+            f.write(str(job_number))
+        return job_number
+
+    def submit(self, script_path, options=()):
+        """
+        queues a job script to run locally.  Supports the "-t <array range>"
+        option (or #PBS -t directive) for job arrays, "-l" options that
+        override the script's walltime or ppn, and "-W depend=..." options
+        :return jobid: (str) the job's id
+        """
+        options = list(options)
+        directives = parse_directives(script_path)
+        array_range = directives.get('t')
+        if '-t' in options:
+            array_range = options[options.index('-t') + 1]
+        if '-l' in options:
+            for resource in options[options.index('-l') + 1].split(','):
+                key, _, val = resource.partition('=')
+                directives[key] = val
+        depend = directives.get('W', '')
+        if '-W' in options:
+            depend = options[options.index('-W') + 1]
+        job_name = directives.get('N') or os.path.basename(script_path)
+        ppn = min(int(directives.get('ppn') or 1), self.n_cores)
+        walltime = _walltime_seconds(directives.get('walltime'))
+        job_number = self._next_job_number()
+
+        if array_range is None:
+            jobid = f'{job_number}.{LOCAL_SERVER}'
+            runs = {jobid: partial(self._run, script_path, job_name, jobid,
+                                   str(job_number), ppn, walltime)}
+        else:
+            jobid = f'{job_number}[].{LOCAL_SERVER}'
+            indices, slot_limit = parse_array_range(array_range)
+            slots = threading.Semaphore(slot_limit or len(indices))
+            runs = {}
+            for ix in indices:
+                task_id = f'{job_number}[{ix}].{LOCAL_SERVER}'
+                runs[task_id] = partial(self._run, script_path, job_name,
+                                        task_id, f'{job_number}-{ix}', ppn,
+                                        walltime, array_index=ix, slots=slots)
+
+        dependencies = parse_depend(depend) if depend.startswith('depend=') \
+            else []
+        if dependencies:
+            futures = {task_id: Future() for task_id in runs}
+            # waits in its own thread, so jobs that are waiting never hold up
+            # (or deadlock) the pool
+            threading.Thread(target=self._run_after,
+                             args=(dependencies, runs, futures),
+                             daemon=True).start()
+        else:
+            futures = {task_id: self._pool.submit(run)
+                       for task_id, run in runs.items()}
+        self._jobs.update(futures)
+        self._jobs[jobid] = list(futures.values())
+        self._futures.extend(futures.values())
+        return jobid
+
+    def _run_after(self, dependencies, runs, futures):
+        """
+        waits for the jobs in dependencies to finish, then runs the runs (if
+        the dependencies were satisfied), setting each one's future to its
+        exit status (None if it wasn't run)
+        """
+        satisfied = True
+        for depend_type, dep_jobid in dependencies:
+            dep_futures = self._jobs.get(dep_jobid, [])
+            if isinstance(dep_futures, Future):
+                dep_futures = [dep_futures]
+            # jobs submitted by another process are assumed to have finished
+            succeeded = all(fut.exception() is None and fut.result() == 0
+                            for fut in dep_futures)
+            if (depend_type == 'afterok' and not succeeded) or \
+                    (depend_type == 'afternotok' and succeeded):
+                satisfied = False
+        for task_id, run in runs.items():
+            if not satisfied:
+                futures[task_id].set_result(None)
+                continue
+            pool_future = self._pool.submit(run)
+            pool_future.add_done_callback(
+                partial(self._copy_result, futures[task_id])
+            )
+
+    @staticmethod
+    def _copy_result(future, done_future):
+        if done_future.exception() is not None:
+            future.set_exception(done_future.exception())
+        else:
+            future.set_result(done_future.result())
+
+    def _run(self, script_path, job_name, jobid, out_id, ppn, walltime,
+             array_index=None, slots=None):
+        if slots is not None:
+            slots.acquire()
+        with self._cores_freed:
+            self._cores_freed.wait_for(lambda: self._free_cores >= ppn)
+            self._free_cores -= ppn
+        try:
+            env = dict(os.environ, PBS_JOBID=jobid, PBS_JOBNAME=job_name,
+                       PBS_O_WORKDIR=self.workingdir, PBS_NUM_PPN=str(ppn),
+                       # keep multithreaded libraries within the job's cores
+                       OMP_NUM_THREADS=str(ppn), MKL_NUM_THREADS=str(ppn))
+            if array_index is not None:
+                env['PBS_ARRAYID'] = str(array_index)
+            stdout_path = opj(self.workingdir, f'{job_name}.o{out_id}')
+            stderr_path = opj(self.workingdir, f'{job_name}.e{out_id}')
+            with open(stdout_path, 'w') as out, open(stderr_path, 'w') as err:
+                # in its own process group, so the whole job can be killed
+                proc = Popen(['bash', script_path], stdout=out, stderr=err,
+                             cwd=self.workingdir, env=env,
+                             start_new_session=True)
+                try:
+                    return proc.wait(timeout=walltime)
+                except TimeoutExpired:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                    proc.wait()
+                    # same message PBS writes when it kills a job
+                    err.write(f'=>> PBS: job killed: walltime {walltime} '
+                              f'exceeded limit {walltime}\n')
+                    return None
+        finally:
+            with self._cores_freed:
+                self._free_cores += ppn
+                self._cores_freed.notify_all()
+            if slots is not None:
+                slots.release()
+
+    def wait(self):
+        """blocks until all submitted jobs have finished"""
+        for future in self._futures:
+            future.result()
+        self._futures = []
+        self._jobs = {}
+
+    def shutdown(self):
+        self.wait()
+        self._pool.shutdown()
@@ -0,0 +1,274 @@
+#!/usr/bin/python
+
+# multi-stage pipelines (e.g., crunch -> reduce -> collect) whose stages are
+# all submitted at once, with each stage's jobs held by the scheduler until
+# the stages they depend on have finished (qsub -W depend=...), so the next
+# stage starts as soon as the last job of the one before it ends.  A stage
+# that depends on a job array waits for the whole array (fan-in).  Stages are
+# defined in submit.py (see "stages" there); the jobs in each are recorded in
+# <workingdir>/<jobname>_pipeline.json & tracked in the job ledger, so running
+# submit.py again resumes a partially failed pipeline:
+#   - stages whose jobs all finished successfully are skipped
+#   - jobs in other stages that failed (or were never run, e.g. because a
+#     stage they depend on failed) are resubmitted.  Jobs still in the queue
+#     are left alone
+#   - every job in a stage downstream of a resubmitted one is rerun
+# (resubmit_failed.py leaves a pipeline's jobs to submit.py, since it would
+# resubmit them without their dependencies)
+# To show the state of each stage:
+#   python3 pipeline.py status <workingdir> <jobname> [--sync]
+import json
+import os
+from argparse import ArgumentParser
+from os.path import isfile, join as opj
+
+try:
+    from .ledger import JobLedger, ledger_path
+except ImportError:
+    # run as a script on the cluster
+    from ledger import JobLedger, ledger_path
+
+# afterok: run only if every job in the stages depended on succeeded
+# afterany: run once they've all finished, whether or not they succeeded
+# afternotok: run only if at least one of them failed (e.g., to clean up)
+DEPEND_TYPES = ('afterok', 'afterany', 'afternotok')
+PENDING_STATES = ('submitted', 'running')
+
+
+def pipeline_path(workingdir, job_name):
+    return opj(workingdir, f'{job_name}_pipeline.json')
+
+
+class Stage:
+    """
+    a step in a pipeline
+    :param name: (str) name of the stage
+    :param jobs: (iterable) (job name, job command) pairs.  Job names must be
+                 unique across all of a pipeline's stages
+    :param depend: (str, default: 'afterok') when to run the stage's jobs,
+                   relative to the stages it depends on (see DEPEND_TYPES)
+    :param after: (str or list, optional) name(s) of the stage(s) it depends
+                  on (default: the stage before it; none for the first stage)
+    :param resources: (str, optional) resources to request for the stage's
+                      jobs in place of those in config.ini, e.g.,
+                      "walltime=4:00:00,ppn=4"
+    """
+    def __init__(self, name, jobs, depend='afterok', after=None,
+                 resources=None):
+        assert depend in DEPEND_TYPES, \
+            f"depend must be one of {', '.join(DEPEND_TYPES)} ({name})"
+        self.name = name
+        self.jobs = jobs
+        self.depend = depend
+        if isinstance(after, str):
+            after = [after]
+        self.after = after
+        self.resources = resources
+
+
+def task_jobid(jobid, array_index=None):
+    """
+    returns the jobid of a single array task (e.g., "12345[7].server") given
+    its array's jobid ("12345[].server") & its index
+    """
+    if array_index is None:
+        return jobid
+    return jobid.replace('[]', f'[{array_index}]', 1)
+
+
+def depend_option(depend, jobids):
+    """
+    formats the value of qsub's -W option making a job depend on jobids.
+    Whole job arrays (e.g., "12345[].server") are depended on with
+    "<depend>array", as Torque requires
+    """
+    jobs = [jobid for jobid in jobids if '[]' not in jobid]
+    arrays = [jobid for jobid in jobids if '[]' in jobid]
+    conditions = [':'.join([depend, *jobs])] if jobs else []
+    conditions.extend(f'{depend}array:{jobid}' for jobid in arrays)
+    return f"depend={','.join(conditions)}"
+
+
+def job_outcome(row):
+    """
+    returns 'succeeded', 'failed', 'pending' or 'not submitted' for a job
+    given its (jobid, array index, state, exit status) in the ledger (or None
+    if it isn't there)
+    """
+    if row is None:
+        return 'not submitted'
+    jobid, _, state, exit_status = row
+    if state in PENDING_STATES:
+        return 'pending'
+    if state == 'finished' and exit_status in (0, None):
+        return 'succeeded'
+    if state == 'written' or jobid is None:
+        return 'not submitted'
+    return 'failed'
+
+
+def stage_state(outcomes):
+    """
+    summarizes the outcomes of a stage's jobs as the stage's state
+    """
+    if outcomes and all(o == 'succeeded' for o in outcomes):
+        return 'finished'
+    if 'pending' in outcomes:
+        return 'running'
+    if 'failed' in outcomes:
+        return 'failed'
+    return 'not submitted'
+
+
+class Pipeline:
+    """
+    :param stages: (list) Stage objects, in order.  Stages may only depend
+                   on earlier ones
+    :param state_path: (str) JSON file the stages' job names are saved to
+    """
+    def __init__(self, stages, state_path):
+        self.stages = stages
+        self.state_path = state_path
+        names = [stage.name for stage in stages]
+        assert len(set(names)) == len(names), "stage names must be unique"
+        for ix, stage in enumerate(stages):
+            if stage.after is None:
+                stage.after = names[ix - 1:ix]
+            for upstream in stage.after:
+                assert upstream in names[:ix], \
+                    f"stage {stage.name} depends on {upstream}, which isn't " \
+                    "an earlier stage"
+
+    def save(self, stage_jobs):
+        state = {'stages': [{'name': stage.name, 'depend': stage.depend,
+                             'after': stage.after,
+                             'job_names': [job_n for job_n, _
+                                           in stage_jobs[stage.name]]}
+                            for stage in self.stages]}
+        tmp_path = f'{self.state_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def submit(self, script_template, array_template=None,
+               bundle_template=None):
+        """
+        submits every stage that hasn't finished successfully (see module
+        description), each depending on the submissions of the stages it
+        depends on.  Stages with more than one job to run are submitted as a
+        job array if array_template is given, or in bundles if
+        bundle_template is given
+        :param script_template: (ScriptTemplate) writes & submits job scripts
+        :return stage_jobids: (dict) maps each stage's name to the jobids that
+                              stages depending on it wait for
+        """
+        config = script_template.config
+        ledger = script_template.ledger
+        # jobs are generated first: generating them may update the ledger
+        # (e.g., forgetting jobs with out-of-date cached results)
+        stage_jobs = {stage.name: list(stage.jobs) for stage in self.stages}
+        all_names = [job_n for jobs in stage_jobs.values()
+                     for job_n, _ in jobs]
+        assert len(set(all_names)) == len(all_names), \
+            "job names must be unique across a pipeline's stages"
+        self.save(stage_jobs)
+
+        ledger.sync(config['workingdir'], config['jobname'])
+        rows = {name: (jobid, array_ix, state, exit_status) for
+                name, jobid, array_ix, state, exit_status, *_
+                in ledger.jobs()}
+
+        stage_jobids = {}
+        resubmitted = set()
+        for stage in self.stages:
+            rerun_all = any(upstream in resubmitted
+                            for upstream in stage.after)
+            to_run = []
+            pending = []
+            n_done = 0
+            for job_n, job_c in stage_jobs[stage.name]:
+                outcome = job_outcome(rows.get(job_n))
+                if outcome == 'pending':
+                    jobid, array_ix, *_ = rows[job_n]
+                    pending.append(task_jobid(jobid, array_ix))
+                elif outcome == 'succeeded' and not rerun_all:
+                    n_done += 1
+                else:
+                    to_run.append((job_n, job_c))
+
+            options = []
+            upstream_jobids = [jobid for upstream in stage.after
+                               for jobid in stage_jobids[upstream]]
+            if upstream_jobids:
+                options.extend(['-W', depend_option(stage.depend,
+                                                    upstream_jobids)])
+            if stage.resources:
+                options.extend(['-l', stage.resources])
+
+            jobids = []
+            if to_run:
+                for job_n, job_c in to_run:
+                    script_template.lock(job_n, job_c)
+                    # rewritten, in case the command has changed
+                    old_script = opj(script_template.scriptdir, job_n)
+                    if isfile(old_script):
+                        os.remove(old_script)
+                many = len(to_run) > 1
+                jobids = script_template.submit_jobs(
+                    to_run,
+                    array_template=array_template if many else None,
+                    bundle_template=bundle_template if many else None,
+                    options=options
+                )
+                resubmitted.add(stage.name)
+            # (pending array tasks are depended on individually, since other
+            # tasks in the same array may have failed)
+            stage_jobids[stage.name] = jobids + list(dict.fromkeys(pending))
+            print(f"[STAGE {stage.name}: {len(to_run)} jobs submitted, "
+                  f"{len(pending)} already queued, {n_done} finished]")
+        return stage_jobids
+
+
+def pipeline_status(workingdir, job_name, sync=False):
+    """
+    returns (stage name, stage state, {job outcome: number of jobs}) for
+    each stage of the pipeline last submitted from workingdir
+    """
+    with open(pipeline_path(workingdir, job_name), 'r') as f:
+        stages = json.load(f)['stages']
+    ledger = JobLedger(ledger_path(workingdir, job_name))
+    if sync:
+        ledger.sync(workingdir, job_name)
+    rows = {name: (jobid, array_ix, state, exit_status) for
+            name, jobid, array_ix, state, exit_status, *_ in ledger.jobs()}
+    ledger.close()
+
+    status = []
+    for stage in stages:
+        outcomes = [job_outcome(rows.get(name))
+                    for name in stage['job_names']]
+        counts = {}
+        for outcome in outcomes:
+            counts[outcome] = counts.get(outcome, 0) + 1
+        status.append((stage['name'], stage_state(outcomes), counts))
+    return status
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser(description="Show the state of each stage \
+    of a pipeline")
+    subparsers = arg_parser.add_subparsers(dest='action')
+    status_parser = subparsers.add_parser('status')
+    status_parser.add_argument("workingdir", type=str)
+    status_parser.add_argument("job_name", type=str)
+    status_parser.add_argument("--sync", action='store_true',
+                               help="Update the ledger from qstat & the \
+                               jobs' output files first")
+    args = arg_parser.parse_args()
+
+    for stage_name, state, outcome_counts in pipeline_status(
+            args.workingdir, args.job_name, args.sync
+    ):
+        counts = ', '.join(f'{n} {outcome}'
+                           for outcome, n in outcome_counts.items())
+        print(f'{stage_name}\t{state}\t{counts}')
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+
+# reads jobs' stdout/stderr files on the cluster for the local log tailer
+# (tail_logs.py), so every job's new output is fetched in a single remote
+# command.  Running jobs write their output to the working directory as they
+# go when live_logs is enabled in config.ini (#PBS -k oed):
+#   python3 read_logs.py tail <workingdir> <job name> [--offsets <offsets>]
+#       [--offsets-file <path>] [--max-bytes N]
+# The caller passes the number of bytes of each file it already has (a
+# base64-encoded, zlib-compressed JSON object mapping file names to offsets,
+# given directly or in a file that's removed after reading).  One JSON line is
+# printed for each file that's grown (or shrunk) since:
+#   {"file": <name>, "offset": <start>, "size": <file size>,
+#    "data": <base64-encoded, zlib-compressed bytes from offset>}
+# "offset" is 0 if the file is shorter than the caller's offset (i.e., it was
+# replaced, e.g. by a resubmitted job).  At most --max-bytes are sent per file;
+# the rest is sent on the next call.
+#   python3 read_logs.py grep <workingdir> <job name> <pattern>
+#       [--ignore-case] [--streams oe] [--max-matches N]
+# prints "<file name>\t<line number>\t<line>" for every matching line
+import base64
+import json
+import os
+import re
+import sys
+import zlib
+from argparse import ArgumentParser
+
+STREAMS = ('o', 'e')
+
+
+def encode_offsets(offsets):
+    return base64.b64encode(
+        zlib.compress(json.dumps(offsets).encode())
+    ).decode()
+
+
+def decode_offsets(encoded):
+    return json.loads(zlib.decompress(base64.b64decode(encoded)))
+
+
+def log_files(workingdir, job_name, streams=STREAMS):
+    """
+    yields os.DirEntry objects for jobs' stdout (streams containing 'o')
+    and/or stderr (streams containing 'e') files, from a single listing of
+    workingdir
+    """
+    prefixes = tuple(f'{job_name}.{stream}' for stream in streams)
+    with os.scandir(workingdir) as entries:
+        for entry in entries:
+            # (excludes e.g. {job_name}.o.tmp files that aren't job outputs)
+            if entry.name.startswith(prefixes) \
+                    and entry.name[len(job_name) + 2:][:1].isdigit():
+                yield entry
+
+
+def tail(workingdir, job_name, offsets, max_bytes=1 << 20):
+    """
+    yields a record (see module description) for every log file whose size
+    differs from its offset in offsets
+    """
+    for entry in log_files(workingdir, job_name):
+        size = entry.stat().st_size
+        offset = offsets.get(entry.name, 0)
+        if size == offset:
+            continue
+        if size < offset:
+            offset = 0
+        with open(entry.path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(min(size - offset, max_bytes))
+        yield {'file': entry.name, 'offset': offset, 'size': size,
+               'data': base64.b64encode(zlib.compress(data)).decode()}
+
+
+def grep(workingdir, job_name, pattern, ignore_case=False, streams=STREAMS,
+         max_matches=None):
+    """
+    yields (file name, line number, line) for every line of the jobs' log
+    files matching pattern (a regular expression)
+    """
+    regex = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+    n_matches = 0
+    entries = sorted(log_files(workingdir, job_name, streams),
+                     key=lambda e: e.name)
+    for entry in entries:
+        with open(entry.path, 'r', errors='replace') as f:
+            for line_no, line in enumerate(f, start=1):
+                if regex.search(line):
+                    yield entry.name, line_no, line.rstrip('\n')
+                    n_matches += 1
+                    if max_matches is not None and n_matches >= max_matches:
+                        return
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser(description="Read new output from, or search, \
+    jobs' stdout/stderr files")
+    subparsers = arg_parser.add_subparsers(dest='action')
+    tail_parser = subparsers.add_parser('tail')
+    tail_parser.add_argument("workingdir", type=str)
+    tail_parser.add_argument("job_name", type=str)
+    tail_parser.add_argument("--offsets", default=None, type=str)
+    tail_parser.add_argument("--offsets-file", default=None, type=str)
+    tail_parser.add_argument("--max-bytes", default=1 << 20, type=int)
+    grep_parser = subparsers.add_parser('grep')
+    grep_parser.add_argument("workingdir", type=str)
+    grep_parser.add_argument("job_name", type=str)
+    grep_parser.add_argument("pattern", type=str)
+    grep_parser.add_argument("--ignore-case", action='store_true')
+    grep_parser.add_argument("--streams", default='oe', type=str,
+                             help="'o' for stdout, 'e' for stderr, or 'oe'")
+    grep_parser.add_argument("--max-matches", default=None, type=int)
+    args = arg_parser.parse_args()
+
+    if args.action == 'tail':
+        file_offsets = {}
+        if args.offsets_file is not None:
+            with open(args.offsets_file, 'r') as offsets_f:
+                file_offsets = decode_offsets(offsets_f.read())
+            os.remove(args.offsets_file)
+        elif args.offsets is not None:
+            file_offsets = decode_offsets(args.offsets)
+        for record in tail(args.workingdir, args.job_name, file_offsets,
+                           args.max_bytes):
+            sys.stdout.write(json.dumps(record) + '\n')
+    else:
+        for file_name, line_number, text in grep(
+                args.workingdir, args.job_name, args.pattern,
+                args.ignore_case, args.streams, args.max_matches
+        ):
+            sys.stdout.write(f'{file_name}\t{line_number}\t{text}\n')
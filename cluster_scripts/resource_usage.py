@@ -0,0 +1,145 @@
+#!/usr/bin/python
+
+# summarizes the resources (walltime, memory & CPU time) jobs actually used, as
+# recorded in the job ledger, and recommends tighter requests for future
+# submissions: the 95th percentile of finished jobs' usage plus a margin.
+# Jobs killed for exceeding a limit are given a larger one when resubmitted.
+#   python3 resource_usage.py <ledger path> [--margin 0.25] [--min-jobs 10]
+# prints a JSON object with the usage statistics ("stats"), the recommended
+# requests ("recommended", null if too few jobs have finished), and the
+# requests for killed jobs' resubmissions ("escalated")
+import json
+import math
+import sys
+from argparse import ArgumentParser
+
+try:
+    from .ledger import JobLedger
+except ImportError:
+    # run as a script on the cluster
+    from ledger import JobLedger
+
+# killed jobs' limits are multiplied by this when they're resubmitted
+ESCALATION_FACTOR = 2
+# never request less than this much walltime (seconds)
+MIN_WALLTIME = 60
+
+
+def percentile(values, q):
+    """
+    returns the q-th percentile (0-100) of values, interpolating linearly
+    between the closest ranks
+    """
+    values = sorted(values)
+    rank = (len(values) - 1) * q / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def fmt_walltime(seconds):
+    """formats a number of seconds as a PBS walltime (HH:MM:SS)"""
+    minutes, seconds = divmod(int(math.ceil(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours:02d}:{minutes:02d}:{seconds:02d}'
+
+
+def fmt_mem(n_bytes):
+    """formats a number of bytes as a PBS memory request, in mb"""
+    return f'{int(math.ceil(n_bytes / (1 << 20)))}mb'
+
+
+def usage_stats(usage_rows):
+    """
+    summarizes the usage of finished jobs
+    :param usage_rows: (list) rows returned by JobLedger.usage()
+    :return stats: (dict) number of jobs with recorded usage ("n_jobs"), and
+                   the p50, p95 & max of "walltime" (seconds), "mem" (bytes)
+                   and "cpus" (CPU time / walltime, i.e. busy cores)
+    """
+    samples = {'walltime': [], 'mem': [], 'cpus': []}
+    for _, state, walltime, mem, cput, *_ in usage_rows:
+        if state != 'finished' or walltime is None:
+            continue
+        samples['walltime'].append(walltime)
+        if mem is not None:
+            samples['mem'].append(mem)
+        if cput is not None and walltime > 0:
+            samples['cpus'].append(cput / walltime)
+
+    stats = {'n_jobs': len(samples['walltime'])}
+    for resource, values in samples.items():
+        if values:
+            stats[resource] = {'p50': percentile(values, 50),
+                               'p95': percentile(values, 95),
+                               'max': max(values)}
+    return stats
+
+
+def recommend_resources(stats, margin=0.25, min_jobs=10):
+    """
+    returns the walltime, mem & ppn to request for jobs like those summarized
+    in stats: the p95 of each plus a margin (ppn is the p95 number of busy
+    cores, rounded up).  Returns None if fewer than min_jobs jobs have
+    recorded usage
+    """
+    if stats['n_jobs'] < min_jobs:
+        return None
+    walltime = max(MIN_WALLTIME, stats['walltime']['p95'] * (1 + margin))
+    recommended = {'walltime': fmt_walltime(walltime), 'mem': None,
+                   'ppn': None}
+    if 'mem' in stats:
+        recommended['mem'] = fmt_mem(stats['mem']['p95'] * (1 + margin))
+    if 'cpus' in stats:
+        # (a little CPU time beyond a whole core is scheduling noise)
+        recommended['ppn'] = max(1, math.ceil(stats['cpus']['p95'] - 0.05))
+    return recommended
+
+
+def escalate(killed_by, killed_limit, factor=ESCALATION_FACTOR):
+    """
+    returns the resource request (e.g., "walltime=02:00:00") to resubmit a
+    job killed for exceeding killed_limit of killed_by with, or None if the
+    resource isn't one that can be escalated
+    """
+    if killed_limit is None:
+        return None
+    if killed_by in ('walltime', 'cput'):
+        return f'{killed_by}={fmt_walltime(killed_limit * factor)}'
+    if killed_by in ('mem', 'vmem', 'pmem'):
+        return f'{killed_by}={fmt_mem(killed_limit * factor)}'
+    return None
+
+
+def resource_report(ledger, margin=0.25, min_jobs=10):
+    """
+    returns usage statistics, recommended requests & escalated requests for
+    killed jobs (see module description) from a JobLedger
+    """
+    usage_rows = ledger.usage()
+    stats = usage_stats(usage_rows)
+    escalated = {}
+    for name, state, *_, killed_by, killed_limit in usage_rows:
+        request = escalate(killed_by, killed_limit)
+        if state == 'failed' and request is not None:
+            escalated[name] = request
+    return {'stats': stats,
+            'recommended': recommend_resources(stats, margin, min_jobs),
+            'escalated': escalated}
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser(description="Summarize the resources used by \
+    finished jobs & recommend requests for future submissions")
+    arg_parser.add_argument("ledger_path", type=str)
+    arg_parser.add_argument("--margin", default=0.25, type=float,
+                            help="Fraction added to the 95th percentile of \
+                            usage when recommending requests")
+    arg_parser.add_argument("--min-jobs", default=10, type=int,
+                            help="Number of finished jobs needed to make a \
+                            recommendation")
+    args = arg_parser.parse_args()
+
+    job_ledger = JobLedger(args.ledger_path)
+    report = resource_report(job_ledger, args.margin, args.min_jobs)
+    job_ledger.close()
+    sys.stdout.write(json.dumps(report) + '\n')
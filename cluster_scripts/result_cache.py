@@ -0,0 +1,235 @@
+#!/usr/bin/python
+
+# content-addressed cache of job results, so that re-running a sweep only
+# submits jobs whose command, job script, declared input files, or relevant
+# config.ini options have changed since they last ran successfully.
+#   - each job's key is a hash of those things (see ResultCache.job_key)
+#   - when a job is submitted, a pending entry records its key, name & the
+#     output files it declares
+#   - once the ledger shows the job finished (with exit status 0), its outputs
+#     are hard-linked (or copied) into the cache & the entry is completed
+#   - on a later submission, a job whose key has a completed entry isn't
+#     submitted; the cached outputs are linked to its output paths instead
+# Entries are only ever removed explicitly:
+#   python result_cache.py <cache dir> list
+#   python result_cache.py <cache dir> evict [--job PATTERN] [--older-than N]
+#   python result_cache.py <cache dir> evict --all
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import sys
+import time
+from argparse import ArgumentParser
+from fnmatch import fnmatch
+from os.path import isdir, isfile, join as opj
+
+# config.ini options that affect a job's results
+CACHED_CONFIG_FIELDS = ('modules', 'env_type', 'env_name', 'cmd_wrapper')
+
+
+def _link(src, dest):
+    # hard links are free, but can't cross filesystems
+    if isfile(dest):
+        if os.path.samefile(src, dest):
+            return
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
+class ResultCache:
+    """
+    :param cache_dir: (str) directory holding the cache (created if it
+                      doesn't exist)
+    :param config: (dict-like) options from config.ini
+    """
+    def __init__(self, cache_dir, config=None):
+        self.cache_dir = cache_dir
+        self.pending_dir = opj(cache_dir, 'pending')
+        os.makedirs(self.pending_dir, exist_ok=True)
+        self.config_fields = {}
+        if config is not None:
+            self.config_fields = {field: str(config[field])
+                                  for field in CACHED_CONFIG_FIELDS}
+        # many jobs share a script & inputs, so each file is only hashed once
+        self._checksums = {}
+
+    def file_checksum(self, path):
+        st = os.stat(path)
+        memo_key = (os.path.realpath(path), st.st_mtime, st.st_size)
+        if memo_key not in self._checksums:
+            hash_md5 = hashlib.md5()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    hash_md5.update(chunk)
+            self._checksums[memo_key] = hash_md5.hexdigest()
+        return self._checksums[memo_key]
+
+    def job_key(self, job_command, inputs=()):
+        """
+        returns the cache key for a job: a hash of its command, the checksum
+        of its job script (the command's first word) & declared input files,
+        and the config.ini options in CACHED_CONFIG_FIELDS
+        """
+        script = shlex.split(job_command)[0] if job_command.strip() else ''
+        payload = {
+            'command': job_command,
+            'script': self.file_checksum(script) if isfile(script) else None,
+            'inputs': sorted((os.path.realpath(p), self.file_checksum(p))
+                             for p in inputs),
+            'config': self.config_fields
+        }
+        encoded = json.dumps(payload, sort_keys=True).encode()
+        return hashlib.sha256(encoded).hexdigest()
+
+    def _entry_dir(self, key):
+        return opj(self.cache_dir, key[:2], key)
+
+    def lookup(self, key):
+        """returns the completed entry for a key, or None"""
+        entry_path = opj(self._entry_dir(key), 'entry.json')
+        if not isfile(entry_path):
+            return None
+        with open(entry_path, 'r') as f:
+            return json.load(f)
+
+    def restore(self, key, output_paths):
+        """
+        if the key has a completed entry with the same number of outputs,
+        links the cached outputs to output_paths & returns True
+        """
+        entry = self.lookup(key)
+        if entry is None or len(entry['outputs']) != len(output_paths):
+            return False
+        for ix, dest in enumerate(output_paths):
+            os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+            _link(opj(self._entry_dir(key), 'outputs', str(ix)), dest)
+        return True
+
+    def is_pending(self, key):
+        return isfile(opj(self.pending_dir, key))
+
+    def register(self, key, job_name, output_paths):
+        """
+        records that a job with the given key is being submitted.  Its old
+        outputs are removed first, so the job writes new files rather than
+        overwriting ones that may be linked into the cache
+        """
+        for path in output_paths:
+            if isfile(path):
+                os.remove(path)
+        with open(opj(self.pending_dir, key), 'w') as f:
+            json.dump({'job_name': job_name,
+                       'outputs': [os.path.abspath(p) for p in output_paths],
+                       'submitted': time.time()}, f)
+
+    def store(self, key):
+        """
+        moves a pending entry into the cache, linking its job's outputs into
+        the entry.  Returns False (and drops the entry) if any are missing
+        """
+        pending_path = opj(self.pending_dir, key)
+        with open(pending_path, 'r') as f:
+            entry = json.load(f)
+        if not all(isfile(p) for p in entry['outputs']):
+            os.remove(pending_path)
+            return False
+        entry_dir = self._entry_dir(key)
+        tmp_dir = f'{entry_dir}.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(opj(tmp_dir, 'outputs'))
+        for ix, path in enumerate(entry['outputs']):
+            _link(path, opj(tmp_dir, 'outputs', str(ix)))
+            # cached files (& the outputs linked to them) are made read-only
+            # so they can't be modified in place
+            os.chmod(path, os.stat(path).st_mode & ~0o222)
+        entry['stored'] = time.time()
+        with open(opj(tmp_dir, 'entry.json'), 'w') as f:
+            json.dump(entry, f)
+        # replace any existing entry for the key in one step
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.rename(tmp_dir, entry_dir)
+        os.remove(pending_path)
+        return True
+
+    def store_finished(self, ledger):
+        """
+        completes the pending entries of jobs the ledger shows have finished
+        successfully.  Entries of failed jobs are kept, in case they succeed
+        when resubmitted.  Returns the number of entries stored
+        """
+        states = {name: (state, exit_status) for
+                  name, _, _, state, exit_status, *_ in ledger.jobs()}
+        n_stored = 0
+        for key in os.listdir(self.pending_dir):
+            with open(opj(self.pending_dir, key), 'r') as f:
+                job_name = json.load(f)['job_name']
+            state, exit_status = states.get(job_name, (None, None))
+            if state == 'finished' and exit_status in (0, None):
+                n_stored += self.store(key)
+        return n_stored
+
+    def entries(self):
+        """yields (key, entry) for every completed entry"""
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = opj(self.cache_dir, prefix)
+            if prefix == 'pending' or not isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                if not key.endswith('.tmp'):
+                    entry = self.lookup(key)
+                    if entry is not None:
+                        yield key, entry
+
+    def evict(self, job_pattern=None, older_than=None):
+        """
+        removes completed entries whose job names match job_pattern and/or
+        that were stored more than older_than seconds ago (all entries, if
+        neither is given).  Returns the number of entries removed
+        """
+        now = time.time()
+        to_evict = [key for key, entry in self.entries()
+                    if (job_pattern is None
+                        or fnmatch(entry['job_name'], job_pattern))
+                    and (older_than is None
+                         or now - entry['stored'] > older_than)]
+        for key in to_evict:
+            shutil.rmtree(self._entry_dir(key))
+        return len(to_evict)
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser(description="Inspect or evict entries from \
+    the job result cache")
+    arg_parser.add_argument("cache_dir", type=str)
+    subparsers = arg_parser.add_subparsers(dest='action')
+    subparsers.add_parser('list')
+    evict_parser = subparsers.add_parser('evict')
+    evict_parser.add_argument("--job", default=None, type=str,
+                              help="Only evict jobs matching this pattern")
+    evict_parser.add_argument("--older-than", default=None, type=float,
+                              help="Only evict entries stored more than this \
+                              many days ago")
+    evict_parser.add_argument("--all", action='store_true',
+                              help="Evict every entry")
+    args = arg_parser.parse_args()
+
+    cache = ResultCache(args.cache_dir)
+    if args.action == 'evict':
+        if args.job is None and args.older_than is None and not args.all:
+            sys.exit("specify --job, --older-than, or --all")
+        older_than_s = None
+        if args.older_than is not None:
+            older_than_s = args.older_than * 86400
+        n_evicted = cache.evict(args.job, older_than_s)
+        print(f"evicted {n_evicted} entries")
+    else:
+        for cache_key, cache_entry in cache.entries():
+            stored = time.strftime('%Y-%m-%d %H:%M:%S',
+                                   time.localtime(cache_entry['stored']))
+            sys.stdout.write(f"{cache_key}\t{cache_entry['job_name']}\t"
+                             f"{stored}\t{len(cache_entry['outputs'])}\n")
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+
+# summarizes jobs' stdout/stderr files on the cluster so that the local tools
+# can check on every job with a single remote command.  Prints one
+# tab-separated line per job:
+#   <jobid>  <script name>  <finished (1/0)>  <stderr size (bytes, -1 if none)>
+#   <exit status (empty if not reported)>
+# Files that don't contain a "script name:" line are reported with an empty
+# script name.  Bundled jobs share a stdout file, so may share a jobid.
+import os
+import sys
+from argparse import ArgumentParser
+
+
+def parse_stdout(stdout_path):
+    """
+    reads a job's stdout file line by line and returns a list of
+    [script name, finished, exit status] lists, one per "script name:"
+    section
+    """
+    sections = []
+    with open(stdout_path, 'r', errors='replace') as f:
+        for line in f:
+            if line.startswith('script name: '):
+                sections.append(
+                    [line[len('script name: '):].strip(), False, None]
+                )
+            elif sections and line.startswith('exit status: '):
+                sections[-1][2] = int(line[len('exit status: '):])
+            elif sections and line.startswith('job script finished'):
+                sections[-1][1] = True
+    return sections
+
+
+def scan_outputs(workingdir, job_name):
+    """
+    yields (jobid, script name, finished, stderr size, exit status) for every
+    {job_name}.o<jobid> file in workingdir
+    """
+    stdout_prefix = f'{job_name}.o'
+    stderr_prefix = f'{job_name}.e'
+    stdout_entries = []
+    stderr_sizes = {}
+    # a single directory listing, rather than a stat call per file
+    with os.scandir(workingdir) as entries:
+        for entry in entries:
+            if entry.name.startswith(stdout_prefix):
+                stdout_entries.append(entry)
+            elif entry.name.startswith(stderr_prefix):
+                jobid = entry.name[len(stderr_prefix):]
+                stderr_sizes[jobid] = entry.stat().st_size
+
+    for entry in sorted(stdout_entries, key=lambda e: e.name):
+        jobid = entry.name[len(stdout_prefix):]
+        stderr_size = stderr_sizes.get(jobid, -1)
+        sections = parse_stdout(entry.path)
+        if not sections:
+            yield jobid, '', False, stderr_size, None
+        for script_name, finished, exit_status in sections:
+            yield jobid, script_name, finished, stderr_size, exit_status
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser(description="Summarize job output files")
+    arg_parser.add_argument("workingdir", type=str)
+    arg_parser.add_argument("job_name", type=str)
+    args = arg_parser.parse_args()
+
+    outputs = scan_outputs(args.workingdir, args.job_name)
+    for jobid, script_name, finished, stderr_size, exit_status in outputs:
+        exit_status = '' if exit_status is None else exit_status
+        sys.stdout.write(f'{jobid}\t{script_name}\t{int(finished)}\t'
+                         f'{stderr_size}\t{exit_status}\n')
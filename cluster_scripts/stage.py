@@ -0,0 +1,357 @@
+#!/usr/bin/python
+
+# stages jobs' data on node-local scratch space, used when config['stage_data']
+# is enabled.  submit.py runs each job command through this script, which
+#   - copies the job's declared input files (job_inputs) to a per-node cache
+#     (unless they're already there), then links them into a scratch directory
+#     under $TMPDIR
+#   - replaces the input & output paths (job_outputs) in the job command's
+#     arguments with their scratch copies & runs it
+#   - copies the outputs the command wrote back to their real paths (each
+#     under a temporary name, then renamed, so partial outputs never appear)
+#     & removes the scratch directory
+# Cached inputs are named for a hash of their contents (computed once, at
+# submission), so consecutive jobs on the same node read each input from the
+# shared filesystem only once, and a changed input is never mistaken for an
+# old one.  When the cache is over its size limit, the least recently used
+# inputs are removed.
+#   python3 stage.py run [--cache-dir DIR] [--cache-size SIZE] \
+#       [--scratch-dir DIR] [--input PATH [HASH]]... [--output PATH]... \
+#       -- <command>
+import fcntl
+import getpass
+import hashlib
+import os
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser, REMAINDER
+from contextlib import contextmanager
+from os.path import abspath, basename, dirname, isfile, realpath, join as opj
+from subprocess import Popen
+
+try:
+    from .job_status import parse_mem
+except ImportError:
+    # run as a script on the cluster
+    from job_status import parse_mem
+
+stage_script = realpath(__file__)
+DEFAULT_CACHE_SIZE = '20gb'
+# partial copies left by jobs that were killed while caching a file are
+# removed after this many seconds
+STALE_TMP_SECONDS = 3600
+
+# many jobs share inputs, so each file is only hashed once per submission
+_checksums = {}
+
+
+def default_cache_dir():
+    # outside $TMPDIR, which PBS removes when each job ends
+    return opj('/tmp', f'{getpass.getuser()}_stage_cache')
+
+
+def content_hash(path):
+    """
+    returns the MD5 checksum of a file's contents, or None if it doesn't
+    exist (yet)
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    memo_key = (realpath(path), st.st_mtime, st.st_size)
+    if memo_key not in _checksums:
+        hash_md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                hash_md5.update(chunk)
+        _checksums[memo_key] = hash_md5.hexdigest()
+    return _checksums[memo_key]
+
+
+def stage_wrapper(config):
+    """
+    returns the command (used in place of config['cmd_wrapper']) that runs
+    jobs through this script with the cache options in config
+    """
+    wrapper = f'python3 {stage_script} run'
+    if config['stage_cache_dir']:
+        wrapper += f" --cache-dir {shlex.quote(config['stage_cache_dir'])}"
+    if config['stage_cache_size']:
+        wrapper += f" --cache-size {config['stage_cache_size']}"
+    return wrapper
+
+
+def staged_command(job_command, cmd_wrapper, inputs=(), outputs=()):
+    """
+    returns the arguments to add to stage_wrapper() to run a job command
+    (with cmd_wrapper) whose declared input & output files are staged
+    """
+    args = []
+    for path in inputs:
+        checksum = content_hash(path)
+        args.append(f'--input {shlex.quote(path)}'
+                    + (f' {checksum}' if checksum is not None else ''))
+    for path in outputs:
+        args.append(f'--output {shlex.quote(path)}')
+    return ' '.join([*args, '--', cmd_wrapper, job_command])
+
+
+class NodeCache:
+    """
+    cache of input files on a node's local disk, shared by every job that
+    runs on the node
+    :param cache_dir: (str) directory holding the cache (created if it
+                      doesn't exist)
+    :param max_bytes: (int) most space cached files may use
+    """
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock_dir = opj(cache_dir, 'locks')
+        os.makedirs(self.lock_dir, exist_ok=True)
+
+    @contextmanager
+    def _locked(self, name, blocking=True):
+        """
+        holds an exclusive lock on the named lock file (yielding whether it
+        was acquired, which it always is if blocking is True)
+        """
+        with open(opj(self.lock_dir, name), 'a') as lock_f:
+            flags = fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(lock_f, flags)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+    def fetch(self, src, key, dest):
+        """
+        links (or copies) the cached copy of src, whose contents hash to key,
+        to dest, adding it to the cache first if it isn't there.  Jobs that
+        need the same file at the same time wait for the first to copy it
+        rather than each reading it from the shared filesystem.  Returns True
+        if the file was already cached
+        """
+        cached_path = opj(self.cache_dir, key)
+        with self._locked(key):
+            hit = isfile(cached_path)
+            if hit:
+                # the modification time records when each file was last used
+                os.utime(cached_path)
+            else:
+                tmp_path = f'{cached_path}.{os.getpid()}.tmp'
+                shutil.copyfile(src, tmp_path)
+                # jobs get hard links to cached files, so they mustn't be
+                # modified in place
+                os.chmod(tmp_path, 0o444)
+                os.replace(tmp_path, cached_path)
+            # linked while the entry is locked, so it can't be evicted first
+            try:
+                os.link(cached_path, dest)
+            except OSError:
+                shutil.copy2(cached_path, dest)
+        return hit
+
+    def evict(self, keep=()):
+        """
+        removes the least recently used files until the cache fits in
+        max_bytes, except those in keep & those other jobs are linking.
+        (Jobs that linked an evicted file keep their copy.)  Returns the
+        number of files removed
+        """
+        with self._locked('.evict'):
+            entries = []
+            now = time.time()
+            with os.scandir(self.cache_dir) as scan:
+                for entry in scan:
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat()
+                    if not entry.name.endswith('.tmp'):
+                        entries.append((st.st_mtime, st.st_size, entry.name))
+                    elif now - st.st_mtime > STALE_TMP_SECONDS:
+                        os.remove(entry.path)
+            total = sum(size for _, size, _ in entries)
+            n_removed = 0
+            for _, size, key in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if key in keep:
+                    continue
+                with self._locked(key, blocking=False) as acquired:
+                    if acquired:
+                        os.remove(opj(self.cache_dir, key))
+                        total -= size
+                        n_removed += 1
+            return n_removed
+
+
+def _file_key(path, checksum=None):
+    """
+    names a file in the cache: its content hash if it's known, otherwise a
+    hash of its path, size & modification time
+    """
+    if checksum is not None:
+        return checksum
+    st = os.stat(path)
+    stat_id = f'{realpath(path)}\0{st.st_size}\0{st.st_mtime_ns}'
+    return hashlib.md5(stat_id.encode()).hexdigest()
+
+
+def stage_in(inputs, cache, scratch_dir):
+    """
+    stages (path, checksum) pairs in scratch_dir, via the node cache.  Inputs
+    that can't be staged (e.g., because the node's disk is full) are read
+    from their original paths.  Returns a dict mapping each staged input's
+    path to its scratch copy
+    """
+    staged = {}
+    keys = set()
+    n_cached = 0
+    start = time.time()
+    for ix, (path, checksum) in enumerate(inputs):
+        dest_dir = opj(scratch_dir, 'inputs', str(ix))
+        dest = opj(dest_dir, basename(path))
+        try:
+            key = _file_key(path, checksum)
+            os.makedirs(dest_dir, exist_ok=True)
+            n_cached += cache.fetch(path, key, dest)
+        except OSError as e:
+            sys.stderr.write(f"staging: couldn't stage {path} ({e}), "
+                             "reading it from its original path\n")
+            continue
+        keys.add(key)
+        staged[path] = dest
+    try:
+        cache.evict(keep=keys)
+    except OSError as e:
+        sys.stderr.write(f"staging: couldn't evict cached inputs ({e})\n")
+    print(f"staging: {len(staged)} of {len(inputs)} inputs staged "
+          f"({n_cached} from node cache) in {time.time() - start:.2f}s")
+    return staged
+
+
+def stage_out(outputs):
+    """
+    copies (scratch path, real path) pairs of outputs back to their real
+    paths.  Each file is copied under a temporary name, then renamed, so a
+    partially copied output never appears.  Returns the number copied
+    """
+    n_copied = 0
+    for scratch_path, path in outputs:
+        if not isfile(scratch_path):
+            continue
+        os.makedirs(dirname(abspath(path)), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        shutil.copyfile(scratch_path, tmp_path)
+        os.replace(tmp_path, path)
+        n_copied += 1
+    return n_copied
+
+
+def rewrite_args(command, path_map):
+    """
+    replaces arguments (or the values of "--option=value" arguments) that
+    are keys of path_map with their values
+    """
+    # paths may be given as written or as absolute paths
+    path_map = {**{abspath(p): s for p, s in path_map.items()}, **path_map}
+    rewritten = []
+    for arg in command:
+        option, sep, value = arg.partition('=')
+        if arg in path_map:
+            arg = path_map[arg]
+        elif sep and value in path_map:
+            arg = f'{option}={path_map[value]}'
+        rewritten.append(arg)
+    return rewritten
+
+
+def run_staged(command, inputs=(), outputs=(), cache_dir=None,
+               cache_size=DEFAULT_CACHE_SIZE, scratch_dir=None):
+    """
+    runs a job command (a list of arguments) with its inputs & outputs
+    staged in node-local scratch space (see module description)
+    :param command: (list) the command & its arguments
+    :param inputs: (iterable) (path, checksum) pairs of input files (checksum
+                   may be None)
+    :param outputs: (iterable) paths of output files
+    :param cache_dir: (str, optional) the node's input cache (default:
+                      /tmp/<username>_stage_cache)
+    :param cache_size: (str) most space the cache may use (e.g., "20gb")
+    :param scratch_dir: (str, optional) directory to create the job's scratch
+                        directory in (default: $TMPDIR)
+    :return returncode: (int) the command's exit status
+    """
+    inputs = list(inputs)
+    cache = NodeCache(cache_dir or default_cache_dir(),
+                      parse_mem(cache_size) or parse_mem(DEFAULT_CACHE_SIZE))
+    job_scratch = tempfile.mkdtemp(prefix='stage_', dir=scratch_dir)
+    try:
+        path_map = stage_in(inputs, cache, job_scratch)
+        staged_outputs = []
+        for ix, path in enumerate(outputs):
+            scratch_path = opj(job_scratch, 'outputs', str(ix), basename(path))
+            os.makedirs(dirname(scratch_path), exist_ok=True)
+            path_map[path] = scratch_path
+            staged_outputs.append((scratch_path, path))
+        sys.stdout.flush()
+
+        proc = Popen(rewrite_args(command, path_map),
+                     env={**os.environ, 'STAGE_DIR': job_scratch})
+        try:
+            returncode = proc.wait()
+        except KeyboardInterrupt:
+            proc.terminate()
+            returncode = proc.wait()
+
+        # outputs are copied back whether or not the command succeeded, so
+        # partial results aren't lost
+        start = time.time()
+        n_copied = stage_out(staged_outputs)
+        print(f"staging: {n_copied} of {len(staged_outputs)} outputs copied "
+              f"back in {time.time() - start:.2f}s")
+    finally:
+        shutil.rmtree(job_scratch, ignore_errors=True)
+    # a command killed by a signal exits with 128 + the signal, as in bash
+    return returncode if returncode >= 0 else 128 - returncode
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser(description="Run a job command with its \
+    input & output files staged in node-local scratch space")
+    subparsers = arg_parser.add_subparsers(dest='action')
+    run_parser = subparsers.add_parser('run')
+    run_parser.add_argument("--cache-dir", default=None, type=str,
+                            help="The node's input cache (default: \
+                            /tmp/<username>_stage_cache)")
+    run_parser.add_argument("--cache-size", default=DEFAULT_CACHE_SIZE,
+                            type=str, help="Most space the cache may use")
+    run_parser.add_argument("--scratch-dir", default=None, type=str,
+                            help="Where to create the job's scratch \
+                            directory (default: $TMPDIR)")
+    run_parser.add_argument("--input", action='append', nargs='+',
+                            default=[], metavar=('PATH', 'HASH'),
+                            help="An input file & (optionally) its checksum")
+    run_parser.add_argument("--output", action='append', default=[],
+                            type=str, help="An output file")
+    run_parser.add_argument("command", nargs=REMAINDER)
+    args = arg_parser.parse_args()
+
+    job_command = args.command
+    if job_command and job_command[0] == '--':
+        job_command = job_command[1:]
+    job_inputs = [(spec[0], spec[1] if len(spec) > 1 else None)
+                  for spec in args.input]
+    sys.exit(run_staged(job_command, job_inputs, args.output, args.cache_dir,
+                        args.cache_size, args.scratch_dir))
@@ -2,17 +2,49 @@
 
 # create a bunch of job scripts
 import os
-from datetime import datetime as dt
+import signal
 from os.path import dirname, realpath, join as opj
-from string import Template
-from subprocess import run
-from .config import job_config as config
+from .config import job_config as config, as_bool
+from .env_snapshot import ensure_snapshot
+from .job_scripts import (
+                            ARRAY_JOBSCRIPT_TEMPLATE,
+                            BUNDLE_JOBSCRIPT_TEMPLATE,
+                            INSTRUMENTED_ARRAY_JOBSCRIPT_TEMPLATE,
+                            INSTRUMENTED_JOBSCRIPT_TEMPLATE,
+                            JOBSCRIPT_TEMPLATE,
+                            ScriptTemplate
+                        )
+from .ledger import JobLedger, ledger_path
+from .pipeline import Pipeline, Stage, pipeline_path
+from .resource_usage import resource_report
+from .result_cache import ResultCache
+from .stage import stage_wrapper, staged_command
 
 job_script = opj(dirname(realpath(__file__)), 'cruncher.py')
 job_name = config['jobname']
 
 job_commands = list()
 job_names = list()
+# (optional) an iterable of (job name, job command) pairs to use instead of
+# job_names & job_commands, e.g., a sweep over a parameter grid:
+#   from .sweep import sweep, Product
+#   jobs = sweep(Product(alpha=[0.1, 0.5], seed=range(1000)),
+#                f'{job_name}_{{alpha}}_{{seed}}',
+#                f'{job_script} {{alpha}} {{seed}}')
+# jobs may be a generator; each job is written & submitted as it's produced
+jobs = None
+# (optional) used only if result_cache or stage_data is enabled in config.ini
+job_inputs = dict()
+job_outputs = dict()
+# (optional) later stages of a pipeline, run once the jobs above finish (see
+# pipeline.py).  Every stage is submitted now, held by the scheduler until the
+# stage before it is done, e.g., a reducer that waits for every job to
+# succeed, then the collector, which runs even if the reducer fails:
+#   stages = [Stage('reduce', [(f'{job_name}_reduce', f'{reduce_script}')]),
+#             Stage('collect', [(f'{job_name}_collect', f'{collect_script}')],
+#                   depend='afterany')]
+# Running submit.py again resubmits only the failed stage onwards
+stages = list()
 
 # ====== MODIFY ONLY THE CODE BETWEEN THESE LINES ======
 
@@ -21,11 +53,19 @@ job_names = list()
 #   + create the desired directory structure for your jobs' output files
 #   + iterate over the combinations of parameters with which you want to run jobs
 #   + for each parameter combination, append strings to the job_names and
-#     job_commands lists
+#     job_commands lists (or set jobs, above)
 #     - items added to the job_names list should take the format:
 #       '{job_name}_{param1}_{param2}'
 #     - items added to the job_commands list should take the format:
 #       '{job_script} {param1} {param2}'
+#   + if result_cache is enabled in config.ini, map each job's name to lists of
+#     the files it reads in job_inputs and the files it writes in job_outputs.
+#     Jobs whose command, job script, inputs & environment haven't changed
+#     since they last finished successfully are skipped & their outputs
+#     restored from the cache
+#   + if stage_data is enabled in config.ini, do the same.  Each job's inputs
+#     are copied to (and its outputs written on) its node's local disk; paths
+#     are replaced wherever they appear as arguments in its job command
 
 # The code below will create a bash script for each combination of paramaters
 # (named for the items in job_names) and place it in the scripts/ directory.
@@ -35,11 +75,20 @@ job_names = list()
 
 
 # ====== MODIFY ONLY THE CODE BETWEEN THESE LINES ======
-assert (len(job_commands) == len(job_names)), \
-    "job_names and job_commands must have equal numbers of items"
+if jobs is None:
+    assert (len(job_commands) == len(job_names)), \
+        "job_names and job_commands must have equal numbers of items"
+    n_jobs = len(job_names)
+    jobs = zip(job_names, job_commands)
+else:
+    try:
+        n_jobs = len(jobs)
+    except TypeError:
+        # a generator (or a grid whose size isn't known in advance)
+        n_jobs = None
 
 # use largeq if more than 600 jobs are being submitted (Discovery policy)
-if len(job_commands) > 600 and config['queue'] == 'default':
+if n_jobs is not None and n_jobs > 600 and config['queue'] == 'default':
     config['queue'] = 'largeq'
 
 # set command to activate conda env
@@ -49,106 +98,146 @@ if config['env_type'] == 'conda':
 else:
     raise ValueError("Only conda environments are currently supported")
 
-
-JOBSCRIPT_TEMPLATE = Template(
-"""#!/bin/bash -l
-#PBS -N ${jobname}
-#PBS -q ${queue}
-#PBS -l nodes=${nnodes}:ppn=${ppn}
-#PBS -l walltime=${walltime}
-#PBS -m $email_updates
-#PBS -M $email_addr
-
-echo ---
-echo script name: $job_name
-echo loading modules: $modules
-module load $modules
-
-echo activating ${env_type} environment: $env_name
-$activate_cmd $env_name
-
-echo calling job script
-$cmd_wrapper $job_command
-echo job script finished
-$deactivate_cmd
-echo ---"""
-)
-
-
-class ScriptTemplate:
-    def __init__(self, template, config):
-        self.template = template
-        self.config = config
-        self.scriptdir = self.config['scriptdir']
-        self.lockdir = self.config['lockdir']
-        self.hostname = os.environ.get('HOSTNAME')
-        self.username = os.environ.get('LOGNAME')
-        self.locks = []
-
-        # set submission command
-        if self.username.startswith('f00'):
-            self.submit_cmd = 'mksub'
-        else:
-            self.submit_cmd = 'qsub'
-
-        # create directories if they don't already exist
-        try:
-            os.stat(self.scriptdir)
-        except FileNotFoundError:
-            os.mkdir(self.scriptdir)
-        try:
-            os.stat(self.lockdir)
-        except FileNotFoundError:
-            os.mkdir(self.lockdir)
-
-    def lock(self, job_name):
-        lockfile_path = opj(self.lockdir, f'{job_name}.LOCK')
-        self.locks.append(lockfile_path)
-        try:
-            os.stat(lockfile_path)
-            return True
-        except FileNotFoundError:
-            with open(lockfile_path, 'w') as f:
-                f.writelines(f'LOCK CREATE TIME: {dt.now()} \n')
-                f.writelines(f'HOST: {self.hostname} \n')
-                f.writelines(f'USER: {self.username} \n')
-                f.writelines('\n-----\nCONFIG\n-----\n')
-                for opt, val in self.config.items():
-                    f.writelines(f'{opt.upper()} : {val} \n')
-            return False
-
-    def release_locks(self):
-        for l in self.locks:
-            os.remove(l)
-        os.rmdir(self.lockdir)
-
-    def submit_job(self, jobscript_path):
-        submission_cmd = f'echo "[SUBMITTING JOB: {jobscript_path} ]"; {self.submit_cmd}'
-        run([submission_cmd, jobscript_path])
-
-
-    def write_scriptfile(self, job_name, job_command):
-        filepath = opj(self.scriptdir, job_name)
-        try:
-            os.stat(filepath)
-            return
-        except FileNotFoundError:
-            template_vals = self.config
-            template_vals['job_name'] = job_name
-            template_vals['job_command'] = job_command
-            script_content = self.template.substitute(template_vals)
-            with open(filepath, 'w+') as f:
-                f.write(script_content)
-            return filepath
-
-
-script_template = ScriptTemplate(JOBSCRIPT_TEMPLATE, config)
-
-for job_n, job_c in zip(job_names, job_commands):
-    lockfile_exists = script_template.lock(job_n)
-    if not lockfile_exists:
-        script_filepath = script_template.write_scriptfile(job_n, job_c)
-        if script_filepath:
-            script_template.submit_job(script_filepath)
-
-script_template.release_locks()
+# capture the environment once, rather than loading modules & activating it
+# in every job (see env_snapshot.py)
+config['env_snapshot'] = ''
+if as_bool(config['cache_environment']):
+    env_snapshot = ensure_snapshot(config)
+    if env_snapshot is None:
+        print("couldn't capture environment snapshot; jobs will load "
+              "modules & activate the environment themselves")
+    else:
+        config['env_snapshot'] = env_snapshot
+
+# time each phase of every job & measure its resource use (see instrument.py)
+if as_bool(config['instrument']):
+    jobscript_template = INSTRUMENTED_JOBSCRIPT_TEMPLATE
+    array_jobscript_template = INSTRUMENTED_ARRAY_JOBSCRIPT_TEMPLATE
+    config['bundle_options'] = '--instrument'
+else:
+    jobscript_template = JOBSCRIPT_TEMPLATE
+    array_jobscript_template = ARRAY_JOBSCRIPT_TEMPLATE
+    config['bundle_options'] = ''
+
+if as_bool(config['right_size']) and not as_bool(config['bundle_mode']):
+    # request resources based on what this sweep's finished jobs used
+    usage_ledger = JobLedger(ledger_path(config['workingdir'], job_name))
+    usage_ledger.sync(config['workingdir'], job_name)
+    report = resource_report(usage_ledger, float(config['resource_margin']))
+    usage_ledger.close()
+    if report['recommended'] is not None:
+        for resource, value in report['recommended'].items():
+            if value is not None:
+                print(f"requesting {resource}={value} "
+                      f"(was: {config[resource]})")
+                config[resource] = str(value)
+
+# jobs' own command wrapper (replaced by stage.py's, below)
+job_cmd_wrapper = config['cmd_wrapper']
+if as_bool(config['stage_data']):
+    # run jobs through stage.py, which copies their inputs to node-local
+    # scratch space (via a per-node cache) & their outputs back afterwards
+    config['cmd_wrapper'] = stage_wrapper(config)
+
+script_template = ScriptTemplate(jobscript_template, config)
+
+
+def _exit_on_signal(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+# so that submissions made before submit.py is stopped are still written to
+# the ledger (see script_template.release_locks, below)
+signal.signal(signal.SIGTERM, _exit_on_signal)
+signal.signal(signal.SIGHUP, _exit_on_signal)
+
+if as_bool(config['result_cache']):
+    # reuse the outputs of jobs that already ran with the same command,
+    # script, inputs & environment, and submit only the rest
+    # (staging doesn't change jobs' results, so isn't part of their keys)
+    result_cache = ResultCache(opj(config['workingdir'], 'result_cache'),
+                               {**config, 'cmd_wrapper': job_cmd_wrapper})
+    ledger = script_template.ledger
+    ledger.sync(config['workingdir'], job_name)
+    result_cache.store_finished(ledger)
+    job_states = {name: state for name, _, _, state, *_ in ledger.jobs()}
+
+    def uncached(cache_jobs):
+        for job_n, job_c in cache_jobs:
+            outputs = job_outputs.get(job_n, [])
+            cache_key = result_cache.job_key(job_c, job_inputs.get(job_n, []))
+            if result_cache.restore(cache_key, outputs):
+                print(f"[CACHED: {job_n}]")
+            elif (result_cache.is_pending(cache_key)
+                  and job_states.get(job_n) not in ('failed', 'written')):
+                # an identical job has already been submitted
+                continue
+            else:
+                result_cache.register(cache_key, job_n, outputs)
+                # jobs with out-of-date results are written & submitted
+                # again, even though they've been run before
+                ledger.forget([job_n])
+                old_script = opj(script_template.scriptdir, job_n)
+                if os.path.isfile(old_script):
+                    os.remove(old_script)
+                yield job_n, job_c
+
+    jobs = uncached(jobs)
+
+if as_bool(config['stage_data']):
+    # (after the result cache, whose keys are based on the jobs' own commands)
+    def staged(stage_jobs):
+        for job_n, job_c in stage_jobs:
+            yield job_n, staged_command(job_c, job_cmd_wrapper,
+                                        job_inputs.get(job_n, []),
+                                        job_outputs.get(job_n, []))
+
+    jobs = staged(jobs)
+    for stage in stages:
+        stage.jobs = staged(stage.jobs)
+
+if not as_bool(config['array_mode']):
+    array_jobscript_template = None
+bundle_template = None
+if as_bool(config['bundle_mode']) and not as_bool(config['array_mode']):
+    bundle_template = BUNDLE_JOBSCRIPT_TEMPLATE
+
+# jobs an earlier run of submit.py wrote but never submitted (e.g., because
+# it was interrupted) are submitted along with the new ones
+unsubmitted = {name for name, jobid, *_
+               in script_template.ledger.jobs(states=('written',))
+               if jobid is None}
+
+
+def new_jobs(all_jobs):
+    for job_n, job_c in all_jobs:
+        if not script_template.lock(job_n, job_c):
+            yield job_n, job_c
+        elif job_n in unsubmitted:
+            # rewritten, in case the command has changed
+            old_script = opj(script_template.scriptdir, job_n)
+            if os.path.isfile(old_script):
+                os.remove(old_script)
+            yield job_n, job_c
+
+
+try:
+    if stages:
+        # the jobs above are the pipeline's first stage.  Each stage's jobs
+        # are submitted unless they've already finished successfully (or are
+        # queued)
+        pipeline = Pipeline([Stage('crunch', jobs), *stages],
+                            pipeline_path(config['workingdir'], job_name))
+        pipeline.submit(script_template, array_jobscript_template,
+                        bundle_template)
+    else:
+        # jobs are generated, written & submitted one at a time (or one
+        # bundle at a time), so submission starts as soon as the first script
+        # is written.  The whole sweep is submitted as one job array (one
+        # scheduler transaction), in bundles, or one job at a time
+        script_template.submit_jobs(new_jobs(jobs), array_jobscript_template,
+                                    bundle_template)
+finally:
+    # writes the jobs claimed & submitted so far to the ledger, even if
+    # submission failed part way through
+    script_template.release_locks()
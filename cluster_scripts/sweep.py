@@ -0,0 +1,145 @@
+#!/usr/bin/python
+
+# lazy parameter grids for describing sweeps in submit.py.  Grids yield one
+# dict of parameter values per job and are never materialized in memory, so
+# jobs can be written & submitted as they're generated:
+#   grid = Product(alpha=[0.1, 0.5], seed=range(1000))   # every combination
+#   grid = Zip(x=xs, y=ys)                               # paired values
+#   grid = RandomSubset(grid, 100, seed=0)               # 100 random points
+#   jobs = sweep(grid, f'{job_name}_{{alpha}}_{{seed}}',
+#                f'{job_script} {{alpha}} {{seed}}')
+# Grids can be combined with + (one after the other)
+import itertools
+import random
+from abc import ABC, abstractmethod
+from math import prod
+
+
+class Grid(ABC):
+    """
+    Base class for parameter grids: iterables of {parameter: value} dicts.
+    len() is supported when the number of points is known in advance
+    """
+    @abstractmethod
+    def __iter__(self):
+        pass
+
+    def __add__(self, other):
+        return Chain(self, other)
+
+
+class Product(Grid):
+    """every combination of the given parameter values"""
+    def __init__(self, **params):
+        self.names = list(params)
+        self.values = [list(v) for v in params.values()]
+
+    def __len__(self):
+        return prod(len(v) for v in self.values)
+
+    def __iter__(self):
+        for combination in itertools.product(*self.values):
+            yield dict(zip(self.names, combination))
+
+    def __getitem__(self, ix):
+        # decodes a flat index (in iteration order) without iterating
+        point = {}
+        for name, values in zip(reversed(self.names), reversed(self.values)):
+            ix, value_ix = divmod(ix, len(values))
+            point[name] = values[value_ix]
+        return {name: point[name] for name in self.names}
+
+
+class Zip(Grid):
+    """
+    the i-th values of each parameter together.  Values may be generators;
+    the grid ends when the shortest one does
+    """
+    def __init__(self, **params):
+        self.params = params
+
+    def __len__(self):
+        return min(len(v) for v in self.params.values())
+
+    def __iter__(self):
+        names = list(self.params)
+        for values in zip(*self.params.values()):
+            yield dict(zip(names, values))
+
+
+class Chain(Grid):
+    """the points of several grids, one after the other"""
+    def __init__(self, *grids):
+        self.grids = grids
+
+    def __len__(self):
+        return sum(len(g) for g in self.grids)
+
+    def __iter__(self):
+        for grid in self.grids:
+            yield from grid
+
+
+class RandomSubset(Grid):
+    """
+    n points chosen at random (without replacement) from another grid.
+    Points are drawn directly from Product grids (in random order) and by
+    reservoir sampling from any other grid, so the full grid is never held
+    in memory
+    """
+    def __init__(self, grid, n, seed=None):
+        self.grid = grid
+        self.n = n
+        self.seed = seed
+
+    def __len__(self):
+        return min(self.n, len(self.grid))
+
+    def __iter__(self):
+        rng = random.Random(self.seed)
+        if isinstance(self.grid, Product):
+            for ix in rng.sample(range(len(self.grid)), len(self)):
+                yield self.grid[ix]
+            return
+        reservoir = []
+        for i, point in enumerate(self.grid):
+            if i < self.n:
+                reservoir.append(point)
+            else:
+                j = rng.randint(0, i)
+                if j < self.n:
+                    reservoir[j] = point
+        yield from reservoir
+
+
+class Sweep:
+    """
+    (job name, job command) pairs for each point in a grid, formatted from
+    the point's parameter values with str.format
+    """
+    def __init__(self, grid, name_format, command_format):
+        self.grid = grid
+        self.name_format = name_format
+        self.command_format = command_format
+
+    def __len__(self):
+        return len(self.grid)
+
+    def __iter__(self):
+        for point in self.grid:
+            yield (self.name_format.format(**point),
+                   self.command_format.format(**point))
+
+
+def sweep(grid, name_format, command_format):
+    """
+    returns a lazy sequence of (job name, job command) pairs, one per point in
+    grid (any iterable of {parameter: value} dicts)
+    :param grid: (iterable) e.g., a Product, Zip, or RandomSubset
+    :param name_format: (str) format string for job names, e.g.
+                        'myjob_{alpha}_{seed}'
+    :param command_format: (str) format string for job commands, e.g.
+                           '/path/to/cruncher.py {alpha} {seed}'
+    :return jobs: (Sweep) iterable of (job name, job command) pairs
+    """
+    return Sweep(grid, name_format, command_format)
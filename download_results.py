@@ -0,0 +1,247 @@
+import json
+import os
+import shlex
+import tarfile
+import time
+from argparse import ArgumentParser
+from os.path import dirname, basename, isfile, getsize, join as opj
+from ._helpers import (
+                        attempt_load_config,
+                        fmt_remote_commands,
+                        md5_checksum,
+                        parse_config,
+                        remote_md5sums
+                    )
+from .cluster_scripts.config import job_config
+from .session_broker import connect_to_cluster
+
+# kept in the local download directory; records each downloaded file's remote
+# size & mtime (to skip unchanged files) and local checksum
+MANIFEST_NAME = '.download_manifest.json'
+
+
+def list_remote_files(remote_shell, remote_dir, pattern='*'):
+    """
+    lists (non-hidden) files under remote_dir whose names match pattern, with
+    a single remote command
+    :return files: (dict) maps paths relative to remote_dir to (size, mtime)
+    """
+    cmd = fmt_remote_commands([
+        f'cd {shlex.quote(remote_dir)}',
+        f"find . -type f ! -path '*/.*' -name {shlex.quote(pattern)} "
+        f"-printf '%P\\t%s\\t%T@\\n'"
+    ])
+    files = {}
+    for line in remote_shell.check_output(cmd).splitlines():
+        if line:
+            path, size, mtime = line.rsplit('\t', 2)
+            files[path] = (int(size), float(mtime))
+    return files
+
+
+def load_manifest(manifest_path):
+    if isfile(manifest_path):
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+    return {}
+
+
+def save_manifest(manifest_path, manifest):
+    # written to a temporary file first so an interruption can't corrupt it
+    tmp_path = f'{manifest_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+
+def stream_download(transport, remote_dir, list_path, local_dir, remote_files,
+                    manifest_path, checkpoint_every=200):
+    """
+    downloads files as a single gzipped tar stream (built on the fly by tar on
+    the cluster) over one SSH channel, unpacking it locally as it arrives.
+    Each file is added to the manifest once it's been fully written, so if
+    the transfer is interrupted, the next download picks up where it stopped
+    :param transport: (paramiko.Transport) the connection to the cluster
+    :param remote_dir: (str) remote directory the files are relative to
+    :param list_path: (str) remote file listing the (null-separated) paths to
+                      download.  Removed once the transfer finishes
+    :param local_dir: (str) local directory to unpack files into
+    :param remote_files: (dict) maps paths to their remote (size, mtime)
+    :param manifest_path: (str) path to the local download manifest
+    :param checkpoint_every: (int, default: 200) save the manifest after this
+                             many files
+    :return: (tuple) number of files & number of bytes downloaded
+    """
+    tar_cmd = (f'cd {shlex.quote(remote_dir)} && '
+               f'tar --null -T {shlex.quote(list_path)} -czf -; '
+               f'status=$?; rm -f {shlex.quote(list_path)}; exit $status')
+    manifest = load_manifest(manifest_path)
+    n_files = n_bytes = 0
+    channel = transport.open_session()
+    try:
+        channel.exec_command(f'bash -c {shlex.quote(tar_cmd)}')
+        with channel.makefile('rb') as stream, \
+                tarfile.open(fileobj=stream, mode='r|gz') as archive:
+            for member in archive:
+                name = os.path.normpath(member.name)
+                if (not member.isfile() or os.path.isabs(name)
+                        or name.startswith('..')):
+                    continue
+                local_path = opj(local_dir, name)
+                os.makedirs(dirname(local_path), exist_ok=True)
+                # unpack to a temporary file so partially downloaded files
+                # are never mistaken for complete ones
+                tmp_path = opj(dirname(local_path),
+                               f'.{basename(local_path)}.part')
+                with archive.extractfile(member) as src, \
+                        open(tmp_path, 'wb') as dest:
+                    for chunk in iter(lambda: src.read(1 << 20), b''):
+                        dest.write(chunk)
+                os.replace(tmp_path, local_path)
+                os.utime(local_path, (member.mtime, member.mtime))
+
+                size, mtime = remote_files.get(member.name,
+                                               (member.size, member.mtime))
+                manifest[member.name] = {'size': size, 'mtime': mtime,
+                                         'md5': md5_checksum(local_path)}
+                n_files += 1
+                n_bytes += member.size
+                if n_files % checkpoint_every == 0:
+                    save_manifest(manifest_path, manifest)
+                    print(f"downloaded {n_files} files...")
+        exit_status = channel.recv_exit_status()
+        if exit_status != 0:
+            # e.g., a file was removed after being listed.  Everything else
+            # was still downloaded, and anything missed is retried next time
+            stderr = channel.makefile_stderr('rb').read().decode()
+            print(f"remote tar exited with status {exit_status}: "
+                  f"{stderr.strip()}")
+    finally:
+        channel.close()
+        save_manifest(manifest_path, manifest)
+    return n_files, n_bytes
+
+
+def download_results(remote_shell, local_dir, job_conf, remote_dir=None,
+                     pattern='*', verify=True):
+    """
+    downloads new & changed result files from the cluster in a single
+    compressed stream.  Files whose remote size & modification time match the
+    manifest from a previous download (and whose local copies still exist)
+    are skipped
+
+    :param remote_shell: (spurplus.SshShell instance)
+    :param local_dir: (str) local directory to download files into
+    :param job_conf: (dict-like) options from cluster_scripts/config.ini
+    :param remote_dir: (str, optional) remote directory to download from.
+    Defaults to the remote datadir
+    :param pattern: (str, default: '*') only download files whose names match
+    this glob pattern
+    :param verify: (bool, default: True) if True, compare downloaded files'
+    checksums against the remote copies (with a single remote command).
+    Files that don't match are downloaded again next time
+    :return: None
+    """
+    if remote_dir is None:
+        remote_dir = job_conf['datadir']
+    os.makedirs(local_dir, exist_ok=True)
+    manifest_path = opj(local_dir, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+
+    remote_files = list_remote_files(remote_shell, remote_dir, pattern)
+    to_download = []
+    for path, (size, mtime) in sorted(remote_files.items()):
+        entry = manifest.get(path)
+        local_path = opj(local_dir, path)
+        if (entry is not None and entry['size'] == size
+                and entry['mtime'] == mtime and isfile(local_path)
+                and getsize(local_path) == size):
+            continue
+        to_download.append(path)
+
+    n_skipped = len(remote_files) - len(to_download)
+    if not to_download:
+        print(f"all {n_skipped} files are up to date")
+        return
+
+    print(f"downloading {len(to_download)} files ({n_skipped} unchanged)...")
+    list_path = opj(job_conf['workingdir'], f'.download_list_{os.getpid()}')
+    remote_shell.write_text(list_path, '\0'.join(to_download))
+    start_time = time.time()
+    if hasattr(remote_shell, 'stream_download'):
+        # connected through a session broker, which unpacks the stream
+        n_files, n_bytes = remote_shell.stream_download(
+            remote_dir, list_path, local_dir, remote_files, manifest_path
+        )
+    else:
+        transport = remote_shell.as_spur()._get_ssh_transport()
+        n_files, n_bytes = stream_download(transport, remote_dir, list_path,
+                                           local_dir, remote_files,
+                                           manifest_path)
+    elapsed = max(time.time() - start_time, 1e-6)
+
+    if verify:
+        manifest = load_manifest(manifest_path)
+        remote_checksums = remote_md5sums(remote_shell, remote_dir,
+                                          to_download)
+        mismatched = [f for f in to_download if f in manifest
+                      and manifest[f]['md5'] != remote_checksums.get(f)]
+        for f in mismatched:
+            # e.g., the file was still being written when it was downloaded
+            print(f"checksum mismatch for {f}; it will be downloaded again")
+            del manifest[f]
+        save_manifest(manifest_path, manifest)
+
+    print(f"finished downloading results: {n_files} files "
+          f"({n_bytes / elapsed / 1024:.1f} KB/s), {n_skipped} skipped")
+
+
+if __name__ == '__main__':
+    description = "Download new & changed result files from the cluster"
+    arg_parser = ArgumentParser(description=description)
+    arg_parser.add_argument(
+        "local_dir",
+        type=str,
+        help="Local directory to download files into"
+    )
+    arg_parser.add_argument(
+        "--remote-dir",
+        default=None,
+        type=str,
+        help="Remote directory to download from (defaults to the datadir in \
+        your job config)"
+    )
+    arg_parser.add_argument(
+        "--pattern",
+        default='*',
+        type=str,
+        help="Only download files whose names match this pattern"
+    )
+    arg_parser.add_argument(
+        "--no-verify",
+        action='store_true',
+        help="Skip comparing downloaded files' checksums with the remote \
+        copies"
+    )
+    arg_parser.add_argument(
+        "--config-path",
+        default=None,
+        type=str,
+        help="Path to your config file (optional unless you've moved your \
+        config file)"
+    )
+    args = arg_parser.parse_args()
+
+    if args.config_path is None:
+        config = attempt_load_config()
+    else:
+        config = parse_config(args.config_path)
+
+    with connect_to_cluster(
+        hostname=config['hostname'],
+        username=config['username'],
+        password=config['password']
+    ) as cluster:
+        download_results(cluster, args.local_dir, job_config,
+                         remote_dir=args.remote_dir, pattern=args.pattern,
+                         verify=not args.no_verify)
@@ -0,0 +1,184 @@
+#!/usr/bin/python
+
+# a stand-in for the PBS scheduler's command line tools, used by benchmark.py
+# to measure submission throughput without using real cluster time.
+# install_fake_pbs writes qsub, mksub, qselect & qstat executables (which call
+# this script) to a directory to put at the front of the PATH.  Behavior is
+# set with environment variables:
+#   FAKE_PBS_DIR        directory holding the fake scheduler's state
+#   FAKE_PBS_LATENCY    seconds each command takes to respond (default: 0)
+#   FAKE_PBS_FAIL_RATE  fraction of jobs that fail (default: 0)
+#   FAKE_PBS_OUTDIR     where job output files are written (default: the
+#                       directory qsub is run from, as with PBS)
+# Submitted jobs "run" instantly: qsub writes each job's stdout/stderr files
+# (in the same format as the job script templates) before returning.  Failed
+# jobs are cut off before finishing, as if they'd been killed
+import fcntl
+import getpass
+import os
+import random
+import re
+import sys
+import time
+from os.path import join as opj
+
+SERVER = 'fakepbs'
+JOBS_FILE = 'jobs.tsv'
+
+
+def install_fake_pbs(bin_dir):
+    """
+    writes fake qsub, mksub, qselect & qstat executables to bin_dir
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    script_path = os.path.realpath(__file__)
+    for command in ('qsub', 'mksub', 'qselect', 'qstat'):
+        path = opj(bin_dir, command)
+        with open(path, 'w') as f:
+            f.write(f'#!/bin/sh\nexec {sys.executable} {script_path} '
+                    f'{command} "$@"\n')
+        os.chmod(path, 0o755)
+
+
+def _state_dir():
+    state_dir = os.environ.get('FAKE_PBS_DIR',
+                               opj(os.path.expanduser('~'), '.fake_pbs'))
+    os.makedirs(state_dir, exist_ok=True)
+    return state_dir
+
+
+def _respond():
+    time.sleep(float(os.environ.get('FAKE_PBS_LATENCY', 0)))
+
+
+def _next_job_number(state_dir):
+    with open(opj(state_dir, 'counter'), 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        job_number = int(f.read().strip() or 0) + 1
+        f.seek(0)
+        f.truncate()
+        f.write(str(job_number))
+    return job_number
+
+
+def _expand_range(array_range):
+    indices = []
+    for part in array_range.split('%')[0].split(','):
+        start, _, end = part.partition('-')
+        indices.extend(range(int(start), int(end or start) + 1))
+    return indices
+
+
+def _read_manifest(path):
+    with open(path, 'r') as f:
+        return [line.split('\t', 1)[0] for line in f if line.strip()]
+
+
+def _write_output(outdir, job_name, out_id, script_names, fail_rate):
+    sections = []
+    failed = False
+    for script_name in script_names:
+        if random.random() < fail_rate:
+            # killed partway through, so the job never finishes
+            sections.append(f'---\nscript name: {script_name}\n'
+                            f'calling job script\n')
+            failed = True
+            break
+        sections.append(f'---\nscript name: {script_name}\n'
+                        f'calling job script\nexit status: 0\n'
+                        f'job script finished\n---\n')
+    with open(opj(outdir, f'{job_name}.o{out_id}'), 'w') as f:
+        f.write(''.join(sections))
+    with open(opj(outdir, f'{job_name}.e{out_id}'), 'w') as f:
+        if failed:
+            f.write('=>> PBS: job killed: walltime exceeded limit\n')
+
+
+def qsub(args):
+    _respond()
+    array_range = None
+    if '-t' in args:
+        array_range = args[args.index('-t') + 1]
+    script_path = args[-1]
+    with open(script_path, 'r') as f:
+        script = f.read()
+
+    name_match = re.search(r'^#PBS -N (\S+)', script, re.M)
+    job_name = name_match.group(1) if name_match else 'STDIN'
+    if array_range is None:
+        range_match = re.search(r'^#PBS -t (\S+)', script, re.M)
+        array_range = range_match.group(1) if range_match else None
+
+    # job names come from the script itself, or from the manifest that
+    # array & bundle scripts read them from
+    manifest_match = re.search(r'(\S+\.tsv)', script)
+    names = (_read_manifest(manifest_match.group(1)) if manifest_match
+             else re.findall(r'^echo script name: (\S+)', script, re.M))
+
+    state_dir = _state_dir()
+    outdir = os.environ.get('FAKE_PBS_OUTDIR', os.getcwd())
+    fail_rate = float(os.environ.get('FAKE_PBS_FAIL_RATE', 0))
+    owner = getpass.getuser()
+    job_number = _next_job_number(state_dir)
+
+    records = []
+    if array_range is None:
+        jobid = f'{job_number}.{SERVER}'
+        _write_output(outdir, job_name, job_number, names, fail_rate)
+        records.append(f'{jobid}\t{job_name}\t{owner}\tC\n')
+    else:
+        jobid = f'{job_number}[].{SERVER}'
+        for ix in _expand_range(array_range):
+            _write_output(outdir, job_name, f'{job_number}-{ix}',
+                          names[ix:ix + 1], fail_rate)
+            records.append(f'{job_number}[{ix}].{SERVER}\t{job_name}-{ix}\t'
+                           f'{owner}\tC\n')
+    with open(opj(state_dir, JOBS_FILE), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.writelines(records)
+    print(jobid)
+
+
+def _read_jobs():
+    path = opj(_state_dir(), JOBS_FILE)
+    if not os.path.isfile(path):
+        return []
+    with open(path, 'r') as f:
+        return [line.rstrip('\n').split('\t') for line in f if line.strip()]
+
+
+def qselect(args):
+    _respond()
+    owner = args[args.index('-u') + 1] if '-u' in args else None
+    name = args[args.index('-N') + 1] if '-N' in args else None
+    for jobid, job_name, job_owner, _ in _read_jobs():
+        if (owner is None or owner == job_owner) \
+                and (name is None or name == job_name):
+            print(jobid)
+
+
+def qstat(args):
+    _respond()
+    ids = {a for a in args if not a.startswith('-')}
+    jobs = [j for j in _read_jobs() if not ids or j[0] in ids]
+    xml = ['<?xml version="1.0"?><Data>']
+    for jobid, job_name, owner, state in jobs:
+        xml.append(f'<Job><Job_Id>{jobid}</Job_Id>'
+                   f'<Job_Name>{job_name}</Job_Name>'
+                   f'<Job_Owner>{owner}@{SERVER}</Job_Owner>'
+                   f'<job_state>{state}</job_state></Job>')
+    xml.append('</Data>')
+    print(''.join(xml))
+
+
+if __name__ == '__main__':
+    command, *command_args = sys.argv[1:]
+    if command in ('qsub', 'mksub'):
+        qsub(command_args)
+    elif command == 'qselect':
+        qselect(command_args)
+    elif command == 'qstat':
+        qstat(command_args)
+    else:
+        sys.exit(f"fake_pbs: unsupported command: {command}")
@@ -0,0 +1,258 @@
+import asyncio
+import time
+from argparse import ArgumentParser
+from collections import Counter, deque
+from datetime import timedelta
+from .cluster_scripts.config import job_config
+from .cluster_scripts.ledger import stdout_id
+from .session_broker import connect_to_cluster
+from ._helpers import (
+                        attempt_load_config,
+                        get_job_statuses,
+                        parse_config,
+                        read_ledger
+                    )
+
+
+def ledger_progress(records):
+    """
+    summarizes a sweep's progress from its job ledger, in the form
+    SweepMonitor's poll_outputs returns
+    :param records: (list) LedgerRecord records (see _helpers.read_ledger)
+    :return progress: (tuple) # jobs in sweep, # finished successfully &
+                      stdout ids of jobs submitted that haven't
+    """
+    # jobs that exited non-zero are "failed" in the ledger
+    finished = len([r for r in records if r.state == 'finished'])
+    unfinished = [r.stdout_id for r in records
+                  if r.state in ('submitted', 'running', 'failed')]
+    return len(records), finished, unfinished
+
+
+class SweepMonitor:
+    """
+    Watches the progress of one or more sweeps (sets of jobs sharing a job
+    name).  Each round, the scheduler and every sweep's output directory are
+    polled concurrently.  The polling interval starts at min_interval, grows
+    (up to max_interval) while nothing changes, and resets when something
+    does.
+
+    The polling functions are passed in so a fake scheduler can stand in for
+    the cluster:
+    :param poll_scheduler: (callable) takes no arguments and returns a dict
+                           mapping jobids to JobStatus records
+    :param poll_outputs: (callable) takes a job name and returns a tuple of
+                         (# jobs in sweep, # finished successfully, stdout
+                         ids (see cluster_scripts/ledger.stdout_id) of jobs
+                         submitted that haven't).  Those still in the queue
+                         are running, the rest failed (see ledger_progress)
+    :param job_names: (list) names of the sweeps to watch
+    """
+    def __init__(self, poll_scheduler, poll_outputs, job_names,
+                 min_interval=10, max_interval=300, backoff=1.5,
+                 rate_window=600):
+        self.poll_scheduler = poll_scheduler
+        self.poll_outputs = poll_outputs
+        self.job_names = list(job_names)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.rate_window = rate_window
+        self.interval = min_interval
+        self.start_time = time.time()
+        # (time, # finished) samples used to estimate throughput
+        self.history = {name: deque() for name in self.job_names}
+        # consecutive polls in which a sweep had no jobs in the queue
+        self.idle_polls = Counter()
+        self.idle_limit = 3
+        self.progress = {}
+
+    def _sweep_states(self, statuses, job_name):
+        # tasks of job arrays are named "<job name>-<array index>"
+        return Counter(s.state for s in statuses.values()
+                       if s.name == job_name
+                       or (s.name or '').startswith(f'{job_name}-'))
+
+    def _rate(self, job_name):
+        """completed jobs per second over the last rate_window seconds"""
+        samples = self.history[job_name]
+        if len(samples) < 2 or samples[-1][0] == samples[0][0]:
+            return 0
+        (t0, finished0), (t1, finished1) = samples[0], samples[-1]
+        return (finished1 - finished0) / (t1 - t0)
+
+    async def poll(self):
+        """
+        polls the scheduler & all sweeps' outputs concurrently and returns a
+        dict mapping job names to progress summaries
+        """
+        loop = asyncio.get_running_loop()
+        scheduler_poll = loop.run_in_executor(None, self.poll_scheduler)
+        output_polls = [loop.run_in_executor(None, self.poll_outputs, name)
+                        for name in self.job_names]
+        statuses, *outputs = await asyncio.gather(scheduler_poll,
+                                                  *output_polls)
+        queued_ids = {stdout_id(s.jobid, s.array_index)
+                      for s in statuses.values() if s.state != 'C'}
+
+        now = time.time()
+        progress = {}
+        for job_name, (total, finished, unfinished) in zip(self.job_names,
+                                                           outputs):
+            failed = len([out_id for out_id in unfinished
+                          if out_id not in queued_ids])
+            samples = self.history[job_name]
+            samples.append((now, finished))
+            while samples[0][0] < now - self.rate_window:
+                samples.popleft()
+
+            states = self._sweep_states(statuses, job_name)
+            rate = self._rate(job_name)
+            remaining = max(total - finished - failed, 0)
+            eta = None
+            if rate > 0:
+                eta = timedelta(seconds=int(remaining / rate))
+            queued = any(states.get(s) for s in ('Q', 'R', 'H', 'W', 'E'))
+            if queued:
+                self.idle_polls[job_name] = 0
+            else:
+                self.idle_polls[job_name] += 1
+            progress[job_name] = {
+                'total': total,
+                'finished': finished,
+                'failed': failed,
+                'states': dict(states),
+                'rate': rate,
+                'eta': eta,
+                # nothing left in the queue for this sweep, and either every
+                # job has output or it's stayed that way for a few polls
+                # (e.g., jobs that were deleted before writing any output)
+                'done': (total > 0 and not queued
+                         and (finished + failed >= total
+                              or self.idle_polls[job_name] >= self.idle_limit))
+            }
+        return progress
+
+    def report(self, progress):
+        stamp = time.strftime('%H:%M:%S')
+        for job_name, p in progress.items():
+            states = ' '.join(f'{s}:{n}'
+                              for s, n in sorted(p['states'].items()))
+            eta = p['eta'] if p['eta'] is not None else '--'
+            print(f"[{stamp}] {job_name}: {p['finished']}/{p['total']} "
+                  f"finished, {p['failed']} failed | "
+                  f"{states or 'no jobs queued'} | "
+                  f"{p['rate'] * 60:.1f} jobs/min | ETA {eta}")
+
+    def summary(self):
+        elapsed = timedelta(seconds=int(time.time() - self.start_time))
+        print(f"all sweeps finished (monitored for {elapsed})")
+        for job_name, p in self.progress.items():
+            print(f"  {job_name}: {p['finished']} finished, {p['failed']} "
+                  f"failed, {p['total']} total")
+
+    async def run(self):
+        while True:
+            progress = await self.poll()
+            # throughput & ETA estimates don't count as progress
+            changed = any(
+                {k: p[k] for k in ('total', 'finished', 'failed', 'states')}
+                != {k: self.progress.get(name, {}).get(k)
+                    for k in ('total', 'finished', 'failed', 'states')}
+                for name, p in progress.items()
+            )
+            self.progress = progress
+            self.report(progress)
+            if all(p['done'] for p in progress.values()):
+                self.summary()
+                return progress
+
+            if changed:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * self.backoff,
+                                    self.max_interval)
+            await asyncio.sleep(self.interval)
+
+
+def monitor(job_names=None, config_path=None, min_interval=10,
+            max_interval=300):
+    """
+    watches the progress of submitted sweeps from your local machine until
+    all of their jobs have left the queue
+
+    :param job_names: (list, optional) names of the sweeps (job names) to
+    watch.  Defaults to the jobname set in cluster_scripts/config.ini
+    :param config_path: (str, optional, default: None) path to your config file
+    :param min_interval: (int, default: 10) shortest time between polls, in
+    seconds
+    :param max_interval: (int, default: 300) longest time between polls, in
+    seconds
+    :return progress: (dict) final progress summary for each sweep
+    """
+    if config_path is None:
+        config = attempt_load_config()
+    else:
+        config = parse_config(config_path)
+
+    hostname = config['hostname']
+    username = config['username']
+    password = config['password']
+    workingdir = job_config['workingdir']
+    if job_names is None:
+        job_names = [job_config['jobname']]
+
+    with connect_to_cluster(
+            hostname=hostname,
+            username=username,
+            password=password
+    ) as cluster:
+        def poll_scheduler():
+            # a single qstat call covers every sweep
+            return get_job_statuses(cluster, owner=username)
+
+        def poll_outputs(job_name):
+            # syncing the ledger only reads the output of jobs that hadn't
+            # finished or failed by the last poll, rather than rescanning
+            # every job's output each time
+            return ledger_progress(read_ledger(cluster, workingdir, job_name))
+
+        sweep_monitor = SweepMonitor(poll_scheduler, poll_outputs, job_names,
+                                     min_interval=min_interval,
+                                     max_interval=max_interval)
+        return asyncio.run(sweep_monitor.run())
+
+
+if __name__ == '__main__':
+    description = "Watch the progress of jobs submitted to the cluster"
+    arg_parser = ArgumentParser(description=description)
+    arg_parser.add_argument(
+        "--job-names",
+        nargs='+',
+        default=None,
+        help="Names of the sweeps to watch (defaults to the jobname in your \
+        job config)"
+    )
+    arg_parser.add_argument(
+        "--config-path",
+        default=None,
+        type=str,
+        help="Path to your config file (optional unless you've moved your \
+        config file)"
+    )
+    arg_parser.add_argument(
+        "--min-interval",
+        default=10,
+        type=int,
+        help="Shortest time (in seconds) between polls"
+    )
+    arg_parser.add_argument(
+        "--max-interval",
+        default=300,
+        type=int,
+        help="Longest time (in seconds) between polls"
+    )
+
+    args = arg_parser.parse_args()
+    monitor(args.job_names, args.config_path, args.min_interval,
+            args.max_interval)
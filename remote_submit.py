@@ -1,17 +1,53 @@
+import json
 from argparse import ArgumentParser
-from os.path import dirname, realpath, join as opj
-from spurplus import connect_with_retries
+from os.path import basename, dirname, realpath, join as opj
+from subprocess import CalledProcessError
 from .upload_scripts import upload_scripts
 from .cluster_scripts.config import job_config
+from .cluster_scripts.job_scripts import SUBMISSION_PREFIX
+from .session_broker import connect_to_cluster
 from ._helpers import (
                         attempt_load_config,
                         fmt_remote_commands,
                         parse_config,
+                        stream_lines,
                         write_remote_submitter
                     )
 
 
-def remote_submit(sync_changes=False, config_path=None):
+def direct_submit(remote_shell, job_config, activate_cmd):
+    """
+    runs submit.py on the login node in a single remote command, rather than
+    in a submitter job that has to wait in the queue before the sweep can
+    start.  Yields (job name, jobid) for each job as soon as it's submitted
+    (jobid is None if its submission failed); submit.py's other output is
+    printed as it arrives.  Raises CalledProcessError if submit.py fails
+
+    :param remote_shell: (spurplus.SshShell instance)
+    :param job_config: (dict-like) options from cluster_scripts/config.ini
+    :param activate_cmd: (str) command that activates the environment
+    """
+    # the cluster scripts are uploaded to workingdir, so submit.py is run as
+    # a module of the package it makes
+    workingdir = job_config['workingdir'].rstrip('/')
+    commands = [
+        f"module load {job_config['modules']}",
+        f"{activate_cmd} {job_config['env_name']}",
+        f"cd {dirname(workingdir)}",
+        f"python -m {basename(workingdir)}.submit"
+    ]
+    # (a login shell, so "module" is defined, as in job scripts)
+    remote_command = ['bash', '-l', '-c', ' && '.join(commands)]
+    for line in stream_lines(remote_shell, remote_command):
+        if line.startswith(SUBMISSION_PREFIX):
+            submission = json.loads(line[len(SUBMISSION_PREFIX):])
+            for job_name in submission['job_names']:
+                yield job_name, submission['jobid']
+        else:
+            print(line)
+
+
+def remote_submit(sync_changes=False, config_path=None, direct=False):
     """
     main function that handles submitting jobs on the cluster from your local
     machine
@@ -21,6 +57,9 @@ def remote_submit(sync_changes=False, config_path=None):
     :param config_path: (str, optional, default: None) path to your config file.
     If you created your config following the instructions in
     configs/template_config.ini, you can simply leave this empty
+    :param direct: (bool, default: False) if True, submit jobs from the login
+    node in a single remote command (see direct_submit) rather than from a
+    submitter job, falling back to a submitter job if that fails
     :return: None (other than some hopefully some results, eventually!)
     """
     if config_path is None:
@@ -46,7 +85,7 @@ def remote_submit(sync_changes=False, config_path=None):
         # TODO: add commands for venv & virtualenv activation
         raise ValueError("Only conda environments are currently supported")
 
-    with connect_with_retries(
+    with connect_to_cluster(
                             hostname=hostname,
                             username=username,
                             password=password
@@ -56,6 +95,29 @@ def remote_submit(sync_changes=False, config_path=None):
             script_dir = opj(dirname(realpath(__file__)), 'cluster_scripts')
             upload_scripts(cluster, script_dir, job_config, confirm_overwrite)
 
+        if direct:
+            n_submitted = n_failed = 0
+            try:
+                for job_name, jobid in direct_submit(cluster, job_config,
+                                                     activate_cmd):
+                    if jobid is None:
+                        n_failed += 1
+                        print(f"[FAILED TO SUBMIT: {job_name}]")
+                    else:
+                        n_submitted += 1
+                        print(f"[SUBMITTED: {job_name} -> {jobid}]")
+                print(f"submitted {n_submitted} jobs ({n_failed} failed)")
+                return
+            except CalledProcessError as e:
+                if e.stderr:
+                    print(e.stderr)
+                # submit.py writes the jobs it submitted to the ledger even
+                # if it fails part way through, so the submitter job only
+                # submits the rest (including any whose scripts were written
+                # but not submitted)
+                print(f"direct submission failed after submitting "
+                      f"{n_submitted} jobs; falling back to a submitter job")
+
         # create bash script to submit and run submit.py from compute node
         submitter_filepath = write_remote_submitter(
                                                     cluster,
@@ -81,6 +143,13 @@ if __name__ == '__main__':
         action='store_true',
         help="Update remote files with local changes before submitting"
     )
+    arg_parser.add_argument(
+        "--direct",
+        action='store_true',
+        help="Submit jobs from the login node in a single command instead of \
+        queueing a submitter job to do it (falls back to a submitter job if \
+        that fails)"
+    )
     arg_parser.add_argument(
         "--config-path",
         default=None,
@@ -90,4 +159,4 @@ if __name__ == '__main__':
     )
 
     args = arg_parser.parse_args()
-    remote_submit(args.sync_changes, args.config_path)
+    remote_submit(args.sync_changes, args.config_path, args.direct)
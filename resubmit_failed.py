@@ -1,19 +1,75 @@
+import json
 import sys
 from argparse import ArgumentParser
+from collections import Counter
 from os.path import join as opj
-from spurplus import connect_with_retries
-from .cluster_scripts.config import job_config
+from .cluster_scripts.classify_failures import RETRYABLE
+from .cluster_scripts.config import job_config, as_bool
+from .cluster_scripts.pipeline import pipeline_path
+from .session_broker import connect_to_cluster
 from ._helpers import (
                         attempt_load_config,
-                        fmt_remote_commands,
-                        get_qstat,
+                        bulk_submit,
+                        fmt_array_indices,
                         parse_config,
-                        prompt_input
+                        prompt_input,
+                        read_ledger,
+                        read_resource_report
                     )
 
 
-def resubmit_failed(confirm_resubmission=False, config_path=None):
-    # TODO: add docstring
+def summarize_failures(failed_jobs, max_retries, n_reasons=5):
+    """
+    prints how many failed jobs fall into each class (see
+    cluster_scripts/classify_failures.py) & their most common reasons, and
+    returns the jobs that should be resubmitted: those whose failures were
+    transient or due to running out of resources, and that haven't already
+    been retried max_retries times
+    """
+    by_class = {}
+    for job in failed_jobs:
+        # (jobs failed before failures were classified count as transient)
+        by_class.setdefault(job.failure_class or 'transient', []).append(job)
+
+    to_retry = []
+    print(f"found {len(failed_jobs)} failed jobs")
+    for failure_class, class_jobs in sorted(by_class.items()):
+        if failure_class in RETRYABLE:
+            retryable = [j for j in class_jobs if j.attempts <= max_retries]
+            to_retry.extend(retryable)
+            action = (f"{len(retryable)} to resubmit, "
+                      f"{len(class_jobs) - len(retryable)} over retry limit")
+        else:
+            action = "not resubmitted"
+        print(f"  {failure_class}: {len(class_jobs)} ({action})")
+        reasons = Counter(j.failure_reason for j in class_jobs)
+        for reason, count in reasons.most_common(n_reasons):
+            example = next(j.job_name for j in class_jobs
+                           if j.failure_reason == reason)
+            print(f"      {count} x {reason or 'unknown'} (e.g., {example})")
+    return to_retry
+
+
+def read_pipeline_jobs(remote_shell, workingdir, job_name):
+    """
+    returns the names of the jobs in the stages of the pipeline last
+    submitted from workingdir (see cluster_scripts/pipeline.py), if any
+    """
+    state_path = pipeline_path(workingdir, job_name)
+    if not remote_shell.exists(state_path):
+        return set()
+    stages = json.loads(remote_shell.read_text(state_path))['stages']
+    return {name for stage in stages for name in stage['job_names']}
+
+
+def resubmit_failed(confirm_resubmission=False, config_path=None,
+                    max_retries=None):
+    """
+    resubmits jobs that failed for transient reasons or by running out of
+    walltime/memory, up to max_retries times each (default: max_retries in
+    config.ini).  Jobs that failed deterministically (e.g., with an
+    exception) are reported but not resubmitted
+    """
 
     if config_path is None:
         config = attempt_load_config()
@@ -26,7 +82,6 @@ def resubmit_failed(confirm_resubmission=False, config_path=None):
     confirm = config['confirm_resubmission']
 
     workingdir = job_config['workingdir']
-    scriptdir = job_config['scriptdir']
     job_name = job_config['jobname']
 
     # set confirmation option from config if not set here
@@ -39,78 +94,122 @@ def resubmit_failed(confirm_resubmission=False, config_path=None):
     else:
         job_cmd = 'qsub'
 
-    with connect_with_retries(
+    with connect_to_cluster(
             hostname=hostname,
             username=username,
             password=password
     ) as cluster:
-        cluster_sftp = cluster.as_sftp()
-
-        # get all created bash scripts
-        all_scripts = cluster_sftp.listdir(scriptdir)
-        print(f"found {len(all_scripts)} job scripts")
-
-        stdout_files = [f for f in cluster_sftp.listdir(workingdir)
-                        if f.startswith(f'{job_name}.o')]
-        print(f"found {len(stdout_files)} job stdout files")
-
-        # get output of qstat command
-        running_jobs = [line for line in get_qstat(cluster)
-                        if len(line) > 0 and line[0].isnumeric()]
-        # filter out completed jobs, isolate jobid
-        running_jobids = [line.split('.')[0] for line in running_jobs
-                          if line.split()[-2] != 'C']
-        print(f"found {len(running_jobids)} running jobs")
-
-        print("parsing stdout files...")
-
-        successful_jobs = {}
-        for outfile in stdout_files:
-            jobid = outfile.split('.o')[1]
-
-            # read stdout file
-            stdout_path = opj(workingdir, outfile)
-            stdout = cluster.read_text(stdout_path)
-            try:
-                job_script = stdout.split('script name: ')[1].splitlines()[0]
-                # track successfully finished jobs
-                if 'job script finished' in stdout:
-                    successful_jobs[job_script] = jobid
-            except (IndexError, ValueError):
-                print(
-                    f"failed to find corresponding script for {outfile}..."
-                    )
-                continue
-
-        to_resubmit = [s for s in all_scripts
-                       if s not in list(successful_jobs.keys())]
+        # update the state of queued & running jobs in the job ledger, then
+        # read the state of every job
+        jobs = read_ledger(cluster, workingdir, job_name, sync=True)
+        print(f"found {len(jobs)} jobs in ledger")
+        n_running = len([j for j in jobs
+                         if j.state in ('submitted', 'running')])
+        print(f"found {n_running} queued or running jobs")
+
+        # a pipeline's jobs must be resubmitted with their dependencies on
+        # the stages before them (and the stages after them rerun), which
+        # submit.py does
+        pipeline_jobs = read_pipeline_jobs(cluster, workingdir, job_name)
+        failed_jobs = [j for j in jobs if j.state == 'failed']
+        n_pipeline_failed = len([j for j in failed_jobs
+                                 if j.job_name in pipeline_jobs])
+        if n_pipeline_failed:
+            print(f"{n_pipeline_failed} failed jobs are in pipeline stages; "
+                  f"run submit.py again to resubmit them")
+            failed_jobs = [j for j in failed_jobs
+                           if j.job_name not in pipeline_jobs]
+
+        if max_retries is None:
+            max_retries = int(job_config['max_retries'])
+        retry_jobs = summarize_failures(failed_jobs, max_retries)
+        # output files of jobs that aren't resubmitted are left in place
+        resubmitted = {j.job_name for j in retry_jobs}
+
+        # jobs killed for exceeding their walltime (or memory) are given
+        # more; the rest request what finished jobs have needed, if enabled
+        resources = read_resource_report(cluster, workingdir, job_name,
+                                         job_config['resource_margin'])
+        base_request = {}
+        recommended = resources['recommended']
+        if as_bool(job_config['right_size']) and recommended is not None:
+            base_request['walltime'] = recommended['walltime']
+            if recommended['mem'] is not None:
+                base_request['mem'] = recommended['mem']
+            if recommended['ppn'] is not None:
+                base_request['nodes'] = (f"{job_config['nnodes']}:"
+                                         f"ppn={recommended['ppn']}")
+        print(f"{len(resources['escalated'])} jobs were killed for exceeding "
+              f"a resource limit and will be given more")
+
+        def resource_options(job):
+            request = dict(base_request)
+            escalated = resources['escalated'].get(job.job_name)
+            if escalated is not None:
+                resource, value = escalated.split('=', 1)
+                request[resource] = value
+            if not request:
+                return []
+            return ['-l', ','.join(f'{resource}={value}'
+                                   for resource, value in request.items())]
+
+        to_resubmit = [j for j in retry_jobs if j.array_index is None]
+        # job array tasks are resubmitted by index, grouped by array script
+        # (and by the resources they'll request)
+        array_to_resubmit = {}
+        for job in retry_jobs:
+            if job.array_index is not None:
+                group = (job.script_path, tuple(resource_options(job)))
+                array_to_resubmit.setdefault(group, []).append(job)
 
         if confirm_resubmission:
             view_scripts = prompt_input("View jobs to be resubmitted before \
                                         proceeding?")
             if view_scripts:
-                print('\n'.join(to_resubmit))
+                print('\n'.join(j.job_name for j in retry_jobs))
                 resubmit_confirmed = prompt_input("Do you want to resubmit \
                                                     these jobs?")
                 if not resubmit_confirmed:
                     sys.exit()
 
-        print("Removing failed jobs' stdout/stderr files...")
-        for outfile in stdout_files:
-            jobid = outfile.split('.o')[1]
-            if not (jobid in successful_jobs.values()
-                    or jobid in running_jobids):
-                stdout_path = opj(workingdir, outfile)
-                stderr_path = opj(workingdir, f'{job_name}.e{jobid}')
-                cluster.remove(stdout_path)
-                cluster.remove(stderr_path)
-
-        print(f"resubmitting {len(to_resubmit)} jobs")
-        for job in to_resubmit:
-            script_path = opj(scriptdir, job)
-            print(f"resubmitting {job}")
-            cmd = fmt_remote_commands([f'{job_cmd} {script_path}'])
-            cluster.run(cmd)
+        # bundled jobs share output files with jobs that may not have failed
+        keep_ids = {j.stdout_id for j in jobs
+                    if j.job_name not in resubmitted}
+        remove_ids = {j.stdout_id for j in retry_jobs if j.stdout_id}
+        stale_outputs = [opj(workingdir, f'{job_name}.{stream}{out_id}')
+                         for out_id in sorted(remove_ids - keep_ids)
+                         for stream in ('o', 'e')]
+
+        submissions = [{'script_path': job.script_path,
+                        'job_names': [job.job_name],
+                        'array_indices': None,
+                        'options': resource_options(job)}
+                       for job in to_resubmit]
+        slot_limit = job_config['array_slot_limit']
+        for (array_script, options), tasks in array_to_resubmit.items():
+            # resubmit only the failed indices, as a single array job
+            array_range = fmt_array_indices(t.array_index for t in tasks)
+            if slot_limit:
+                array_range = f'{array_range}%{slot_limit}'
+            submissions.append({'script_path': array_script,
+                                'job_names': [t.job_name for t in tasks],
+                                'array_indices': [t.array_index
+                                                  for t in tasks],
+                                'options': [*options, '-t', array_range]})
+
+        # output files are removed, jobs resubmitted, and new jobids recorded
+        # in the ledger all in one remote command
+        print(f"removing {len(stale_outputs)} stdout/stderr files and "
+              f"resubmitting {len(retry_jobs)} jobs...")
+        results = bulk_submit(cluster, workingdir, job_name, job_cmd,
+                              submissions, remove=stale_outputs)
+        errors = [r for r in results if r['error'] is not None]
+        print(f"resubmitted {len(results) - len(errors)} jobs")
+        if errors:
+            print(f"failed to resubmit {len(errors)} jobs:")
+            for r in errors:
+                print(f"  {r['job_name']}: {r['error']}")
+        return results
 
 
 if __name__ == '__main__':
@@ -124,6 +223,13 @@ if __name__ == '__main__':
             to-be-resubmitted jobs and prompted to confirm before resubmitting \
             them.  Passing this overrides default behavior set in your config file"
     )
+    arg_parser.add_argument(
+        "--max-retries",
+        default=None,
+        type=int,
+        help="Most times to resubmit each job (overrides max_retries in \
+            config.ini)"
+    )
     arg_parser.add_argument(
         "--config-path",
         default=None,
@@ -133,4 +239,4 @@ if __name__ == '__main__':
     )
 
     args = arg_parser.parse_args()
-    resubmit_failed(args.confirm, args.config_path)
+    resubmit_failed(args.confirm, args.config_path, args.max_retries)
@@ -0,0 +1,473 @@
+import json
+import os
+import socketserver
+import stat
+import threading
+import time
+from argparse import ArgumentParser
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from os.path import dirname, expanduser, join as opj
+from queue import Queue
+from socket import socket, AF_UNIX, SOCK_STREAM
+from subprocess import CalledProcessError
+from paramiko import SSHException
+from spurplus import connect_with_retries
+from ._helpers import attempt_load_config, parse_config, stream_lines
+
+# same fields as the result of spurplus.SshShell.run
+ExecutionResult = namedtuple(
+    'ExecutionResult', ['return_code', 'output', 'stderr_output']
+)
+
+# raised when the connection to the cluster drops mid-request
+CONNECTION_ERRORS = (SSHException, EOFError, ConnectionError)
+# operations that can safely be repeated if the connection drops part way
+# through.  Others (e.g., running a command that submits jobs) may already
+# have taken effect on the cluster, so they're never replayed
+IDEMPOTENT_OPS = {'ping', 'md5', 'read_text', 'exists', 'is_dir'}
+
+# exceptions raised by the broker that are re-raised as-is by the client
+PASSTHROUGH_ERRORS = {
+    'FileNotFoundError': FileNotFoundError,
+    'FileExistsError': FileExistsError,
+    'PermissionError': PermissionError,
+    'ValueError': ValueError,
+    'ConnectionError': ConnectionError
+}
+
+
+def socket_path(hostname, username):
+    """
+    path to the local socket a broker for the given cluster login listens on.
+    Only the current user can access the directory it's created in
+    """
+    return opj(expanduser('~'), '.cluster-tools',
+               f'{username}@{hostname}.sock')
+
+
+class SessionBroker:
+    """
+    Holds a single authenticated SSH connection to the cluster open, along
+    with a pool of SFTP channels opened on it, so that the command line tools
+    (remote_submit, resubmit_failed, upload_scripts, download_results) can
+    attach to it over a local socket rather than each connecting &
+    authenticating from scratch.
+    Remote commands each get their own exec channel on the same connection.
+    If the connection drops, it's re-established, and the request is retried
+    if it's idempotent (see IDEMPOTENT_OPS); otherwise the client gets a
+    ConnectionError.
+    """
+    def __init__(self, hostname, username, password, n_sftp_channels=4):
+        self.hostname = hostname
+        self.username = username
+        self.password = password
+        self.n_sftp_channels = n_sftp_channels
+        self.shell = None
+        self.sftp_pool = None
+        self.last_active = time.time()
+        self._connect_lock = threading.Lock()
+        self.connect()
+
+    def connect(self):
+        with self._connect_lock:
+            if self.shell is not None:
+                try:
+                    self.shell.close()
+                except Exception:
+                    pass
+            self.shell = connect_with_retries(hostname=self.hostname,
+                                              username=self.username,
+                                              password=self.password)
+            transport = self.shell.as_spur()._get_ssh_transport()
+            self.sftp_pool = Queue()
+            for _ in range(self.n_sftp_channels):
+                self.sftp_pool.put(transport.open_sftp_client())
+
+    def close(self):
+        if self.shell is not None:
+            self.shell.close()
+
+    @contextmanager
+    def sftp(self):
+        """borrows an SFTP channel from the pool"""
+        pool = self.sftp_pool
+        client = pool.get()
+        try:
+            yield client
+        finally:
+            pool.put(client)
+
+    def _ensure_connected(self):
+        transport = self.shell.as_spur()._get_ssh_transport()
+        if not transport.is_active():
+            self.connect()
+
+    def _with_reconnect(self, method, func, *args, **kwargs):
+        self._ensure_connected()
+        try:
+            return func(*args, **kwargs)
+        except CONNECTION_ERRORS as e:
+            # connection dropped mid-request; reconnect, then retry once if
+            # repeating the request can't do any harm
+            self.connect()
+            if method in IDEMPOTENT_OPS:
+                return func(*args, **kwargs)
+            raise ConnectionError(
+                f"connection dropped during {method}, which may have "
+                f"(partly) run on the cluster, so it wasn't retried: {e}"
+            ) from e
+
+    def handle(self, method, args, kwargs):
+        self.last_active = time.time()
+        try:
+            func = getattr(self, f'op_{method}')
+        except AttributeError:
+            raise ValueError(f"unsupported operation: {method}")
+        return self._with_reconnect(method, func, *args, **kwargs)
+
+    # ====== operations available to clients ======
+    def op_ping(self):
+        return True
+
+    def op_run(self, command, allow_error=False):
+        result = self.shell.run(command, allow_error=True)
+        if result.return_code != 0 and not allow_error:
+            raise CalledProcessError(result.return_code, command,
+                                     result.output, result.stderr_output)
+        return [result.return_code, result.output, result.stderr_output]
+
+    def op_check_output(self, command):
+        return self.op_run(command)[1]
+
+    def stream(self, command):
+        """
+        yields each line of a remote command's stdout as it's printed (used
+        by the request handler, which sends the lines on as they arrive).  If
+        the connection drops, it's re-established, but the command isn't
+        rerun (see _with_reconnect)
+        """
+        self._ensure_connected()
+        try:
+            for line in stream_lines(self.shell, command):
+                # a long-running command isn't idle
+                self.last_active = time.time()
+                yield line
+        except CONNECTION_ERRORS as e:
+            self.connect()
+            raise ConnectionError(
+                f"connection dropped while streaming a command, which wasn't "
+                f"rerun: {e}"
+            ) from e
+
+    def op_md5(self, remote_path):
+        return self.op_check_output(['md5sum', remote_path]).split()[0]
+
+    def op_read_text(self, remote_path):
+        with self.sftp() as sftp, sftp.open(remote_path, 'r') as f:
+            return f.read().decode('utf-8')
+
+    def op_write_text(self, remote_path, text):
+        with self.sftp() as sftp, sftp.open(remote_path, 'w') as f:
+            f.write(text.encode('utf-8'))
+
+    def op_exists(self, remote_path):
+        try:
+            with self.sftp() as sftp:
+                sftp.stat(remote_path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def op_is_dir(self, remote_path):
+        # like spurplus, raises FileNotFoundError if the path doesn't exist
+        with self.sftp() as sftp:
+            return stat.S_ISDIR(sftp.stat(remote_path).st_mode)
+
+    def op_mkdir(self, remote_path, parents=False, exist_ok=False):
+        if parents or exist_ok:
+            self.op_run(['mkdir', '-p', remote_path])
+        else:
+            with self.sftp() as sftp:
+                sftp.mkdir(remote_path)
+
+    def op_remove(self, remote_path):
+        with self.sftp() as sftp:
+            sftp.remove(remote_path)
+
+    def op_put(self, local_path, remote_path, create_directories=True):
+        if create_directories:
+            self.op_run(['mkdir', '-p', dirname(remote_path)])
+        with self.sftp() as sftp:
+            sftp.put(local_path, remote_path)
+
+    def op_put_many(self, transfers, n_channels=4):
+        """uploads (local path, remote path) pairs over pooled SFTP channels"""
+        def _put(transfer):
+            with self.sftp() as sftp:
+                sftp.put(*transfer)
+
+        with ThreadPoolExecutor(max_workers=n_channels) as pool:
+            list(pool.map(_put, transfers))
+
+    def op_stream_download(self, remote_dir, list_path, local_dir,
+                           remote_files, manifest_path):
+        # imported here since download_results imports this module
+        from .download_results import stream_download
+        transport = self.shell.as_spur()._get_ssh_transport()
+        remote_files = {path: tuple(info)
+                        for path, info in remote_files.items()}
+        return stream_download(transport, remote_dir, list_path, local_dir,
+                               remote_files, manifest_path)
+
+
+def _error_response(e):
+    if isinstance(e, CalledProcessError):
+        return {'error': {'type': 'CalledProcessError',
+                          'returncode': e.returncode,
+                          'cmd': e.cmd,
+                          'output': e.output,
+                          'stderr': e.stderr}}
+    return {'error': {'type': type(e).__name__, 'message': str(e)}}
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def _send(self, response):
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+        self.wfile.flush()
+
+    def handle(self):
+        # one JSON-encoded request per line; one JSON-encoded response each,
+        # except for "stream" requests, which get a {"line": ...} response
+        # for each line of output before the final one
+        for line in self.rfile:
+            request = json.loads(line)
+            try:
+                if request['method'] == 'stream':
+                    lines = self.server.broker.stream(
+                        *request.get('args', [])
+                    )
+                    try:
+                        for out_line in lines:
+                            self._send({'line': out_line})
+                    finally:
+                        lines.close()
+                    result = None
+                else:
+                    result = self.server.broker.handle(
+                        request['method'], request.get('args', []),
+                        request.get('kwargs', {})
+                    )
+                response = {'result': result}
+            except (BrokenPipeError, ConnectionResetError):
+                # the client went away (e.g., mid-stream)
+                return
+            except Exception as e:
+                response = _error_response(e)
+            try:
+                self._send(response)
+            except (BrokenPipeError, ConnectionResetError):
+                return
+
+
+class _BrokerServer(socketserver.ThreadingMixIn,
+                    socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(hostname, username, password, idle_timeout=3600):
+    """
+    runs a session broker until it's been idle for idle_timeout seconds
+    """
+    path = socket_path(hostname, username)
+    os.makedirs(dirname(path), mode=0o700, exist_ok=True)
+    if os.path.exists(path):
+        os.remove(path)
+
+    broker = SessionBroker(hostname, username, password)
+    server = _BrokerServer(path, _RequestHandler)
+    os.chmod(path, 0o600)
+    server.broker = broker
+
+    def _shutdown_when_idle():
+        while time.time() - broker.last_active < idle_timeout:
+            time.sleep(10)
+        server.shutdown()
+
+    threading.Thread(target=_shutdown_when_idle, daemon=True).start()
+    print(f"session broker for {username}@{hostname} listening on {path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        broker.close()
+        os.remove(path)
+
+
+class SessionClient:
+    """
+    Stand-in for a spurplus.SshShell that forwards each call to a running
+    session broker (supports the subset of methods used by these tools)
+    """
+    def __init__(self, path):
+        self.sock = socket(AF_UNIX, SOCK_STREAM)
+        self.sock.connect(path)
+        self.sock_file = self.sock.makefile('rwb')
+        self._lock = threading.Lock()
+
+    def _call(self, method, *args, **kwargs):
+        request = {'method': method, 'args': args, 'kwargs': kwargs}
+        with self._lock:
+            self.sock_file.write(json.dumps(request).encode() + b'\n')
+            self.sock_file.flush()
+            line = self.sock_file.readline()
+        return self._result(line)
+
+    @staticmethod
+    def _result(line):
+        if not line:
+            raise ConnectionError("session broker closed the connection")
+        response = json.loads(line)
+        if 'error' in response:
+            error = response['error']
+            if error['type'] == 'CalledProcessError':
+                raise CalledProcessError(error['returncode'], error['cmd'],
+                                         error['output'], error['stderr'])
+            exc_type = PASSTHROUGH_ERRORS.get(error['type'], RuntimeError)
+            raise exc_type(f"{error['type']}: {error['message']}")
+        return response['result']
+
+    def ping(self):
+        return self._call('ping')
+
+    def run(self, command, allow_error=False):
+        return ExecutionResult(*self._call('run', list(command),
+                                           allow_error=allow_error))
+
+    def check_output(self, command):
+        return self._call('check_output', list(command))
+
+    def stream(self, command):
+        """
+        yields each line of a remote command's stdout as it's printed.  The
+        connection to the broker is held until the command finishes
+        """
+        request = {'method': 'stream', 'args': [list(command)], 'kwargs': {}}
+        with self._lock:
+            self.sock_file.write(json.dumps(request).encode() + b'\n')
+            self.sock_file.flush()
+            while True:
+                line = self.sock_file.readline()
+                if line:
+                    response = json.loads(line)
+                    if 'line' in response:
+                        yield response['line']
+                        continue
+                self._result(line)
+                return
+
+    def md5(self, remote_path):
+        return self._call('md5', str(remote_path))
+
+    def read_text(self, remote_path):
+        return self._call('read_text', str(remote_path))
+
+    def write_text(self, remote_path, text):
+        return self._call('write_text', str(remote_path), text)
+
+    def exists(self, remote_path):
+        return self._call('exists', str(remote_path))
+
+    def is_dir(self, remote_path):
+        return self._call('is_dir', str(remote_path))
+
+    def mkdir(self, remote_path, parents=False, exist_ok=False):
+        return self._call('mkdir', str(remote_path), parents=parents,
+                          exist_ok=exist_ok)
+
+    def remove(self, remote_path):
+        return self._call('remove', str(remote_path))
+
+    def put(self, local_path, remote_path, create_directories=True):
+        # local paths are resolved by the broker, so must be absolute
+        return self._call('put', os.path.abspath(local_path), str(remote_path),
+                          create_directories=create_directories)
+
+    def put_many(self, transfers, n_channels=4):
+        transfers = [(os.path.abspath(src), str(dest))
+                     for src, dest in transfers]
+        return self._call('put_many', transfers, n_channels=n_channels)
+
+    def stream_download(self, remote_dir, list_path, local_dir, remote_files,
+                        manifest_path):
+        # the broker unpacks the stream, so local paths must be absolute
+        return tuple(self._call('stream_download', str(remote_dir),
+                                str(list_path), os.path.abspath(local_dir),
+                                remote_files, os.path.abspath(manifest_path)))
+
+    def close(self):
+        self.sock_file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+@contextmanager
+def connect_to_cluster(hostname, username, password):
+    """
+    Connects to the cluster through a running session broker if there is one
+    (see serve), or directly otherwise.  Use in place of
+    spurplus.connect_with_retries
+    """
+    path = socket_path(hostname, username)
+    client = None
+    if os.path.exists(path):
+        try:
+            client = SessionClient(path)
+        except OSError:
+            # stale socket left by a broker that didn't shut down cleanly
+            pass
+
+    if client is not None:
+        with client:
+            yield client
+    else:
+        with connect_with_retries(
+                hostname=hostname,
+                username=username,
+                password=password
+        ) as cluster:
+            yield cluster
+
+
+if __name__ == '__main__':
+    description = "Keep a persistent connection to the cluster open for \
+    remote_submit, resubmit_failed, and upload_scripts to share"
+    arg_parser = ArgumentParser(description=description)
+    arg_parser.add_argument(
+        "--config-path",
+        default=None,
+        type=str,
+        help="Path to your config file (optional unless you've moved your \
+        config file)"
+    )
+    arg_parser.add_argument(
+        "--idle-timeout",
+        default=3600,
+        type=int,
+        help="Shut down after this many seconds without any requests"
+    )
+    args = arg_parser.parse_args()
+
+    if args.config_path is None:
+        config = attempt_load_config()
+    else:
+        config = parse_config(args.config_path)
+
+    serve(config['hostname'], config['username'], config['password'],
+          idle_timeout=args.idle_timeout)
@@ -0,0 +1,221 @@
+import base64
+import json
+import os
+import shlex
+import time
+import zlib
+from argparse import ArgumentParser
+from os.path import isfile, join as opj
+from ._helpers import (
+                        attempt_load_config,
+                        fmt_remote_commands,
+                        parse_config
+                    )
+from .cluster_scripts.config import job_config
+from .cluster_scripts.read_logs import encode_offsets
+from .session_broker import connect_to_cluster
+
+# kept in the local log directory; maps each log file's name to the number of
+# bytes of it that have been fetched (the size of the local copy)
+INDEX_NAME = '.log_index.json'
+# offsets longer than this are uploaded rather than passed on the command line
+MAX_OFFSETS_ARG = 100000
+
+
+class LogTailer:
+    """
+    Keeps local copies of a sweep's stdout/stderr files up to date by
+    fetching only the bytes appended to each since the last poll, for every
+    job at once, in a single remote command (see cluster_scripts/read_logs.py).
+    Running jobs' files are only in the working directory if config.ini's
+    live_logs is enabled (see cluster_scripts/job_scripts.py)
+    :param remote_shell: (spurplus.SshShell instance)
+    :param workingdir: (str) remote directory containing the jobs' output
+                       files & cluster scripts
+    :param job_name: (str) name given to the jobs in config.ini
+    :param local_dir: (str) local directory to keep copies of the logs in
+    :param max_bytes: (int) most bytes to fetch from each file per poll
+    """
+    def __init__(self, remote_shell, workingdir, job_name, local_dir,
+                 max_bytes=1 << 20):
+        self.remote_shell = remote_shell
+        self.workingdir = workingdir
+        self.job_name = job_name
+        self.local_dir = local_dir
+        self.max_bytes = max_bytes
+        os.makedirs(local_dir, exist_ok=True)
+        self.index_path = opj(local_dir, INDEX_NAME)
+        self.offsets = {}
+        if isfile(self.index_path):
+            with open(self.index_path, 'r') as f:
+                self.offsets = json.load(f)
+
+    def _save_index(self):
+        tmp_path = f'{self.index_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.offsets, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _tail_command(self):
+        reader_path = opj(self.workingdir, 'read_logs.py')
+        cmd = (f'python3 {reader_path} tail {shlex.quote(self.workingdir)} '
+               f'{self.job_name} --max-bytes {self.max_bytes}')
+        encoded = encode_offsets(self.offsets)
+        if len(encoded) > MAX_OFFSETS_ARG:
+            offsets_path = opj(self.workingdir,
+                               f'.{self.job_name}_log_offsets')
+            self.remote_shell.write_text(offsets_path, encoded)
+            return f'{cmd} --offsets-file {shlex.quote(offsets_path)}'
+        return f'{cmd} --offsets {encoded}'
+
+    def poll(self):
+        """
+        fetches new output from every log file that's changed since the last
+        poll & appends it to the local copies
+        :return new_output: (dict) maps file names to the text appended to
+                            them (a file that was replaced, e.g. by a
+                            resubmitted job, is fetched from the start)
+        """
+        tail_cmd = fmt_remote_commands([self._tail_command()])
+        new_output = {}
+        for line in self.remote_shell.check_output(tail_cmd).splitlines():
+            if not line:
+                continue
+            record = json.loads(line)
+            data = zlib.decompress(base64.b64decode(record['data']))
+            local_path = opj(self.local_dir, record['file'])
+            mode = 'ab' if record['offset'] > 0 else 'wb'
+            with open(local_path, mode) as f:
+                f.write(data)
+            self.offsets[record['file']] = record['offset'] + len(data)
+            new_output[record['file']] = data.decode(errors='replace')
+        self._save_index()
+        return new_output
+
+    def follow(self, interval=30, callback=None):
+        """
+        polls every interval seconds until interrupted, passing each poll's
+        new output to callback (by default, printing each new line prefixed
+        with its file's name)
+        """
+        if callback is None:
+            callback = print_new_output
+        try:
+            while True:
+                callback(self.poll())
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+
+
+def print_new_output(new_output):
+    for file_name, text in sorted(new_output.items()):
+        for line in text.splitlines():
+            print(f'{file_name}: {line}')
+
+
+def grep_logs(remote_shell, workingdir, job_name, pattern, ignore_case=False,
+              streams='oe', max_matches=None):
+    """
+    Searches every job's stdout and/or stderr file for lines matching a
+    regular expression.  The search runs on the cluster, so only matching
+    lines are transferred
+    :param remote_shell: (spurplus.SshShell instance)
+    :param workingdir: (str) remote directory containing the jobs' output
+                       files & cluster scripts
+    :param job_name: (str) name given to the jobs in config.ini
+    :param pattern: (str) regular expression (Python syntax) to search for
+    :param ignore_case: (bool, default: False) match case-insensitively
+    :param streams: (str, default: 'oe') 'o' to search stdout files, 'e' to
+                    search stderr files, or 'oe' for both
+    :param max_matches: (int, optional) stop after this many matches
+    :return matches: (list) (file name, line number, line) tuples
+    """
+    reader_path = opj(workingdir, 'read_logs.py')
+    cmd = (f'python3 {reader_path} grep {shlex.quote(workingdir)} {job_name} '
+           f'{shlex.quote(pattern)} --streams {streams}')
+    if ignore_case:
+        cmd += ' --ignore-case'
+    if max_matches is not None:
+        cmd += f' --max-matches {max_matches}'
+    grep_output = remote_shell.check_output(fmt_remote_commands([cmd]))
+    matches = []
+    for line in grep_output.splitlines():
+        if line:
+            file_name, line_number, text = line.split('\t', 2)
+            matches.append((file_name, int(line_number), text))
+    return matches
+
+
+if __name__ == '__main__':
+    description = "Fetch new output from your jobs' stdout/stderr files, or \
+    search them"
+    arg_parser = ArgumentParser(description=description)
+    arg_parser.add_argument(
+        "--local-dir",
+        default='logs',
+        type=str,
+        help="Local directory to keep copies of the logs in"
+    )
+    arg_parser.add_argument(
+        "--follow",
+        action='store_true',
+        help="Keep fetching new output until interrupted"
+    )
+    arg_parser.add_argument(
+        "--interval",
+        default=30,
+        type=float,
+        help="Seconds between fetches when following"
+    )
+    arg_parser.add_argument(
+        "--grep",
+        default=None,
+        type=str,
+        help="Print lines matching this regular expression from every job's \
+        logs instead"
+    )
+    arg_parser.add_argument(
+        "-i",
+        "--ignore-case",
+        action='store_true',
+        help="Match the --grep pattern case-insensitively"
+    )
+    arg_parser.add_argument(
+        "--streams",
+        default='oe',
+        choices=['o', 'e', 'oe'],
+        help="Search stdout (o), stderr (e), or both (oe) with --grep"
+    )
+    arg_parser.add_argument(
+        "--config-path",
+        default=None,
+        type=str,
+        help="Path to your config file (optional unless you've moved your \
+        config file)"
+    )
+    args = arg_parser.parse_args()
+
+    if args.config_path is None:
+        config = attempt_load_config()
+    else:
+        config = parse_config(args.config_path)
+
+    with connect_to_cluster(
+        hostname=config['hostname'],
+        username=config['username'],
+        password=config['password']
+    ) as cluster:
+        if args.grep is not None:
+            for name, number, match in grep_logs(
+                    cluster, job_config['workingdir'], job_config['jobname'],
+                    args.grep, args.ignore_case, args.streams
+            ):
+                print(f'{name}:{number}: {match}')
+        else:
+            tailer = LogTailer(cluster, job_config['workingdir'],
+                               job_config['jobname'], args.local_dir)
+            if args.follow:
+                tailer.follow(args.interval)
+            else:
+                print_new_output(tailer.poll())
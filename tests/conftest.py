@@ -0,0 +1,15 @@
+import sys
+import types
+from os.path import dirname, realpath, join as opj
+
+repo_root = dirname(dirname(realpath(__file__)))
+# cluster scripts are run as plain scripts on the cluster, so are imported
+# the same way here
+sys.path.insert(0, opj(repo_root, 'cluster_scripts'))
+
+# the local tools use relative imports, so the repository is imported as a
+# package (its directory name isn't necessarily a valid module name)
+if 'cluster_tools' not in sys.modules:
+    package = types.ModuleType('cluster_tools')
+    package.__path__ = [repo_root]
+    sys.modules['cluster_tools'] = package
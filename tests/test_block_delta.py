@@ -0,0 +1,41 @@
+import io
+import os
+import random
+import zlib
+
+from block_delta import (apply_delta, candidate_offsets, file_signature,
+                         write_delta)
+
+
+def test_candidate_offsets_match_adler32():
+    data = os.urandom(1000)
+    block_size = 64
+    weak = [zlib.adler32(data[pos:pos + block_size])
+            for pos in range(len(data) - block_size + 1)]
+    wanted = weak[10::97]
+    assert list(candidate_offsets(data, 5, 900, block_size, wanted)) == [
+        (pos, weak[pos]) for pos in range(5, 900) if weak[pos] in wanted
+    ]
+
+
+def test_delta_reconstructs_edited_file(tmp_path):
+    rng = random.Random(0)
+    old = bytes(rng.randrange(256) for _ in range(5000))
+    # an in-place edit, an insertion (shifting everything after it) & a
+    # deletion
+    new = bytearray(old)
+    new[100:110] = bytes(10)
+    new[2000:2000] = b'inserted'
+    del new[4000:4100]
+    (tmp_path / 'old').write_bytes(old)
+    (tmp_path / 'new').write_bytes(new)
+
+    block_size = 256
+    signature = file_signature(str(tmp_path / 'old'), block_size)
+    delta = io.BytesIO()
+    n_matched = write_delta(str(tmp_path / 'new'), signature, block_size,
+                            delta)
+    assert n_matched >= len(signature) - 4
+    (tmp_path / 'delta').write_bytes(delta.getvalue())
+    apply_delta(str(tmp_path / 'old'), str(tmp_path / 'delta'), block_size)
+    assert (tmp_path / 'old').read_bytes() == new
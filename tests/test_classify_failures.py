@@ -0,0 +1,35 @@
+from cluster_tools._helpers import LedgerRecord
+from cluster_tools.resubmit_failed import summarize_failures
+from ledger import stdout_id
+from test_ledger import TRACEBACK, submitted_ledger, write_outputs
+
+
+def ledger_records(ledger):
+    """the ledger's rows, as read_ledger returns them"""
+    failures = ledger.failures()
+    return [LedgerRecord(*row, stdout_id(row[1], row[2]),
+                         *failures.get(row[0], (None, None)))
+            for row in ledger.jobs()]
+
+
+def test_traceback_is_deterministic_and_not_resubmitted(tmp_path):
+    ledger = submitted_ledger(tmp_path, [('crashed', '5.srv'),
+                                         ('killed', '6.srv'),
+                                         ('ok', '7.srv')])
+    write_outputs(tmp_path, 'sweep', '5', 'crashed', 1, stderr=TRACEBACK)
+    # killed by PBS before the job script could finish
+    (tmp_path / 'sweep.o6').write_text('---\nscript name: killed\n')
+    (tmp_path / 'sweep.e6').write_text(
+        '=>> PBS: job killed: walltime 3630 exceeded limit 3600\n'
+    )
+    write_outputs(tmp_path, 'sweep', '7', 'ok', 0)
+    ledger.sync(str(tmp_path), 'sweep', statuses=[])
+
+    assert ledger.failures() == {
+        'crashed': ('deterministic', 'ValueError: bad parameter'),
+        'killed': ('resource', 'out of walltime')
+    }
+    failed = [job for job in ledger_records(ledger) if job.state == 'failed']
+    to_retry = summarize_failures(failed, max_retries=3)
+    assert [job.job_name for job in to_retry] == ['killed']
+    ledger.close()
@@ -0,0 +1,69 @@
+import os
+import stat
+
+import pytest
+
+from job_scripts import (ARRAY_JOBSCRIPT_TEMPLATE, BUNDLE_JOBSCRIPT_TEMPLATE,
+                         JOBSCRIPT_TEMPLATE, ScriptTemplate)
+
+
+@pytest.fixture
+def failing_qsub(tmp_path, monkeypatch):
+    """puts a qsub on the PATH that rejects every submission"""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    qsub = bin_dir / 'qsub'
+    qsub.write_text('#!/bin/sh\necho "qsub: server unavailable" >&2\n'
+                    'exit 1\n')
+    qsub.chmod(qsub.stat().st_mode | stat.S_IXUSR)
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv('LOGNAME', 'tester')
+
+
+def script_template(tmp_path):
+    config = {
+        'jobname': 'sweep',
+        'startdir': str(tmp_path),
+        'workingdir': str(tmp_path),
+        'datadir': str(tmp_path / 'data'),
+        'scriptdir': str(tmp_path / 'scripts'),
+        'queue': 'largeq',
+        'nnodes': 1,
+        'ppn': 1,
+        'walltime': '1:00:00',
+        'mem': '',
+        'email_updates': 'n',
+        'email_addr': '',
+        'modules': 'python',
+        'env_type': 'conda',
+        'env_name': 'base',
+        'activate_cmd': 'source activate',
+        'deactivate_cmd': 'conda deactivate',
+        'env_snapshot': '',
+        'cmd_wrapper': 'python',
+        'array_slot_limit': '',
+        'bundle_task_time': '0:01:00',
+        'max_queued': '',
+        'queue_poll_interval': 60,
+        'submit_parallel': 2,
+        'live_logs': 'false',
+        'bundle_options': ''
+    }
+    return ScriptTemplate(JOBSCRIPT_TEMPLATE, config)
+
+
+@pytest.mark.parametrize('mode', ['single', 'array', 'bundle'])
+def test_failed_submission_leaves_jobs_written(tmp_path, failing_qsub, mode):
+    template = script_template(tmp_path)
+    jobs = [(f'job_{i}', f'cruncher.py {i}') for i in range(3)]
+    for job_n, job_c in jobs:
+        template.lock(job_n, job_c)
+    batch_templates = {'array': (ARRAY_JOBSCRIPT_TEMPLATE, None),
+                       'bundle': (None, BUNDLE_JOBSCRIPT_TEMPLATE)}
+    assert template.submit_jobs(jobs, *batch_templates.get(mode, ())) == []
+
+    # not recorded as submitted, so the next run submits them again
+    states = {name: (jobid, state, attempts) for
+              name, jobid, _, state, _, attempts, *_ in template.ledger.jobs()}
+    assert states == {job_n: (None, 'written', 0) for job_n, _ in jobs}
+    template.release_locks()
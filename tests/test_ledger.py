@@ -0,0 +1,38 @@
+from ledger import JobLedger
+
+TRACEBACK = """Traceback (most recent call last):
+  File "cruncher.py", line 3, in <module>
+    raise ValueError("bad parameter")
+ValueError: bad parameter
+"""
+
+
+def write_outputs(workingdir, job_name, out_id, job, exit_status,
+                  stderr=''):
+    (workingdir / f'{job_name}.o{out_id}').write_text(
+        f'---\nscript name: {job}\ncalling job script\n'
+        f'exit status: {exit_status}\njob script finished\n---\n'
+    )
+    (workingdir / f'{job_name}.e{out_id}').write_text(stderr)
+
+
+def submitted_ledger(workingdir, jobs):
+    """a ledger with each (job name, jobid) in jobs submitted"""
+    ledger = JobLedger(str(workingdir / 'sweep_ledger.db'))
+    for job, jobid in jobs:
+        ledger.claim(job, f'python cruncher.py {job}')
+        ledger.record_submission([job], jobid)
+    return ledger
+
+
+def test_sync_marks_nonzero_exit_failed(tmp_path):
+    ledger = submitted_ledger(tmp_path, [('a', '5.srv'), ('b', '6.srv')])
+    write_outputs(tmp_path, 'sweep', '5', 'a', 1, stderr=TRACEBACK)
+    write_outputs(tmp_path, 'sweep', '6', 'b', 0)
+
+    ledger.sync(str(tmp_path), 'sweep', statuses=[])
+    states = {name: (state, exit_status) for
+              name, _, _, state, exit_status, *_ in ledger.jobs()}
+    assert states == {'a': ('failed', 1), 'b': ('finished', 0)}
+    assert list(ledger.failures()) == ['a']
+    ledger.close()
@@ -0,0 +1,34 @@
+import asyncio
+
+from job_status import JobStatus
+
+from cluster_tools._helpers import LedgerRecord
+from cluster_tools.monitor import SweepMonitor, ledger_progress
+
+
+def record(job_name, jobid, state, exit_status=None):
+    out_id = jobid.split('.')[0] if jobid else None
+    return LedgerRecord(job_name, jobid, None, state, exit_status, 1, None,
+                        out_id, None, None)
+
+
+def job_status(jobid, state):
+    return JobStatus(jobid, None, 'sweep', 'user', state, None, None, None,
+                     None, None)
+
+
+def test_nonzero_exit_counts_as_failed():
+    records = [record('a', '1.srv', 'finished', 0),
+               record('b', '2.srv', 'failed', 1),
+               record('c', '3.srv', 'running'),
+               record('d', None, 'written')]
+    sweep_monitor = SweepMonitor(
+        poll_scheduler=lambda: {'3.srv': job_status('3.srv', 'R')},
+        poll_outputs=lambda job_name: ledger_progress(records),
+        job_names=['sweep']
+    )
+    progress = asyncio.run(sweep_monitor.poll())['sweep']
+    assert (progress['total'], progress['finished'], progress['failed']) \
+        == (4, 1, 1)
+    assert progress['states'] == {'R': 1}
+    assert not progress['done']
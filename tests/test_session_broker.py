@@ -0,0 +1,128 @@
+import json
+import subprocess
+import threading
+from socket import socket, AF_UNIX, SOCK_STREAM
+
+import pytest
+from paramiko import SSHException
+
+from cluster_tools import session_broker
+from cluster_tools.session_broker import (ExecutionResult, SessionBroker,
+                                          SessionClient, _BrokerServer,
+                                          _RequestHandler)
+
+
+class FakeTransport:
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+    def open_sftp_client(self):
+        return None
+
+
+class FakeShell:
+    """
+    stand-in for an SSH connection that runs commands locally, and can be
+    made to drop the connection part way through the next command
+    """
+    def __init__(self, log):
+        self.log = log
+        self.transport = FakeTransport()
+        self.drop_next = False
+
+    def as_spur(self):
+        return self
+
+    def _get_ssh_transport(self):
+        return self.transport
+
+    def run(self, command, allow_error=False):
+        # the command reaches the cluster before the connection drops
+        result = subprocess.run(command, capture_output=True, text=True)
+        self.log.append(command)
+        if self.drop_next:
+            self.drop_next = False
+            self.transport.active = False
+            raise SSHException("connection dropped")
+        return ExecutionResult(result.returncode, result.stdout,
+                               result.stderr)
+
+    def close(self):
+        self.transport.active = False
+
+
+@pytest.fixture
+def broker(monkeypatch):
+    shells = []
+
+    def _connect(**kwargs):
+        shells.append(FakeShell(log=[] if not shells else shells[0].log))
+        return shells[-1]
+
+    monkeypatch.setattr(session_broker, 'connect_with_retries', _connect)
+    broker = SessionBroker('cluster', 'user', 'password', n_sftp_channels=1)
+    broker.shells = shells
+    return broker
+
+
+def test_dropped_command_is_not_replayed(broker, tmp_path):
+    counter = tmp_path / 'n_submitted'
+    command = ['sh', '-c', f'echo x >> {counter}']
+    broker.shell.drop_next = True
+    with pytest.raises(ConnectionError):
+        broker.handle('run', [command], {})
+
+    # reconnected for the next request, but the command only ran once
+    assert len(broker.shells) == 2
+    assert broker.shell.transport.is_active()
+    assert counter.read_text() == 'x\n'
+    broker.handle('run', [command], {})
+    assert counter.read_text() == 'x\nx\n'
+
+
+def test_dropped_read_is_replayed(broker, tmp_path):
+    path = tmp_path / 'file.txt'
+    path.write_text('contents\n')
+    broker.shell.drop_next = True
+    assert broker.handle('md5', [str(path)], {})
+    assert len(broker.shells) == 2
+    assert len(broker.shell.log) == 2
+
+
+def test_client_disconnecting_mid_stream(broker, monkeypatch, tmp_path):
+    closed = threading.Event()
+
+    def _stream_lines(shell, command):
+        try:
+            while True:
+                yield 'output'
+        finally:
+            closed.set()
+
+    monkeypatch.setattr(session_broker, 'stream_lines', _stream_lines)
+    path = str(tmp_path / 'broker.sock')
+    server = _BrokerServer(path, _RequestHandler)
+    server.broker = broker
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        sock = socket(AF_UNIX, SOCK_STREAM)
+        sock.connect(path)
+        sock_file = sock.makefile('rwb')
+        request = {'method': 'stream', 'args': [['tail', '-f', 'log']],
+                   'kwargs': {}}
+        sock_file.write(json.dumps(request).encode() + b'\n')
+        sock_file.flush()
+        assert json.loads(sock_file.readline()) == {'line': 'output'}
+        sock_file.close()
+        sock.close()
+        # the handler stops streaming rather than erroring out, and the
+        # broker carries on serving other clients
+        assert closed.wait(timeout=10)
+        with SessionClient(path) as client:
+            assert client.ping()
+    finally:
+        server.shutdown()
+        server.server_close()
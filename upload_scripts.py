@@ -1,18 +1,97 @@
 import os
-from os.path import dirname, realpath, join as opj
-from spurplus import connect_with_retries
-from ._helpers import md5_checksum, attempt_load_config, prompt_input
+import shlex
+import tempfile
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from os.path import dirname, getsize, realpath, relpath, join as opj
+from threading import local
+from ._helpers import (
+                        attempt_load_config,
+                        fmt_remote_commands,
+                        md5_checksum,
+                        prompt_input,
+                        remote_md5sums
+                    )
+from .cluster_scripts.block_delta import write_delta
 from .cluster_scripts.config import job_config
+from .session_broker import connect_to_cluster
 
 
-def upload_scripts(remote_shell, local_script_dir, job_conf, confirm_overwrite=True):
+def list_local_files(local_dir):
+    """
+    recursively lists files in local_dir (including nested packages), as
+    paths relative to local_dir.  Hidden files & directories (e.g., .DS_Store
+    on MacOS) and __pycache__ directories are ignored
+    """
+    local_files = []
+    for root, dirs, files in os.walk(local_dir):
+        dirs[:] = sorted(d for d in dirs
+                         if not (d.startswith('.') or d == '__pycache__'))
+        for file in sorted(files):
+            if not file.startswith('.'):
+                local_files.append(relpath(opj(root, file), local_dir))
+    return local_files
+
+
+def parallel_put(remote_shell, transfers, n_channels=4):
+    """
+    uploads files over several SFTP channels at once.  The channels share the
+    remote shell's existing SSH connection, so no additional authentication
+    is needed (if connected through a session broker, the broker's pooled
+    channels are used)
+    :param remote_shell: (spurplus.SshShell instance)
+    :param transfers: (list) (local path, remote path) pairs
+    :param n_channels: (int, default: 4) number of concurrent SFTP channels
+    :return: None
+    """
+    if hasattr(remote_shell, 'put_many'):
+        remote_shell.put_many(transfers, n_channels=n_channels)
+        for src_path, _ in transfers:
+            print(f"uploaded {src_path}")
+        return
+
+    transport = remote_shell.as_spur()._get_ssh_transport()
+    channels = local()
+    opened = []
+
+    def _put(transfer):
+        if not hasattr(channels, 'sftp'):
+            channels.sftp = transport.open_sftp_client()
+            opened.append(channels.sftp)
+        src_path, dest_path = transfer
+        channels.sftp.put(src_path, dest_path)
+        return src_path
+
+    try:
+        with ThreadPoolExecutor(max_workers=n_channels) as pool:
+            for src_path in pool.map(_put, transfers):
+                print(f"uploaded {src_path}")
+    finally:
+        for sftp in opened:
+            sftp.close()
+
+
+def upload_scripts(remote_shell, local_script_dir, job_conf,
+                   confirm_overwrite=True, n_channels=4):
+    """
+    syncs local cluster scripts (including any nested packages) to the remote
+    working directory, uploading only new & changed files
+
+    :param remote_shell: (spurplus.SshShell instance)
+    :param local_script_dir: (str) local directory containing cluster scripts
+    :param job_conf: (dict-like) options from cluster_scripts/config.ini
+    :param confirm_overwrite: (bool, default: True) if True, prompt (once) for
+    confirmation before overwriting remote files with local changes
+    :param n_channels: (int, default: 4) number of concurrent SFTP channels to
+    upload files over
+    :return: None
+    """
     remote_startdir = job_conf['startdir']
     remote_workingdir = job_conf['workingdir']
     remote_datadir = job_conf['datadir']
 
-    to_upload = os.listdir(local_script_dir)
-    # ignore hidden files (e.g., .DS_Store on MacOS)
-    to_upload = [f for f in to_upload if not f.startswith('.')]
+    to_upload = list_local_files(local_script_dir)
     for remote_dir in [remote_startdir, remote_workingdir, remote_datadir]:
         try:
             remote_shell.is_dir(remote_dir)
@@ -21,33 +100,178 @@ def upload_scripts(remote_shell, local_script_dir, job_conf, confirm_overwrite=T
             print(f'creating remote directory: {remote_dir}')
             remote_shell.mkdir(remote_dir)
 
-    print("uploading scripts...")
+    # get checksums of all existing remote copies in a single remote command
+    remote_checksums = remote_md5sums(remote_shell, remote_workingdir,
+                                      to_upload)
+
+    changed = []
+    new = []
+    n_skipped = 0
     for file in to_upload:
-        src_path = opj(local_script_dir, file)
-        dest_path = opj(remote_workingdir, file)
-        if remote_shell.exists(dest_path):
+        if file not in remote_checksums:
+            new.append(file)
+        elif md5_checksum(opj(local_script_dir, file)) == remote_checksums[file]:
             # don't bother uploading file if it hasn't been edited
-            local_checksum = md5_checksum(src_path)
-            remote_checksum = remote_shell.md5(dest_path)
-            if local_checksum == remote_checksum:
-                print(f"skipping {file} (no changes)")
-                continue
+            n_skipped += 1
+        else:
+            changed.append(file)
+
+    if changed and confirm_overwrite:
+        # prompt for confirmation of all overwrites at once
+        print('\n'.join(changed))
+        question = f"overwrite remote versions of these {len(changed)} files \
+        with local changes?"
+        if not prompt_input(question):
+            print(f"skipping {len(changed)} files (overwrite declined)")
+            n_skipped += len(changed)
+            changed = []
+
+    to_transfer = new + changed
+    if to_transfer:
+        # create any nested remote directories in a single remote command
+        remote_dirs = sorted({dirname(opj(remote_workingdir, f))
+                              for f in to_transfer})
+        remote_shell.run(fmt_remote_commands(
+            [f"mkdir -p {' '.join(shlex.quote(d) for d in remote_dirs)}"]
+        ))
+
+    print(f"uploading {len(to_transfer)} scripts...")
+    n_bytes = sum(getsize(opj(local_script_dir, f)) for f in to_transfer)
+    start_time = time.time()
+    parallel_put(
+        remote_shell,
+        [(opj(local_script_dir, f), opj(remote_workingdir, f))
+         for f in to_transfer],
+        n_channels=n_channels
+    )
+    elapsed = max(time.time() - start_time, 1e-6)
+    print(f"finished uploading scripts: {len(to_transfer)} uploaded "
+          f"({n_bytes / elapsed / 1024:.1f} KB/s), {n_skipped} skipped")
+
 
-            if confirm_overwrite:
-                # prompt for confirmation of overwrite if option is enabled
-                question = f"{file}: overwrite remote version with local changes?"
-                overwrite_confirmed = prompt_input(question)
-                if not overwrite_confirmed:
-                    print(f"skipping {file} (overwrite declined)")
-                    continue
+def delta_put(remote_shell, local_path, remote_path, remote_workingdir,
+              block_size=1 << 16):
+    """
+    updates an existing remote file to match a local one by sending only the
+    blocks that differ (see cluster_scripts/block_delta.py, which must have
+    been uploaded to the remote working directory).  Falls back to uploading
+    the whole file if the reconstructed remote file doesn't match
+    :param remote_shell: (spurplus.SshShell instance)
+    :param local_path: (str) path to the new version of the file
+    :param remote_path: (str) path to the old version on the cluster
+    :param remote_workingdir: (str) remote directory containing the cluster
+                              scripts
+    :param block_size: (int, default: 65536) size of blocks compared
+    :return n_sent: (int) number of bytes of file data sent
+    """
+    delta_script = opj(remote_workingdir, 'block_delta.py')
+    remote_path_q = shlex.quote(remote_path)
+    remote_delta_path = f'{remote_path}.delta'
+    sig_cmd = fmt_remote_commands(
+        [f'python3 {delta_script} signature {remote_path_q} {block_size}']
+    )
+    signature = []
+    for line in remote_shell.check_output(sig_cmd).splitlines():
+        if line:
+            weak, strong = line.split('\t')
+            signature.append((int(weak), strong))
 
-        remote_shell.put(src_path, dest_path, create_directories=False)
-        print(f"uploaded {file}")
-    print("finished uploading scripts")
+    with tempfile.NamedTemporaryFile(suffix='.delta', delete=False) as f:
+        write_delta(local_path, signature, block_size, f)
+    try:
+        n_sent = os.path.getsize(f.name)
+        remote_shell.put(f.name, remote_delta_path, create_directories=False)
+        patch_cmd = fmt_remote_commands(
+            [f'python3 {delta_script} patch {remote_path_q} '
+             f'{shlex.quote(remote_delta_path)} {block_size}; '
+             f'rm -f {shlex.quote(remote_delta_path)}']
+        )
+        new_checksum = remote_shell.check_output(patch_cmd).strip()
+    finally:
+        os.remove(f.name)
+
+    if new_checksum != md5_checksum(local_path):
+        print(f"delta transfer of {local_path} failed, uploading whole file")
+        remote_shell.put(local_path, remote_path, create_directories=False)
+        n_sent += getsize(local_path)
+    return n_sent
+
+
+def upload_data(remote_shell, local_data_dir, job_conf,
+                delta_threshold=1 << 24, n_channels=4):
+    """
+    syncs a local data directory to the remote data directory.  New files &
+    small changed files are uploaded whole (over several SFTP channels);
+    changed files larger than delta_threshold are updated with a block-level
+    delta transfer
+
+    :param remote_shell: (spurplus.SshShell instance)
+    :param local_data_dir: (str) local directory containing data files
+    :param job_conf: (dict-like) options from cluster_scripts/config.ini
+    :param delta_threshold: (int, default: 16MB) minimum size (in bytes) of
+    changed files to send as deltas
+    :param n_channels: (int, default: 4) number of concurrent SFTP channels to
+    upload whole files over
+    :return: None
+    """
+    remote_workingdir = job_conf['workingdir']
+    remote_datadir = job_conf['datadir']
+
+    to_upload = list_local_files(local_data_dir)
+    remote_checksums = remote_md5sums(remote_shell, remote_datadir, to_upload)
+
+    whole = []
+    delta = []
+    n_skipped = 0
+    for file in to_upload:
+        local_path = opj(local_data_dir, file)
+        if file not in remote_checksums:
+            whole.append(file)
+        elif md5_checksum(local_path) == remote_checksums[file]:
+            n_skipped += 1
+        elif getsize(local_path) >= delta_threshold:
+            delta.append(file)
+        else:
+            whole.append(file)
+
+    if whole:
+        remote_dirs = sorted({dirname(opj(remote_datadir, f)) for f in whole})
+        remote_shell.run(fmt_remote_commands(
+            [f"mkdir -p {' '.join(shlex.quote(d) for d in remote_dirs)}"]
+        ))
+
+    print(f"uploading {len(whole)} files & {len(delta)} deltas...")
+    n_total = sum(getsize(opj(local_data_dir, f)) for f in whole + delta)
+    n_sent = sum(getsize(opj(local_data_dir, f)) for f in whole)
+    start_time = time.time()
+    parallel_put(
+        remote_shell,
+        [(opj(local_data_dir, f), opj(remote_datadir, f)) for f in whole],
+        n_channels=n_channels
+    )
+    for file in delta:
+        n_sent += delta_put(remote_shell, opj(local_data_dir, file),
+                            opj(remote_datadir, file), remote_workingdir)
+        print(f"updated {file}")
+    elapsed = max(time.time() - start_time, 1e-6)
+    print(f"finished uploading data: {n_sent} of {n_total} bytes sent "
+          f"({n_sent / elapsed / 1024:.1f} KB/s), {n_skipped} files skipped")
 
 
 # setup for running as a stand-alone script
 if __name__ == '__main__':
+    description = "Upload local changes to cluster scripts (and, optionally, \
+    data files) to the cluster"
+    arg_parser = ArgumentParser(description=description)
+    arg_parser.add_argument(
+        "--data-dir",
+        default=None,
+        type=str,
+        help="Local directory of data files to sync to the remote datadir. \
+        Large changed files are sent as block-level deltas"
+    )
+    args = arg_parser.parse_args()
+
     config = attempt_load_config()
     hostname = config['hostname']
     username = config['username']
@@ -56,7 +280,7 @@ if __name__ == '__main__':
 
     script_dir = opj(dirname(realpath(__file__)), 'cluster_scripts')
 
-    with connect_with_retries(
+    with connect_to_cluster(
         hostname=hostname,
         username=username,
         password=password
@@ -67,3 +291,5 @@ if __name__ == '__main__':
             job_config,
             confirm_overwrite=confirm_overwrite
         )
+        if args.data_dir is not None:
+            upload_data(cluster, args.data_dir, job_config)